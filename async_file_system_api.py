@@ -0,0 +1,464 @@
+"""
+asyncio front end of FileSystemApi
+"""
+
+import asyncio
+import functools
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import (
+    Any,
+    AsyncIterable,
+    AsyncIterator,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
+
+from core.file_system import FileSystem
+from file_system_api import FileMetadata, FileSystemApi
+from structs.file_handle import FileHandle
+from structs.file_stream import FileStream
+
+
+class ReadWriteLock:
+    """
+    Lets any number of readers in at once, or a single writer. A waiting writer
+    keeps new readers out so a steady stream of reads cannot starve it.
+    """
+
+    def __init__(self) -> None:
+        self._condition = threading.Condition()
+        self._readers = 0
+        self._writing = False
+        self._waiting_writers = 0
+
+    @contextmanager
+    def shared(self) -> Iterator[None]:
+        with self._condition:
+            while self._writing or self._waiting_writers:
+                self._condition.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._readers -= 1
+                if not self._readers:
+                    self._condition.notify_all()
+
+    @contextmanager
+    def exclusive(self) -> Iterator[None]:
+        with self._condition:
+            self._waiting_writers += 1
+            while self._writing or self._readers:
+                self._condition.wait()
+            self._waiting_writers -= 1
+            self._writing = True
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._writing = False
+                self._condition.notify_all()
+
+
+class VolumeExecutor:
+    """
+    The threads serving one mounted volume. Reads run in a bounded pool and hold
+    the volume's lock shared, mutations run one at a time on a single thread, in
+    the order they were submitted, and hold it exclusively.
+    """
+
+    def __init__(self, read_workers: int) -> None:
+        self.lock = ReadWriteLock()
+        self.read_workers = read_workers
+        self.readers = ThreadPoolExecutor(read_workers, thread_name_prefix="fs-read")
+        self.writer = ThreadPoolExecutor(1, thread_name_prefix="fs-write")
+
+    def shutdown(self) -> None:
+        self.readers.shutdown(wait=True)
+        self.writer.shutdown(wait=True)
+
+
+class CallBatcher:
+    """
+    Collects the calls made during one iteration of the event loop and hands
+    them to the worker threads in batches, so a burst of small operations costs
+    one thread hand-off and one loop wake-up per batch instead of per call.
+    Reads are split over the workers of the pool, mutations go to the writer
+    thread as a single batch that keeps their order.
+    """
+
+    def __init__(
+        self, loop: asyncio.AbstractEventLoop, executor: VolumeExecutor, mutating: bool
+    ) -> None:
+        self.loop = loop
+        self.executor = executor
+        self.mutating = mutating
+        self.pending: List[tuple] = []
+
+    def submit(self, func: Callable, *args, **kwargs) -> "asyncio.Future":
+        future = self.loop.create_future()
+        if not self.pending:
+            self.loop.call_soon(self._dispatch)
+        self.pending.append((future, func, args, kwargs))
+        return future
+
+    def _dispatch(self) -> None:
+        batch, self.pending = self.pending, []
+        if self.mutating:
+            self.executor.writer.submit(self._run, batch, self.executor.lock.exclusive)
+            return
+
+        workers = min(self.executor.read_workers, len(batch))
+        for worker in range(workers):
+            self.executor.readers.submit(
+                self._run, batch[worker::workers], self.executor.lock.shared
+            )
+
+    def _run(self, batch: List[tuple], lock: Callable) -> None:
+        results = []
+        with lock():
+            for future, func, args, kwargs in batch:
+                try:
+                    results.append((future, func(*args, **kwargs), None))
+                except BaseException as error:  # pylint: disable=broad-except
+                    results.append((future, None, error))
+        self.loop.call_soon_threadsafe(self._deliver, results)
+
+    @staticmethod
+    def _deliver(results: List[tuple]) -> None:
+        for future, result, error in results:
+            if future.done():
+                continue
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+
+_executors: "weakref.WeakKeyDictionary[FileSystem, VolumeExecutor]" = (
+    weakref.WeakKeyDictionary()
+)
+_executors_lock = threading.Lock()
+
+
+def get_volume_executor(
+    file_system: FileSystem, read_workers: int
+) -> VolumeExecutor:
+    """Returns the executor shared by every async API of a mounted volume."""
+    with _executors_lock:
+        if file_system not in _executors:
+            _executors[file_system] = VolumeExecutor(read_workers)
+        return _executors[file_system]
+
+
+def _read(name: str) -> Callable:
+    method = getattr(FileSystemApi, name)
+
+    @functools.wraps(method)
+    async def coroutine(self: "AsyncFileSystemApi", *args, **kwargs):
+        return await self._submit_read(method, self.api, *args, **kwargs)
+
+    return coroutine
+
+
+def _mutation(name: str) -> Callable:
+    method = getattr(FileSystemApi, name)
+
+    @functools.wraps(method)
+    async def coroutine(self: "AsyncFileSystemApi", *args, **kwargs):
+        return await self._submit_mutation(method, self.api, *args, **kwargs)
+
+    return coroutine
+
+
+def _inline(name: str) -> Callable:
+    method = getattr(FileSystemApi, name)
+
+    @functools.wraps(method)
+    async def coroutine(self: "AsyncFileSystemApi", *args, **kwargs):
+        return method(self.api, *args, **kwargs)
+
+    return coroutine
+
+
+class AsyncFileStream:
+    """
+    The asyncio counterpart of FileStream. Reads run in the volume's read pool,
+    writes are queued with the other mutations of the volume. Iterating over the
+    stream with async for yields its lines.
+    """
+
+    def __init__(self, api: "AsyncFileSystemApi", stream: FileStream) -> None:
+        self.api = api
+        self.stream = stream
+
+    async def read(self, size: int = -1) -> bytes:
+        return await self.api._submit_read(self.stream.read, size)
+
+    async def readline(self, size: int = -1) -> bytes:
+        return await self.api._submit_read(self.stream.readline, size)
+
+    async def write(self, data: bytes) -> int:
+        return await self.api._submit_mutation(self.stream.write, data)
+
+    async def seek(self, offset: int, whence: int = 0) -> int:
+        return self.stream.seek(offset, whence)
+
+    async def tell(self) -> int:
+        return self.stream.tell()
+
+    async def close(self) -> None:
+        self.stream.close()
+
+    async def __aenter__(self) -> "AsyncFileStream":
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+    def __aiter__(self) -> AsyncIterator[bytes]:
+        return self._lines()
+
+    async def _lines(self) -> AsyncIterator[bytes]:
+        while True:
+            line = await self.readline()
+            if not line:
+                return
+            yield line
+
+
+class AsyncFileSystemApi:
+    """
+    Mirrors every public method of FileSystemApi as a coroutine so the blocking
+    file system never runs on the event loop.
+
+    Reads run in a bounded thread pool, several at a time, on the positional
+    I/O path of the volume. Mutations go through an ordered queue per volume and
+    run one at a time, each one waiting for the reads in progress to finish.
+    Methods that only work on path strings run inline. Directory listings and
+    file contents can also be streamed with async iterators.
+    """
+
+    READ_WORKERS = 8
+    CHUNK_SIZE = 64 * 1024
+
+    READ_METHODS = (
+        "lookup",
+        "is_directory",
+        "exists",
+        "read_file",
+        "pread",
+        "stat",
+        "stat_many",
+        "get_file_metadata",
+        "get_file_size",
+        "list_directory_contents",
+        "list_page",
+        "get_directory_metadata",
+        "get_directory_size",
+        "search_for_file",
+        "get_free_space",
+        "get_total_space",
+        "get_fragmentation_percentage",
+        "get_compression_report",
+        "get_dedup_report",
+    )
+    # change_directory is queued with the mutations since reads resolve relative
+    # paths against the current directory
+    MUTATION_METHODS = (
+        "change_directory",
+        "create_empty_file",
+        "create_file",
+        "create_files",
+        "edit_file",
+        "append_file",
+        "pwrite",
+        "delete_file",
+        "rename_file",
+        "move_file",
+        "copy_file",
+        "create_directory",
+        "delete_directory",
+        "rename_directory",
+        "move_directory",
+        "copy_directory",
+        "make_directories",
+        "defragmentation",
+        "set_compression",
+        "deduplicate",
+        "grow",
+    )
+    INLINE_METHODS = ("normalize_path", "resolve_path", "is_valid_path")
+
+    def __init__(
+        self,
+        user_id: str,
+        api: Optional[FileSystemApi] = None,
+        read_workers: int = READ_WORKERS,
+    ) -> None:
+        """
+        :param user_id: The user whose file system is used.
+        :param api: An already created FileSystemApi to wrap, the volume of the
+            user is mounted when omitted.
+        :param read_workers: The size of the read pool, shared by every async
+            API of the same mounted volume.
+        """
+        self.user_id = user_id
+        self.api = api or FileSystemApi(user_id)
+        self.executor = get_volume_executor(self.api.file_system, read_workers)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    @classmethod
+    async def create_new_file_system(
+        cls, user_id: str, metadata: Optional[Dict[str, Any]] = None
+    ) -> "AsyncFileSystemApi":
+        """
+        Creates a new file system and returns an async API over it.
+
+        :param user_id: The user ID.
+        :param metadata: The metadata fields of the new volume.
+        :return: The async API.
+        """
+        api = await asyncio.get_running_loop().run_in_executor(
+            None, FileSystemApi.create_new_file_system, user_id, metadata or {}
+        )
+        return cls(user_id, api)
+
+    @classmethod
+    async def file_system_exists(cls, user_id: str) -> bool:
+        return FileSystemApi.file_system_exists(user_id)
+
+    @property
+    def current_directory(self) -> str:
+        return self.api.current_directory
+
+    async def open(
+        self, file_path: Union[str, FileHandle], mode: str = "rb"
+    ) -> AsyncFileStream:
+        """
+        Opens a file as an async stream, see FileSystemApi.open.
+
+        :param file_path: The path or handle of the file.
+        :param mode: "rb", "r+b" or "ab".
+        :return: The stream of the file.
+        """
+        if mode == "ab":
+            stream = await self._submit_mutation(self.api.open, file_path, mode)
+        else:
+            stream = await self._submit_read(self.api.open, file_path, mode)
+        return AsyncFileStream(self, stream)
+
+    async def iter_file(
+        self, file_path: Union[str, FileHandle], chunk_size: int = CHUNK_SIZE
+    ) -> AsyncIterator[bytes]:
+        """
+        Yields the contents of a file in chunks, reading ahead of them.
+
+        :param file_path: The path or handle of the file.
+        :param chunk_size: The size of every chunk but the last.
+        :return: An async iterator over the chunks.
+        """
+        async with await self.open(file_path) as stream:
+            while True:
+                chunk = await stream.read(chunk_size)
+                if not chunk:
+                    return
+                yield chunk
+
+    async def write_file(
+        self,
+        file_path: str,
+        chunks: AsyncIterable[bytes],
+        size_hint: Optional[int] = None,
+    ) -> int:
+        """
+        Creates a file from an async iterator of chunks with a streaming writer.
+        The file only appears once every chunk was written, and a failure or
+        cancellation while writing discards it.
+
+        :param file_path: The path of the new file.
+        :param chunks: The data of the file.
+        :param size_hint: The expected size of the file.
+        :return: The number of bytes written.
+        """
+        writer = await self._submit_mutation(
+            self.api.create_writer, file_path, size_hint
+        )
+        try:
+            async for chunk in chunks:
+                await self._submit_mutation(writer.write, chunk)
+        except BaseException:
+            await self._submit_mutation(writer.cancel)
+            raise
+        await self._submit_mutation(writer.close)
+        return writer.bytes_written
+
+    async def scan_directory(
+        self,
+        dir_path: Union[str, FileHandle],
+        start_after: Optional[str] = None,
+        limit: Optional[int] = None,
+    ) -> AsyncIterator[FileMetadata]:
+        """
+        Yields the metadata of the children of a directory, see
+        FileSystemApi.scan_directory.
+        """
+        children = await self._submit_read(
+            lambda: list(self.api.scan_directory(dir_path, start_after, limit))
+        )
+        for child in children:
+            yield child
+
+    async def iter_directory(
+        self, dir_path: Union[str, FileHandle], limit: int = FileSystem.PAGE_SIZE
+    ) -> AsyncIterator[FileMetadata]:
+        """
+        Yields the metadata of the children of a directory, reading one page at
+        a time, see FileSystemApi.iter_directory.
+        """
+        handle = await self.lookup(dir_path) if isinstance(dir_path, str) else dir_path
+        cursor = None
+        while True:
+            page, cursor = await self.list_page(handle, cursor, limit)
+            for child in page:
+                yield child
+            if cursor is None:
+                return
+
+    async def create_writer(self, *args, **kwargs):
+        """
+        Returns a FileWriter, see FileSystemApi.create_writer. Its methods block,
+        use write_file to stream a file from the event loop.
+        """
+        return await self._submit_mutation(self.api.create_writer, *args, **kwargs)
+
+    def _submit_read(self, func: Callable, *args, **kwargs) -> "asyncio.Future":
+        return self._batchers()[0].submit(func, *args, **kwargs)
+
+    def _submit_mutation(self, func: Callable, *args, **kwargs) -> "asyncio.Future":
+        return self._batchers()[1].submit(func, *args, **kwargs)
+
+    def _batchers(self) -> Tuple[CallBatcher, CallBatcher]:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._read_batcher = CallBatcher(loop, self.executor, mutating=False)
+            self._mutation_batcher = CallBatcher(loop, self.executor, mutating=True)
+        return self._read_batcher, self._mutation_batcher
+
+
+for _name in AsyncFileSystemApi.READ_METHODS:
+    setattr(AsyncFileSystemApi, _name, _read(_name))
+for _name in AsyncFileSystemApi.MUTATION_METHODS:
+    setattr(AsyncFileSystemApi, _name, _mutation(_name))
+for _name in AsyncFileSystemApi.INLINE_METHODS:
+    setattr(AsyncFileSystemApi, _name, _inline(_name))
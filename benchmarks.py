@@ -0,0 +1,808 @@
+"""
+Benchmarks for the file system, run with:
+
+    python benchmarks.py <scenario> [--entries N] [--dir PATH]
+
+Volumes are created in a temporary directory (pass --dir /dev/shm to keep the
+O_SYNC writes of the setup phase cheap) and removed afterwards.
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, List, Tuple
+
+from async_file_system_api import AsyncFileSystemApi
+from core.block_device import BlockDevice
+from core.file_system import FileSystem
+from file_system_api import FileSystemApi
+from managers.dentry_cache import DentryCache
+from structs.metadata import Metadata
+from structs.readahead import Readahead
+from utility import open_file_without_cache
+
+
+def create_volume(base_dir: str, name: str, **specs) -> FileSystem:
+    file_system_name = os.path.join(base_dir, name)
+    return FileSystem(
+        file_system_name=file_system_name,
+        user_id=name,
+        specs=Metadata(f"{file_system_name}.disk", **specs),
+    )
+
+
+def timed(func: Callable, repeat: int = 1) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat
+
+
+def bench_sorted_dirs(base_dir: str, entries: int) -> None:
+    names = [f"file_{i:07d}" for i in range(entries)]
+    random.shuffle(names)
+    probes = random.sample(names, min(2000, entries))
+    middle = sorted(names)[entries // 2]
+
+    for sorted_directories in (False, True):
+        mode = "sorted" if sorted_directories else "unsorted"
+        file_system = create_volume(
+            base_dir,
+            mode,
+            file_index_size=(entries + 16) * 64,
+            sorted_directories=sorted_directories,
+        )
+        file_system.create_directory("/big")
+        file_system.create_files("/big", dict.fromkeys(names, b""))
+
+        # The first access builds the in-memory array for sorted volumes
+        first = timed(lambda: file_system.resolve_path(f"/big/{probes[0]}"))
+        lookup = timed(
+            lambda: [file_system.resolve_path(f"/big/{name}") for name in probes]
+        ) / len(probes)
+
+        if sorted_directories:
+            listing = timed(lambda: file_system.list_directory_contents("/big"))
+            page = timed(
+                lambda: file_system.list_directory_contents("/big", middle, 100), 100
+            )
+        else:
+            listing = timed(
+                lambda: sorted(file_system.list_directory_contents("/big"))
+            )
+            page = timed(
+                lambda: [
+                    name
+                    for name in sorted(file_system.list_directory_contents("/big"))
+                    if name > middle
+                ][:100],
+                5,
+            )
+
+        print(f"[{mode}] {entries} entries")
+        print(f"  first lookup:          {first * 1e3:10.3f} ms")
+        print(f"  lookup:                {lookup * 1e6:10.3f} us")
+        print(f"  ordered listing:       {listing * 1e3:10.3f} ms")
+        print(f"  100 names after name:  {page * 1e3:10.3f} ms")
+        file_system.shut_down()
+
+
+def bench_bulk_create(base_dir: str, entries: int) -> None:
+    files = {f"file_{i:07d}": os.urandom(100) for i in range(entries)}
+    file_index_size = (entries + 16) * 64
+
+    file_system = create_volume(base_dir, "loop", file_index_size=file_index_size)
+    file_system.create_directory("/import")
+    loop = timed(
+        lambda: [
+            file_system.create_file(f"/import/{name}", data)
+            for name, data in files.items()
+        ]
+    )
+    file_system.shut_down()
+
+    file_system = create_volume(base_dir, "bulk", file_index_size=file_index_size)
+    file_system.create_directory("/import")
+    bulk = timed(lambda: file_system.create_files("/import", files))
+    file_system.shut_down()
+
+    print(f"{entries} files of 100 bytes")
+    print(f"  create_file loop: {loop:10.3f} s")
+    print(f"  create_files:     {bulk:10.3f} s")
+
+
+def bench_path_lookup(base_dir: str, entries: int) -> None:
+    names = [f"file_{i:07d}" for i in range(entries)]
+    paths = [f"/a/b/c/{name}" for name in names]
+    missing = [f"/a/b/c/missing_{i}" for i in range(entries)]
+
+    for capacity in (0, FileSystem.DENTRY_CACHE_SIZE):
+        file_system = create_volume(
+            base_dir, f"cache_{capacity}", file_index_size=(entries + 16) * 64
+        )
+        file_system.dentry_cache = DentryCache(capacity)
+        for directory in ("/a", "/a/b", "/a/b/c"):
+            file_system.create_directory(directory)
+        file_system.create_files("/a/b/c", dict.fromkeys(names, b""))
+
+        hot = paths[: capacity // 2 or 100]
+        for path in hot + missing[:100]:
+            file_system.exists(path)
+
+        resolve = timed(lambda: [file_system.resolve_path(p) for p in hot], 5)
+        exists = timed(lambda: [file_system.exists(p) for p in missing[:100]], 5)
+
+        print(f"[dentry cache capacity {capacity}] {entries} entries")
+        print(f"  resolve hot path:   {resolve / len(hot) * 1e6:10.3f} us")
+        print(f"  exists on missing:  {exists / 100 * 1e6:10.3f} us")
+        file_system.shut_down()
+
+
+def bench_scan_directory(base_dir: str, entries: int) -> None:
+    names = [f"file_{i:07d}" for i in range(entries)]
+    file_system = create_volume(base_dir, "scan", file_index_size=(entries + 16) * 64)
+    file_system.create_directory("/big")
+    file_system.create_files("/big", dict.fromkeys(names, b"data"))
+    api = FileSystemApi("scan", file_system)
+
+    per_name = timed(
+        lambda: [
+            (api.stat(f"/big/{name}"), api.is_directory(f"/big/{name}"))
+            for name in api.list_directory_contents("/big")
+        ]
+    )
+    scan = timed(lambda: list(api.scan_directory("/big")))
+    batched = timed(lambda: api.stat_many([f"/big/{name}" for name in names]))
+
+    print(f"listing with metadata, {entries} entries")
+    print(f"  list + stat per name:  {per_name * 1e3:10.3f} ms")
+    print(f"  scan_directory:        {scan * 1e3:10.3f} ms")
+    print(f"  stat_many:             {batched * 1e3:10.3f} ms")
+    file_system.shut_down()
+
+
+def bench_append_log(base_dir: str, entries: int) -> None:
+    lines = [f"{i:08d} log entry with some text\n".encode() for i in range(entries)]
+    file_system = create_volume(base_dir, "append")
+
+    file_system.create_file("/rewrite.log", b"")
+    rewrite = timed(
+        lambda: [
+            file_system.edit_file(
+                "/rewrite.log", file_system.read_file("/rewrite.log") + line
+            )
+            for line in lines
+        ]
+    )
+    file_system.create_file("/append.log", b"")
+    append = timed(
+        lambda: [file_system.append_file("/append.log", line) for line in lines]
+    )
+    assert file_system.read_file("/append.log") == b"".join(lines)
+
+    print(f"{entries} appended lines")
+    print(f"  read + edit_file: {rewrite:10.3f} s")
+    print(f"  append_file:      {append:10.3f} s")
+    file_system.shut_down()
+
+
+def bench_storage_backends(base_dir: str, entries: int) -> None:
+    files = {f"file_{i:07d}": os.urandom(1000) for i in range(entries)}
+
+    for backend in ("file", "mmap"):
+        file_system = create_volume(
+            base_dir,
+            backend,
+            file_index_size=(entries + 16) * 64,
+            storage_backend=backend,
+        )
+        file_system.create_directory("/data")
+        file_system.create_files("/data", files)
+        nodes = [file_system.resolve_path(f"/data/{name}") for name in files]
+
+        read = timed(lambda: [file_system.read_file(node) for node in nodes], 3)
+        pread = timed(lambda: [file_system.pread(node, 500, 64) for node in nodes], 3)
+        listing = timed(lambda: file_system.scan_directory("/data"), 3)
+        append = timed(
+            lambda: [file_system.append_file(node, b"x") for node in nodes[:1000]]
+        )
+
+        print(f"[{backend}] {entries} files of 1000 bytes")
+        print(f"  read_file:        {read / entries * 1e6:10.3f} us")
+        print(f"  pread 64 bytes:   {pread / entries * 1e6:10.3f} us")
+        print(f"  scan_directory:   {listing * 1e3:10.3f} ms")
+        print(f"  append_file:      {append / min(1000, entries) * 1e6:10.3f} us")
+        file_system.shut_down()
+
+
+def bench_durability(base_dir: str, entries: int) -> None:
+    sessions = 8
+    count = max(sessions, min(entries, 2000)) // sessions * sessions
+
+    for durability in ("sync", "commit", "group"):
+        name = f"durability_{durability}"
+        file_system = create_volume(
+            base_dir, name, durability=durability, block_cache_size=0
+        )
+        create = timed(
+            lambda: [
+                file_system.create_file(f"/file_{i}", b"x" * 100) for i in range(count)
+            ]
+        )
+        for session in range(sessions):
+            file_system.create_file(f"/session_{session}", b"x" * 4096)
+        file_system.shut_down()
+
+        # Every session mounts the volume on its own and only overwrites its own
+        # file, like concurrent shell sessions of one user
+        mounts = [
+            FileSystem(os.path.join(base_dir, name), name) for _ in range(sessions)
+        ]
+        flushes = []
+        original_fsync = os.fsync
+        os.fsync = lambda fd: flushes.append(fd) or original_fsync(fd)
+
+        def session_writes(session: int) -> None:
+            node = mounts[session].resolve_path(f"/session_{session}")
+            for i in range(count // sessions):
+                mounts[session].pwrite(node, (i * 64) % 4096, b"y" * 64)
+
+        def run_sessions() -> None:
+            threads = [
+                threading.Thread(target=session_writes, args=(session,))
+                for session in range(sessions)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        concurrent = timed(run_sessions)
+        os.fsync = original_fsync
+        print(f"[{durability}] {count} transactions")
+        print(f"  create_file, one session:  {count / create:10.1f} tx/s")
+        print(f"  pwrite, {sessions} sessions:        {count / concurrent:10.1f} tx/s")
+        print(f"  fsync calls for the pwrites: {len(flushes):8d}")
+        for mount in mounts:
+            mount.shut_down()
+
+
+def bench_block_cache(base_dir: str, entries: int) -> None:
+    directories = max(1, entries // 100)
+    files = {f"file_{i:03d}": os.urandom(1000) for i in range(100)}
+
+    for cache_size in (0, 4 * 1024 * 1024):
+        file_system = create_volume(
+            base_dir,
+            f"block_cache_{cache_size}",
+            file_index_size=(directories * 101 + 16) * 64,
+            durability="commit",
+            block_cache_size=cache_size,
+        )
+
+        def create() -> None:
+            for i in range(directories):
+                file_system.create_directory(f"/dir_{i}")
+                file_system.create_files(f"/dir_{i}", files)
+
+        created = timed(create)
+        hot = [file_system.resolve_path(f"/dir_0/{name}") for name in files]
+
+        def walk() -> None:
+            for directory in file_system.scan_directory("/"):
+                file_system.scan_directory(f"/{directory.file_name}")
+
+        read = timed(lambda: [file_system.read_file(node) for node in hot], 10)
+        walked = timed(walk, 3)
+
+        print(f"[cache {cache_size // 1024} KB] {directories * len(files)} files")
+        print(f"  create, commit mode:   {created * 1e3:10.3f} ms")
+        print(f"  read_file, hot:        {read / len(hot) * 1e6:10.3f} us")
+        print(f"  directory walk:        {walked * 1e3:10.3f} ms")
+        if cache_size:
+            storage = file_system.storage
+            print(f"  hits / misses:         {storage.hits} / {storage.misses}")
+        file_system.shut_down()
+
+
+def bench_readahead(base_dir: str, entries: int) -> None:
+    line = b"x" * 99 + b"\n"
+    data = line * (10 * 1024 * 1024 // len(line))
+    file_system = create_volume(base_dir, "readahead", block_cache_size=0)
+    file_system.create_file("/big.log", data)
+    node = file_system.resolve_path("/big.log")
+    api = FileSystemApi("readahead", file_system=file_system)
+    chunk = 8192
+
+    def streamed(max_window: int) -> None:
+        with api.open("/big.log") as stream:
+            stream.readahead.max_window = max_window
+            while stream.read(chunk):
+                pass
+
+    def lines(max_window: int) -> None:
+        with api.open("/big.log") as stream:
+            stream.readahead.max_window = max_window
+            for _ in stream:
+                pass
+
+    size_mb = len(data) / 1024 / 1024
+    print(f"{size_mb:.0f} MB file")
+    for max_window in (0, Readahead.MAX_WINDOW):
+        label = f"readahead up to {max_window // 1024} KB" if max_window else "none"
+        print(f"[readahead: {label}]")
+        read = timed(lambda: streamed(max_window), 3)
+        read_lines = timed(lambda: lines(max_window))
+        print(f"  {chunk} byte reads:  {size_mb / read:10.1f} MB/s")
+        print(f"  lines:             {size_mb / read_lines:10.1f} MB/s")
+
+    with api.open("/big.log") as stream:
+        while stream.read(chunk):
+            pass
+        readahead = stream.readahead
+    print(
+        f"  hits / misses: {readahead.hits} / {readahead.misses}, "
+        f"{readahead.fetches} windows up to {readahead.window // 1024} KB"
+    )
+    file_system.shut_down()
+
+
+def bench_block_device(base_dir: str, entries: int) -> None:
+    path = os.path.join(base_dir, "device.img")
+    with open(path, "wb") as image:
+        image.truncate(64 * 1024 * 1024)
+    offsets = [random.randrange(0, 64 * 1024 * 1024 - 4096) for _ in range(entries)]
+    threads = 4
+
+    # The old access path: one shared file object, seek then read under a lock
+    shared_file = open_file_without_cache(path, "r+b", synchronous=False)
+    seek_lock = threading.Lock()
+
+    def seek_read(offset: int) -> bytes:
+        with seek_lock:
+            shared_file.seek(offset)
+            return shared_file.read(4096)
+
+    device = BlockDevice(path, synchronous=False)
+
+    def in_threads(read: Callable[[int], bytes]) -> None:
+        workers = [
+            threading.Thread(
+                target=lambda part: [read(offset) for offset in part],
+                args=(offsets[i::threads],),
+            )
+            for i in range(threads)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+    print(f"{entries} random 4 KB reads")
+    def pread(offset: int) -> bytes:
+        return device.read_at(offset, 4096)
+
+    for label, read in (("seek + read", seek_read), ("pread", pread)):
+        # Warm the page cache so both paths read from memory
+        in_threads(read)
+        single = timed(lambda: [read(offset) for offset in offsets])
+        parallel = timed(lambda: in_threads(read))
+        print(f"[{label}]")
+        print(f"  1 thread:    {entries / single:12.0f} reads/s")
+        print(f"  {threads} threads:   {entries / parallel:12.0f} reads/s")
+
+    pages = [os.urandom(4096) for _ in range(256)]
+    joined = timed(lambda: device.write_at(0, b"".join(pages)), 20)
+    vectored = timed(lambda: device.writev_at(0, pages), 20)
+    print("256 pages written at once")
+    print(f"  join + pwrite:  {joined * 1e6:10.1f} us")
+    print(f"  pwritev:        {vectored * 1e6:10.1f} us")
+    shared_file.close()
+    device.close()
+
+
+def bench_async_api(base_dir: str, entries: int) -> None:
+    clients = 100
+    operations = max(clients, min(entries, 20000)) // clients
+    file_system = create_volume(base_dir, "async_api", durability="commit")
+    files = {f"file_{i}": os.urandom(2000) for i in range(500)}
+    file_system.create_directory("/data")
+    file_system.create_files("/data", files)
+    api = FileSystemApi("async_api", file_system=file_system)
+    async_api = AsyncFileSystemApi("async_api", api)
+    names = list(files)
+
+    def client_ops(client: int) -> Iterator[Tuple[str, tuple]]:
+        # Nine reads for every append
+        for i in range(operations):
+            name = names[(client * 31 + i) % len(names)]
+            if i % 10 == 9:
+                yield "append_file", (f"/data/{name}", b"x")
+            elif i % 10 == 8:
+                yield "stat", (f"/data/{name}",)
+            else:
+                yield "read_file", (f"/data/{name}",)
+
+    async def measure_lag(done: asyncio.Event, lags: List[float]) -> None:
+        while not done.is_set():
+            start = time.perf_counter()
+            await asyncio.sleep(0.001)
+            lags.append(time.perf_counter() - start - 0.001)
+
+    async def run_clients(target: Any, awaited: bool) -> List[float]:
+        done, lags = asyncio.Event(), []
+        ticker = asyncio.create_task(measure_lag(done, lags))
+
+        async def client(client_id: int) -> None:
+            for name, args in client_ops(client_id):
+                result = getattr(target, name)(*args)
+                if awaited:
+                    await result
+                else:
+                    # Yield like an async client would, the call itself blocks
+                    await asyncio.sleep(0)
+
+        await asyncio.gather(*(client(i) for i in range(clients)))
+        done.set()
+        await ticker
+        return lags
+
+    total = clients * operations
+    print(f"{clients} clients, {total} operations, 10% appends")
+    for label, target, awaited in (
+        ("FileSystemApi", api, False),
+        ("AsyncFileSystemApi", async_api, True),
+    ):
+        lags: List[float] = []
+        elapsed = timed(lambda: lags.extend(asyncio.run(run_clients(target, awaited))))
+        print(f"[{label}]")
+        print(f"  throughput:          {total / elapsed:10.0f} ops/s")
+        print(f"  worst loop stall:    {max(lags, default=0) * 1e3:10.2f} ms")
+    file_system.shut_down()
+
+
+def bench_reflink(base_dir: str, entries: int) -> None:
+    data = os.urandom(16 * 1024 * 1024)
+    file_system = create_volume(base_dir, "reflink")
+    file_system.create_file("/big.bin", data)
+    size_mb = len(data) / 1024 / 1024
+    copies = 3
+
+    def full_copy(path: str) -> None:
+        file_system.create_file(path, file_system.read_file("/big.bin"))
+
+    print(f"{size_mb:.0f} MB file, {copies} copies")
+    for label, copy in (
+        ("full copy", full_copy),
+        ("reflink", lambda path: file_system.copy_file("/big.bin", path)),
+    ):
+        paths = [f"/{label}_{i}" for i in range(copies)]
+        free_space = file_system.get_free_space()
+        elapsed = sum(timed(lambda: copy(path)) for path in paths)
+        used = (free_space - file_system.get_free_space()) / 1024 / 1024
+        print(f"[{label}]")
+        print(f"  per copy:            {elapsed / copies * 1e3:10.2f} ms")
+        print(f"  space used:          {used:10.1f} MB")
+        if copy is full_copy:
+            # The volume only holds a few full copies
+            for path in paths:
+                file_system.delete_file(path)
+
+    clone = file_system.resolve_path("/reflink_0")
+    edit = timed(lambda: file_system.pwrite(clone, 0, b"edited"))
+    print(f"  first edit of clone: {edit * 1e3:10.2f} ms")
+    file_system.shut_down()
+
+
+def bench_copy_directory(base_dir: str, entries: int) -> None:
+    per_directory = 100
+    directories = max(1, entries // per_directory)
+    file_system = create_volume(
+        base_dir, "copy_directory", file_index_size=(3 * entries + 64) * 64
+    )
+    file_system.create_directory("/project")
+    for d in range(directories):
+        file_system.create_directory(f"/project/pkg_{d}")
+        file_system.create_files(
+            f"/project/pkg_{d}",
+            {f"module_{i}.py": os.urandom(200) for i in range(per_directory)},
+        )
+
+    def copy_entries(path: str, new_path: str) -> None:
+        # What copy_directory used to do, one transaction per entry
+        file_system.create_directory(new_path)
+        for child in file_system.resolve_path(path).load_children(file_system):
+            child_path = f"{path}/{child.file_name}"
+            new_child_path = f"{new_path}/{child.file_name}"
+            if child.is_directory:
+                copy_entries(child_path, new_child_path)
+            else:
+                file_system.copy_file(child_path, new_child_path)
+
+    print(f"{directories * per_directory} files in {directories} directories")
+    for label, copy in (
+        ("per entry", copy_entries),
+        ("bulk clone", file_system.copy_directory),
+    ):
+        free_space = file_system.get_free_space()
+        elapsed = timed(lambda: copy("/project", f"/{label.replace(' ', '_')}"))
+        used = (free_space - file_system.get_free_space()) / 1024
+        print(f"[{label}]")
+        print(f"  copy:        {elapsed:10.3f} s")
+        print(f"  space used:  {used:10.1f} KB")
+    file_system.shut_down()
+
+
+def bench_compression(base_dir: str, entries: int) -> None:
+    paths = ["GET /index.html", "POST /api/login", "GET /static/app.js"]
+    data = b"".join(
+        f"2024-05-{i % 28 + 1:02d} 12:{i % 60:02d}:{i * 7 % 60:02d} "
+        f"10.0.{i % 256}.{i * 13 % 256} {random.choice(paths)} "
+        f"{random.choice((200, 200, 200, 304, 404))} {random.randint(100, 50000)}\n"
+        .encode()
+        for i in range(150_000)
+    )
+    size_mb = len(data) / 1024 / 1024
+    print(f"{size_mb:.1f} MB access log")
+
+    for codec in ("none", "zlib", "lzma"):
+        file_system = create_volume(
+            base_dir,
+            f"compression_{codec}",
+            compression="zlib" if codec == "none" else codec,
+            block_cache_size=0,
+        )
+        compress = codec != "none"
+        create = timed(lambda: file_system.create_file("/a.log", data, compress))
+        node = file_system.resolve_path("/a.log")
+        stored = node.file_blocks * file_system.config_manager.block_size
+
+        def read_all() -> None:
+            node.compressed_layout = None
+            file_system.read_file(node)
+
+        def random_reads() -> None:
+            for _ in range(200):
+                file_system.pread(node, random.randrange(len(data) - 4096), 4096)
+
+        read = timed(read_all, 3)
+        pread = timed(random_reads)
+        print(f"[{codec}]")
+        print(f"  stored:            {stored / 1024 / 1024:10.2f} MB")
+        print(f"  create:            {size_mb / create:10.1f} MB/s")
+        print(f"  read_file:         {size_mb / read:10.1f} MB/s")
+        print(f"  4 KB random pread: {pread / 200 * 1e6:10.1f} us")
+        if compress:
+            report = file_system.compressor.report()
+            print(
+                f"  ratio {report['ratio']:.2f}, compress "
+                f"{report['compress_mb_s']:.1f} MB/s, decompress "
+                f"{report['decompress_mb_s']:.1f} MB/s"
+            )
+        file_system.shut_down()
+
+
+def bench_dedup(base_dir: str, entries: int) -> None:
+    count = min(entries, 2000)
+    originals = [os.urandom(4096) for _ in range(count // 2)]
+    # Half of the files repeat an earlier one
+    files = {f"file_{i}": originals[i % len(originals)] for i in range(count)}
+    size_mb = sum(map(len, files.values())) / 1024 / 1024
+    print(f"{count} files of 4 KB, half of them copies")
+
+    for dedup in (False, True):
+        file_system = create_volume(
+            base_dir,
+            f"dedup_{dedup}",
+            dedup=dedup,
+            file_index_size=(2 * count + 64) * 64,
+        )
+        free_space = file_system.get_free_space()
+        create = timed(
+            lambda: [
+                file_system.create_file(f"/{name}", data)
+                for name, data in files.items()
+            ]
+        )
+        used = (free_space - file_system.get_free_space()) / 1024 / 1024
+        # Unique data only pays for hashing and the digest index
+        unique = timed(
+            lambda: [
+                file_system.create_file(f"/unique_{i}", data[::-1])
+                for i, data in enumerate(originals)
+            ]
+        )
+        print(f"[inline dedup {'on' if dedup else 'off'}]")
+        print(f"  create_file:   {size_mb / create:10.2f} MB/s")
+        print(f"  unique files:  {size_mb / 2 / unique:10.2f} MB/s")
+        print(f"  space used:    {used:10.2f} MB")
+
+        if not dedup:
+            free_space = file_system.get_free_space()
+            offline = timed(file_system.deduplicate)
+            freed = (file_system.get_free_space() - free_space) / 1024 / 1024
+            print(f"  offline pass:  {offline:10.3f} s")
+            print(f"  space freed:   {freed:10.2f} MB")
+        report = file_system.dedup_manager.report()
+        print(
+            f"  {report['files_deduplicated']} files deduplicated, "
+            f"{report['bytes_saved'] / 1024 / 1024:.2f} MB saved, "
+            f"hashing at {report['hash_mb_s']:.0f} MB/s"
+        )
+        file_system.shut_down()
+
+
+def bench_sparse(base_dir: str, entries: int) -> None:
+    size = 32 * 1024 * 1024
+    image = bytearray(size)
+    # A VM style image: 5% of it is data in 64 KB runs, the rest never written
+    runs = range(0, size, 64 * 1024)
+    for offset in random.sample(runs, len(runs) // 20):
+        image[offset : offset + 64 * 1024] = os.urandom(64 * 1024)
+    image[-1:] = b"\1"
+    size_mb = size / 1024 / 1024
+    print(f"{size_mb:.0f} MB image, 5% data")
+
+    # The dense image has its holes filled in, which is what storing every zero
+    # block used to cost
+    dense = bytes(image).replace(bytes(1), b"\1")
+    for name, data in (("dense", dense), ("sparse", bytes(image))):
+        file_system = create_volume(
+            base_dir, f"sparse_{name}", block_size=4096, block_cache_size=0
+        )
+        free_space = file_system.get_free_space()
+        create = timed(lambda: file_system.create_file("/disk.img", data))
+        used = (free_space - file_system.get_free_space()) / 1024 / 1024
+        node = file_system.resolve_path("/disk.img")
+        read = timed(lambda: file_system.read_file(node), 3)
+        pread = timed(
+            lambda: [
+                file_system.pread(node, random.randrange(size - 4096), 4096)
+                for _ in range(500)
+            ]
+        )
+        print(f"[{name}]")
+        print(f"  space used:        {used:10.2f} MB")
+        print(f"  create:            {size_mb / create:10.1f} MB/s")
+        print(f"  read_file:         {size_mb / read:10.1f} MB/s")
+        print(f"  4 KB random pread: {pread / 500 * 1e6:10.1f} us")
+        file_system.shut_down()
+
+
+def bench_size_classes(base_dir: str, entries: int) -> None:
+    count = min(entries, 2000)
+    small_files = {
+        f"small_{i}": os.urandom(random.randint(50, 2000)) for i in range(count)
+    }
+    large_files = {f"large_{i}": os.urandom(1024 * 1024) for i in range(16)}
+    print(f"{count} files of 50 B to 2 KB, 16 files of 1 MB")
+
+    def used_bytes(bitmap_manager: Any) -> int:
+        regions = [bitmap_manager]
+        if hasattr(bitmap_manager, "large"):
+            regions = [bitmap_manager.small, bitmap_manager.large]
+        return sum(
+            sum(bin(byte).count("1") for byte in region.bitmap) * region.block_size
+            for region in regions
+        )
+
+    layouts = {
+        "32 B blocks": {"block_size": 32},
+        "4 KB blocks": {"block_size": 4096},
+        "32 B + 4 KB regions": {
+            "block_size": 32,
+            "large_region_size": 48 * 1024 * 1024,
+        },
+    }
+    for name, specs in layouts.items():
+        file_system = create_volume(
+            base_dir,
+            f"size_classes_{specs['block_size']}_{len(specs)}",
+            file_index_size=(count + 64) * 96,
+            **specs,
+        )
+        create_small = timed(lambda: file_system.create_files("/", small_files))
+        small_used = used_bytes(file_system.bitmap_manager)
+        create_large = timed(
+            lambda: [
+                file_system.create_file(f"/{name}", data)
+                for name, data in large_files.items()
+            ]
+        )
+        large_used = used_bytes(file_system.bitmap_manager) - small_used
+        grow = timed(
+            lambda: [
+                file_system.pwrite(node, 1024 * 1024, b"x" * 512 * 1024)
+                for node in (
+                    file_system.resolve_path(f"/{name}") for name in large_files
+                )
+            ]
+        )
+        print(f"[{name}]")
+        print(f"  bitmaps:         {file_system.config_manager.bitmap_size:10d} B")
+        print(f"  small files use: {small_used / 1024 / 1024:10.2f} MB")
+        print(f"  large files use: {large_used / 1024 / 1024:10.2f} MB")
+        print(f"  create small:    {create_small * 1000:10.1f} ms")
+        print(f"  create large:    {16 / create_large:10.1f} MB/s")
+        print(f"  grow large:      {8 / grow:10.1f} MB/s")
+        file_system.shut_down()
+
+
+def bench_resize(base_dir: str, entries: int) -> None:
+    count = min(entries, 1000)
+    print(f"{count} files per volume, grown from 64 MB to 128 MB")
+
+    for data_mb in (1, 8, 32):
+        files = {
+            f"file_{i}": os.urandom(data_mb * 1024 * 1024 // count)
+            for i in range(count)
+        }
+        file_system = create_volume(
+            base_dir,
+            f"resize_{data_mb}",
+            file_system_size=64 * 1024 * 1024,
+            file_index_size=(count + 64) * 96,
+        )
+        file_system.create_files("/", files)
+        grow = timed(lambda: file_system.grow(128 * 1024 * 1024))
+        file_system.shut_down()
+
+        # What growing took before: copying everything into a bigger volume
+        file_system = FileSystem(os.path.join(base_dir, f"resize_{data_mb}"), "resize")
+        copy = create_volume(
+            base_dir,
+            f"resize_{data_mb}_copy",
+            file_system_size=128 * 1024 * 1024,
+            file_index_size=(count + 64) * 96,
+        )
+        export = timed(
+            lambda: copy.create_files(
+                "/",
+                {
+                    name: file_system.read_file(file_system.resolve_path(f"/{name}"))
+                    for name in files
+                },
+            )
+        )
+        print(f"[{data_mb} MB of data]")
+        print(f"  grow:              {grow * 1000:10.1f} ms")
+        print(f"  export + reimport: {export * 1000:10.1f} ms")
+        copy.shut_down()
+        file_system.shut_down()
+
+
+SCENARIOS: Dict[str, Callable[[str, int], None]] = {
+    "sorted_dirs": bench_sorted_dirs,
+    "bulk_create": bench_bulk_create,
+    "path_lookup": bench_path_lookup,
+    "scan_directory": bench_scan_directory,
+    "append_log": bench_append_log,
+    "storage_backends": bench_storage_backends,
+    "durability": bench_durability,
+    "block_cache": bench_block_cache,
+    "readahead": bench_readahead,
+    "block_device": bench_block_device,
+    "async_api": bench_async_api,
+    "reflink": bench_reflink,
+    "copy_directory": bench_copy_directory,
+    "compression": bench_compression,
+    "dedup": bench_dedup,
+    "sparse": bench_sparse,
+    "size_classes": bench_size_classes,
+    "resize": bench_resize,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run file system benchmarks.")
+    parser.add_argument("scenario", choices=sorted(SCENARIOS))
+    parser.add_argument("--entries", type=int, default=100_000)
+    parser.add_argument("--dir", type=str, default=None)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as base_dir:
+        SCENARIOS[args.scenario](base_dir, args.entries)
@@ -10,9 +10,20 @@ class CatCommand(BaseCommand):
     description = "Prints the contents of a file to the console."
     arguments = [{"name": "file_path", "optional": False}]
 
+    def run(self, args: List[str], fs: "FileSystemApi", printline):
+        if ">" in args or ">>" in args:
+            return super().run(args, fs, printline)
+
+        # Print the file line by line as it is read instead of loading it whole,
+        # the stream reads ahead of the lines in large windows
+        self.validate_args(args)
+        with fs.open(fs.lookup(args[0])) as stream:
+            for line in stream:
+                printline(line.decode().rstrip("\n"))
+
     def execute(self, args: List[str], fs: "FileSystemApi") -> str:
-        file_path = args[0]
+        file_handle = fs.lookup(args[0])
 
-        file_contents = fs.read_file(file_path)
+        file_contents = fs.read_file(file_handle)
 
         return file_contents.decode()
@@ -18,19 +18,26 @@ class CpCommand(BaseCommand):
         source = args[0]
         destination = args[1]
 
-        if not fs.exists(source):
+        try:
+            source_handle = fs.lookup(source)
+        except FileNotFoundError:
             raise ValueError(f"Error: Source file '{source}' does not exist.")
 
-        if fs.is_directory(source):
+        if fs.is_directory(source_handle):
             raise ValueError(
                 f"Error: Source '{source}' is a directory. Only file copying is supported."
             )
 
-        if not fs.is_directory(destination):
+        try:
+            destination_handle = fs.lookup(destination)
+        except FileNotFoundError:
+            raise ValueError(f"Destination '{destination}' is not a directory.")
+
+        if not fs.is_directory(destination_handle):
             raise ValueError(f"Destination '{destination}' is not a directory.")
 
         try:
-            fs.copy_file(source, destination)
+            fs.copy_file(source_handle, destination_handle)
             return f"File '{source}' copied to '{destination}' successfully."
         except OSError as error:
             raise Exception(
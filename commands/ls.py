@@ -1,5 +1,4 @@
-import os
-from typing import TYPE_CHECKING, List
+from typing import TYPE_CHECKING, Iterator, List
 from structs.base_command import BaseCommand
 
 if TYPE_CHECKING:
@@ -14,8 +13,20 @@ class LsCommand(BaseCommand):
         {"name": "-l", "optional": True},
     ]
 
+    def run(self, args: List[str], fs: "FileSystemApi", printline):
+        if ">" in args or ">>" in args:
+            return super().run(args, fs, printline)
+
+        # Print every page as soon as it is read instead of building the whole
+        # listing first
+        self.validate_args(args)
+        for line in self.iter_lines(args, fs):
+            printline(line)
+
     def execute(self, args: List[str], fs: "FileSystemApi") -> str:
-        output = ""
+        return "\n".join(self.iter_lines(args, fs))
+
+    def iter_lines(self, args: List[str], fs: "FileSystemApi") -> Iterator[str]:
         path = "."
 
         if len(args) > 0 and not args[0].startswith("-"):
@@ -23,25 +34,20 @@ class LsCommand(BaseCommand):
 
         use_long_format = "-l" in args
 
-        if fs.is_directory(path):
-            contents = fs.list_directory_contents(path)
+        handle = fs.lookup(path)
+        if not fs.is_directory(handle):
+            yield f"{path} is not a directory."
+            return
+
+        for metadata in fs.iter_directory(handle):
+            item = metadata.file_name
             if use_long_format:
-                for item in contents:
-                    metadata = fs.get_file_metadata(os.path.join(path, item))
-                    if fs.is_directory(os.path.join(path, item)):
-                        output += f"\033[94m{item}\033[0m {metadata.file_size} {metadata.modification_date} {metadata.is_directory}\n"
-                    else:
-                        output += f"{item} {metadata.file_size} {metadata.modification_date} {metadata.is_directory}\n"
+                if metadata.is_directory:
+                    yield f"\033[94m{item}\033[0m {metadata.file_size} {metadata.modification_date} {metadata.is_directory}"
+                else:
+                    yield f"{item} {metadata.file_size} {metadata.modification_date} {metadata.is_directory}"
             else:
-                for item in contents:
-                    if fs.is_directory(os.path.join(path, item)):
-                        output += f"\033[94m{item}\033[0m\n"
-                    else:
-                        output += f"{item}\n"
-        else:
-            output += f"{path} is not a directory."
-
-        if output and output[-1] == "\n":
-            output = output[:-1]
-
-        return output
+                if metadata.is_directory:
+                    yield f"\033[94m{item}\033[0m"
+                else:
+                    yield f"{item}"
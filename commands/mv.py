@@ -16,15 +16,21 @@ class MvCommand(BaseCommand):
     def execute(self, args: List[str], fs: "FileSystemApi") -> None:
         input_path = args[0]
         target_path = args[1]
-        if not fs.exists(input_path):
+        try:
+            input_handle = fs.lookup(input_path)
+        except FileNotFoundError:
             raise ValueError(f"Error: file or directory '{input_path}' does not exist.")
 
-        if fs.is_directory(input_path) and fs.is_directory(target_path):
-            fs.move_directory(input_path, target_path)
-            return "Moved directory successfully."
+        try:
+            target_handle = fs.lookup(target_path)
+        except FileNotFoundError:
+            return "Error: Invalid arguments."
+        if not fs.is_directory(target_handle):
+            return "Error: Invalid arguments."
 
-        elif not fs.is_directory(input_path) and fs.is_directory(target_path):
-            fs.move_file(input_path, target_path)
-            return "Moved file successfully."
+        if fs.is_directory(input_handle):
+            fs.move_directory(input_handle, target_handle)
+            return "Moved directory successfully."
 
-        return "Error: Invalid arguments."
+        fs.move_file(input_handle, target_handle)
+        return "Moved file successfully."
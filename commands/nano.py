@@ -1,3 +1,4 @@
+import os
 import sys
 from cmd import Cmd
 
@@ -9,7 +10,8 @@ class NanoEditor(Cmd):
         super().__init__()
         self.file_system_api = file_system_api
         self.file_path = file_path
-        self.data = self.file_system_api.read_file(file_path).decode().splitlines()
+        self.saved_data = self.file_system_api.read_file(file_path)
+        self.data = self.saved_data.decode().splitlines()
         self.current_line = 0
         self.prompt = f"{file_path}> "
         self.intro = "".join(
@@ -78,7 +80,14 @@ class NanoEditor(Cmd):
             print("Please provide a keyword to search.")
 
     def do_save(self, arg):
-        self.file_system_api.edit_file(self.file_path, "\n".join(self.data).encode())
+        # Only rewrite from the first changed byte, zeroing a leftover tail
+        new_data = "\n".join(self.data).encode()
+        unchanged = len(os.path.commonprefix([self.saved_data, new_data]))
+        padding = bytes(max(0, len(self.saved_data) - len(new_data)))
+        self.file_system_api.pwrite(
+            self.file_path, unchanged, new_data[unchanged:] + padding
+        )
+        self.saved_data = new_data
         print("File saved successfully.")
 
     def do_exit(self, arg):
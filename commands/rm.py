@@ -12,10 +12,13 @@ class RmCommand(BaseCommand):
 
     def execute(self, args: List[str], fs: "FileSystemApi") -> str:
         path = args[0]
-        if not fs.is_directory(path):
-            fs.delete_file(path)
-        elif fs.is_directory(path):
-            fs.delete_directory(path)
-        else:
+        try:
+            handle = fs.lookup(path)
+        except FileNotFoundError:
             raise FileNotFoundError(f"{path} not found")
+
+        if fs.is_directory(handle):
+            fs.delete_directory(handle)
+        else:
+            fs.delete_file(handle)
         return ""
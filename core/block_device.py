@@ -0,0 +1,152 @@
+"""
+Module containing the BlockDevice class, positional access to a volume image
+through its file descriptor.
+"""
+
+import os
+import threading
+from typing import Sequence, Union
+
+Buffer = Union[bytes, bytearray, memoryview]
+
+
+class BlockDevice:
+    """
+    Wraps the descriptor of an image and reads and writes it with os.pread and
+    os.pwrite, or their vectored forms, so every access is a single syscall that
+    carries its own offset. Nothing shares a file position, so any number of
+    threads can use one device at once.
+
+    Platforms without pread fall back to lseek followed by read or write under
+    a lock, and the vectored calls fall back to one call per buffer.
+    """
+
+    HAS_PREAD = hasattr(os, "pread")
+    HAS_PREADV = hasattr(os, "preadv")
+    # The most buffers a single vectored call accepts
+    IOV_MAX = (
+        os.sysconf("SC_IOV_MAX")
+        if "SC_IOV_MAX" in getattr(os, "sysconf_names", {})
+        else 16
+    )
+
+    def __init__(self, path: str, synchronous: bool = True) -> None:
+        """
+        :param path: The path of the image.
+        :param synchronous: Whether writes wait for the disk (O_SYNC).
+        """
+        flags = os.O_RDWR
+        if os.name == "nt":
+            flags |= os.O_BINARY
+        elif synchronous:
+            flags |= os.O_SYNC  # pylint: disable=no-member
+
+        self.path = path
+        self.fd = os.open(path, flags)
+        self.closed = False
+        self._seek_lock = threading.Lock()
+
+    def fileno(self) -> int:
+        return self.fd
+
+    def read_at(self, offset: int, size: int) -> bytes:
+        """Reads size bytes at offset, fewer at the end of the image."""
+        data = self._pread(size, offset)
+        if len(data) == size or not data:
+            return data
+
+        # Short reads only happen at the end of the image or on interruption
+        chunks = [data]
+        read = len(data)
+        while read < size:
+            chunk = self._pread(size - read, offset + read)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            read += len(chunk)
+        return b"".join(chunks)
+
+    def readinto_at(self, offset: int, buffer: memoryview) -> int:
+        """Fills buffer with the bytes at offset and returns how many were read."""
+        return self.readv_at(offset, [buffer])
+
+    def readv_at(self, offset: int, buffers: Sequence[memoryview]) -> int:
+        """
+        Fills the buffers one after the other with the bytes starting at offset.
+
+        :return: The number of bytes read, which is short at the end of the image.
+        """
+        if not self.HAS_PREADV:
+            read = 0
+            for buffer in buffers:
+                data = self.read_at(offset + read, len(buffer))
+                buffer[: len(data)] = data
+                read += len(data)
+                if len(data) < len(buffer):
+                    break
+            return read
+
+        read = 0
+        for start in range(0, len(buffers), self.IOV_MAX):
+            group = buffers[start : start + self.IOV_MAX]
+            size = sum(len(buffer) for buffer in group)
+            group_read = os.preadv(self.fd, group, offset + read)
+            read += group_read
+            if group_read < size:
+                break
+        return read
+
+    def write_at(self, offset: int, data: Buffer) -> int:
+        """Writes all of data at offset and returns its length."""
+        view = memoryview(data).cast("B")
+        written = 0
+        while written < len(view):
+            written += self._pwrite(view[written:], offset + written)
+        return written
+
+    def writev_at(self, offset: int, buffers: Sequence[Buffer]) -> int:
+        """
+        Writes the buffers back to back starting at offset, with one syscall for
+        every IOV_MAX buffers.
+
+        :return: The number of bytes written.
+        """
+        if not self.HAS_PREADV:
+            written = 0
+            for buffer in buffers:
+                written += self.write_at(offset + written, buffer)
+            return written
+
+        written = 0
+        for start in range(0, len(buffers), self.IOV_MAX):
+            group = buffers[start : start + self.IOV_MAX]
+            size = sum(len(buffer) for buffer in group)
+            group_written = os.pwritev(self.fd, group, offset + written)
+            if group_written < size:
+                # Rare partial write, the rest goes out as one buffer
+                rest = memoryview(b"".join(group))[group_written:]
+                self.write_at(offset + written + group_written, rest)
+            written += size
+        return written
+
+    def sync(self) -> None:
+        os.fsync(self.fd)
+
+    def close(self) -> None:
+        if not self.closed:
+            os.close(self.fd)
+            self.closed = True
+
+    def _pread(self, size: int, offset: int) -> bytes:
+        if self.HAS_PREAD:
+            return os.pread(self.fd, size, offset)
+        with self._seek_lock:
+            os.lseek(self.fd, offset, os.SEEK_SET)
+            return os.read(self.fd, size)
+
+    def _pwrite(self, data: memoryview, offset: int) -> int:
+        if self.HAS_PREAD:
+            return os.pwrite(self.fd, data, offset)
+        with self._seek_lock:
+            os.lseek(self.fd, offset, os.SEEK_SET)
+            return os.write(self.fd, data)
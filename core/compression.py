@@ -0,0 +1,227 @@
+"""
+Module containing the Compressor class, which stores file data as chunks that
+are compressed independently with zlib or lzma, so any range of a file can be
+read back by decoding only the chunks it covers.
+"""
+
+import lzma
+import math
+import struct
+import time
+import zlib
+from typing import Dict, List, Optional, Tuple
+
+CODECS = ("zlib", "lzma")
+
+
+class CompressedLayout:
+    """
+    The start of a compressed file's extent: a header with the codec, the chunk
+    size, the length of the data and the number of chunks, followed by the end
+    of every compressed chunk relative to the first one. The chunks follow the
+    table back to back.
+    """
+
+    HEADER = struct.Struct(">BIQI")
+
+    def __init__(
+        self, codec: str, chunk_size: int, length: int, ends: List[int]
+    ) -> None:
+        self.codec = codec
+        self.chunk_size = chunk_size
+        self.length = length
+        self.ends = ends
+        # The last decoded chunk, sequential reads mostly need it again
+        self.last_chunk: Tuple[int, bytes] = (-1, b"")
+
+    @property
+    def data_start(self) -> int:
+        return self.HEADER.size + 4 * len(self.ends)
+
+    @property
+    def stored_size(self) -> int:
+        return self.data_start + (self.ends[-1] if self.ends else 0)
+
+    def chunk_span(self, first: int, last: int) -> Tuple[int, int]:
+        """Returns where chunks first to last start and end in the extent."""
+        start = self.ends[first - 1] if first else 0
+        return self.data_start + start, self.data_start + self.ends[last]
+
+    def to_bytes(self) -> bytes:
+        return self.HEADER.pack(
+            CODECS.index(self.codec), self.chunk_size, self.length, len(self.ends)
+        ) + struct.pack(f">{len(self.ends)}I", *self.ends)
+
+    @classmethod
+    def size_of(cls, head: bytes) -> int:
+        """Returns the size of the header and table that start with head."""
+        *_, count = cls.HEADER.unpack_from(head)
+        return cls.HEADER.size + 4 * count
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "CompressedLayout":
+        codec, chunk_size, length, count = cls.HEADER.unpack_from(data)
+        ends = list(struct.unpack_from(f">{count}I", data, cls.HEADER.size))
+        return cls(CODECS[codec], chunk_size, length, ends)
+
+
+class Compressor:
+    """
+    Compresses file data for storage and decodes it again, keeping totals for
+    reports. Data is only stored compressed when that saves at least
+    MIN_SAVINGS of its blocks, and the first chunk is tried on its own first so
+    data that does not compress is given up on early.
+
+    Attributes:
+        bytes_in (int): The size of all data given to compress.
+        bytes_stored (int): What was stored for it, compressed or not.
+        files_compressed (int): Files stored compressed.
+        files_skipped (int): Files stored as they are because it did not pay off.
+        compress_time (float): Seconds spent compressing.
+        bytes_decoded (int): The size of all decompressed chunks.
+        decompress_time (float): Seconds spent decompressing.
+    """
+
+    CHUNK_SIZE = 64 * 1024
+    MIN_SAVINGS = 0.125
+
+    def __init__(self, codec: str = "zlib", chunk_size: int = CHUNK_SIZE) -> None:
+        if codec not in CODECS:
+            raise ValueError(f"Unsupported compression codec: {codec}")
+
+        self.codec = codec
+        self.chunk_size = chunk_size
+
+        self.bytes_in = 0
+        self.bytes_stored = 0
+        self.files_compressed = 0
+        self.files_skipped = 0
+        self.compress_time = 0.0
+        self.bytes_decoded = 0
+        self.decompress_time = 0.0
+
+    def compress(self, data: bytes, block_size: int) -> Optional[bytes]:
+        """
+        Encodes data as the contents of a compressed extent.
+
+        :param data: The data of the file.
+        :param block_size: The block size of the volume, savings are counted in
+            whole blocks.
+        :return: The extent, or None when compression does not pay off.
+        """
+        start = time.perf_counter()
+        chunks: List[bytes] = []
+        stored = CompressedLayout.HEADER.size
+        # A single block can not get any smaller
+        gave_up = math.ceil(len(data) / block_size) < 2
+        offset = 0
+        while not gave_up and offset < len(data):
+            chunk = data[offset : offset + self.chunk_size]
+            chunks.append(self._compress_chunk(chunk))
+            stored += 4 + len(chunks[-1])
+            if offset == 0 and not self.first_chunk_pays_off(chunk, chunks[0]):
+                gave_up = True
+            offset += self.chunk_size
+
+        self.compress_time += time.perf_counter() - start
+        if gave_up or not self.pays_off(len(data), stored, block_size):
+            self.count_file(len(data), None)
+            return None
+
+        ends = []
+        end = 0
+        for chunk in chunks:
+            end += len(chunk)
+            ends.append(end)
+        layout = CompressedLayout(self.codec, self.chunk_size, len(data), ends)
+        self.count_file(len(data), stored)
+        return layout.to_bytes() + b"".join(chunks)
+
+    def pays_off(self, length: int, stored: int, block_size: int) -> bool:
+        """
+        Tells whether storing length bytes of data as stored bytes saves enough
+        blocks to be worth it.
+        """
+        raw_blocks = math.ceil(length / block_size)
+        max_size = raw_blocks * (1 - self.MIN_SAVINGS) * block_size
+        # A single block can not get any smaller
+        return raw_blocks >= 2 and stored <= max_size
+
+    def first_chunk_pays_off(self, chunk: bytes, compressed: bytes) -> bool:
+        """Tells whether the first chunk of a file compressed well enough to go on."""
+        return len(compressed) <= len(chunk) * (1 - self.MIN_SAVINGS)
+
+    def count_file(self, length: int, stored: Optional[int]) -> None:
+        """
+        Adds a file to the totals of the report.
+
+        :param length: The size of its data.
+        :param stored: The size of the compressed extent, None when the data was
+            stored as it is.
+        """
+        self.bytes_in += length
+        if stored is None:
+            self.files_skipped += 1
+            self.bytes_stored += length
+        else:
+            self.files_compressed += 1
+            self.bytes_stored += stored
+
+    def decompress(self, codec: str, data: bytes) -> bytes:
+        """Decodes one chunk."""
+        start = time.perf_counter()
+        if codec == "zlib":
+            chunk = zlib.decompress(data)
+        else:
+            chunk = lzma.decompress(data, format=lzma.FORMAT_ALONE)
+        self.decompress_time += time.perf_counter() - start
+        self.bytes_decoded += len(chunk)
+        return chunk
+
+    def report(self) -> Dict[str, float]:
+        """
+        Sums up the compression done so far.
+
+        :return: The number of files compressed and skipped, the ratio of the
+            data given to what was stored, and the throughput of compressing
+            and decompressing in MB/s of uncompressed data.
+        """
+        megabyte = 1024 * 1024
+        return {
+            "files_compressed": self.files_compressed,
+            "files_skipped": self.files_skipped,
+            "ratio": self.bytes_in / self.bytes_stored if self.bytes_stored else 1.0,
+            "compress_mb_s": (
+                self.bytes_in / megabyte / self.compress_time
+                if self.compress_time
+                else 0.0
+            ),
+            "decompress_mb_s": (
+                self.bytes_decoded / megabyte / self.decompress_time
+                if self.decompress_time
+                else 0.0
+            ),
+        }
+
+    def compress_chunks(self, codec: str, chunk_size: int, data: bytes) -> List[bytes]:
+        """
+        Compresses data as chunks of chunk_size with codec, to replace chunks of
+        a file stored with them, which can differ from those of the volume.
+
+        :param codec: The codec of the file.
+        :param chunk_size: The chunk size of the file.
+        :param data: The data of whole chunks, only the last can be shorter.
+        :return: The compressed chunks.
+        """
+        start = time.perf_counter()
+        chunks = [
+            self._compress_chunk(data[offset : offset + chunk_size], codec)
+            for offset in range(0, len(data), chunk_size)
+        ]
+        self.compress_time += time.perf_counter() - start
+        return chunks
+
+    def _compress_chunk(self, chunk: bytes, codec: Optional[str] = None) -> bytes:
+        if (codec or self.codec) == "zlib":
+            return zlib.compress(chunk, 6)
+        return lzma.compress(chunk, format=lzma.FORMAT_ALONE, preset=6)
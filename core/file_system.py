@@ -1,16 +1,27 @@
+import base64
+import dataclasses
+import errno
 import logging
 import math
 import os
+import struct
 import time
-from typing import List, Optional, Tuple, Union
+from typing import Callable, Dict, List, Optional, Tuple, Union
+from structs.file_handle import FileHandle
 from structs.file_index_node import FileIndexNode
 from structs.metadata import Metadata
-from utility import open_file_without_cache, reset_seek_to_zero
+from core.compression import CompressedLayout, Compressor
+from core.sparse import SparseLayout
+from core.storage_backend import StorageBackend, open_storage
 from managers.index_manager import IndexManager
-from managers.bitmap_manager import BitmapManager
+from managers.bitmap_manager import BitmapManager, SizeClassBitmap
 from managers.config_manager import ConfigManager
 from managers.metadata_manager import MetadataManager
 from managers.transaction_manager import TransactionManager
+from managers.sorted_directory_manager import SortedDirectoryManager
+from managers.block_cache import BlockCache
+from managers.dedup_manager import DedupManager
+from managers.dentry_cache import DentryCache
 
 # TODO: ensure no 2 file systems are open for the same file
 # TODO: ensure nothing can be done to the root directory
@@ -18,13 +29,26 @@ from managers.transaction_manager import TransactionManager
 
 class FileSystem:
     ROOT_DIR = "root"
+    DENTRY_CACHE_SIZE = 4096
+    COPY_CHUNK_SIZE = 1024 * 1024
+    # How much of a compressed extent is read to find its chunk table
+    LAYOUT_READ_SIZE = 4096
+    PAGE_SIZE = 256
 
     def __init__(
         self,
         file_system_name: str,
         user_id: str,
         specs: Optional[Metadata] = None,
+        durability: Optional[str] = None,
     ) -> None:
+        """
+        :param file_system_name: The path of the volume without extension.
+        :param user_id: The user the volume belongs to.
+        :param specs: The metadata of a new volume, read from disk when omitted.
+        :param durability: Overrides the durability mode of the volume for this
+            mount only.
+        """
         self.user_id = user_id
         self.logger = logging.getLogger(self.user_id)
 
@@ -37,40 +61,91 @@ class FileSystem:
 
         self.fs_path_name = f"{self.config_manager.file_system_path}"
 
-        if not os.path.exists(self.fs_path_name):
-            self.fs = open_file_without_cache(self.fs_path_name, "w+b")
-        else:
-            self.fs = open_file_without_cache(self.fs_path_name, "r+b")
-        if os.path.getsize(self.fs_path_name) == 0:
+        if (
+            not os.path.exists(self.fs_path_name)
+            or os.path.getsize(self.fs_path_name) == 0
+        ):
             self.reserve_file()
-
-        self.bitmap_manager = BitmapManager(
-            self.fs,
-            self.config_manager.num_blocks,
-            self.config_manager.block_size,
-            self.config_manager.bitmap_size,
+        self.durability = durability or self.config_manager.durability
+        self.storage = self._open_storage()
+        self.bitmap_manager = self._load_bitmaps()
+        self.index_manager = IndexManager(self.storage, self.config_manager)
+        self.transaction_manager = TransactionManager(on_commit=self.storage.sync)
+        self.compressor = Compressor(self.config_manager.compression)
+        self.dentry_cache = DentryCache(FileSystem.DENTRY_CACHE_SIZE)
+        self.sorted_directory_manager = (
+            SortedDirectoryManager(self)
+            if self.metedata_manager.metadata.sorted_directories
+            else None
         )
-        self.index_manager = IndexManager(self.fs, self.config_manager)
-        self.transaction_manager = TransactionManager()
 
         root = self.index_manager.find_file_by_name(FileSystem.ROOT_DIR)
         if not root:
-            root = FileIndexNode(FileSystem.ROOT_DIR, 0, 1, is_directory=True, id=0)
+            root = FileIndexNode(
+                FileSystem.ROOT_DIR,
+                0,
+                self.config_manager.directory_initial_blocks,
+                is_directory=True,
+                id=0,
+            )
             root.id = 0  # id of the root directory is 0
             root.calculate_file_size(self.config_manager.block_size)
 
-            self.bitmap_manager.mark_used(0)
+            self.bitmap_manager.mark_range(0, root.file_blocks)
             self.index_manager.write_to_index(root)
 
+        self.dedup_manager = DedupManager(self)
+
         self.logger.info(f"FileSystem initialized: {self.user_id}")
 
+    def _open_storage(self) -> StorageBackend:
+        storage = open_storage(
+            self.fs_path_name, self.config_manager.storage_backend, self.durability
+        )
+        # A mapped image is already served from memory
+        if (
+            self.config_manager.block_cache_size
+            and self.config_manager.storage_backend == "file"
+        ):
+            storage = BlockCache(storage, self.config_manager.block_cache_size)
+        return storage
+
+    def _load_bitmaps(self) -> Union[BitmapManager, SizeClassBitmap]:
+        bitmap_manager = BitmapManager(
+            self.storage,
+            self.config_manager.small_num_blocks,
+            self.config_manager.block_size,
+            self.config_manager.small_bitmap_size,
+            offset=self.config_manager.bitmap_offset,
+        )
+        if not self.config_manager.large_num_blocks:
+            return bitmap_manager
+        return SizeClassBitmap(
+            bitmap_manager,
+            BitmapManager(
+                self.storage,
+                self.config_manager.large_num_blocks,
+                self.config_manager.large_block_size,
+                self.config_manager.large_bitmap_size,
+                offset=self.config_manager.bitmap_offset
+                + self.config_manager.small_bitmap_size,
+                first_block=self.config_manager.small_num_blocks,
+                blocks_per_bit=self.config_manager.blocks_per_large_block,
+            ),
+            self.config_manager.large_file_threshold // self.config_manager.block_size,
+        )
+
     def __del__(self):
         self.shut_down()
 
     def shut_down(self):
+        # The storage is missing when the volume failed to open
+        storage = getattr(self, "storage", None)
+        if storage is None or storage.closed:
+            return
         self.logger.info("FileSystem shutting down...")
-        self.fs.flush()
-        self.fs.close()
+        self.storage.sync()
+        self.storage.close()
 
     """
     Utility Functions.
@@ -80,16 +155,60 @@ class FileSystem:
         return self.resolve_path(file_path).is_directory
 
     def exists(self, file_path: str) -> bool:
-        try:
-            self.resolve_path(file_path)
-            return True
-        except:
-            return False
+        return self.lookup_path(self.split_path(file_path)) is not None
 
     def update_file_access_time(self, file_path: str) -> None:
         file_node = self.resolve_path(file_path)
         self.index_manager.write_to_index(file_node)
 
+    @staticmethod
+    def split_path(path: str) -> Tuple[str, ...]:
+        """
+        Normalizes a path into its components, which is also the key used by the
+        dentry cache. Every path is taken from the root and `..` is applied
+        lexically.
+
+        :param path: The path to split.
+        :return: The names leading from the root to the target.
+        """
+        directories = [d for d in path.split("/") if d not in ("", ".")]
+        if directories and directories[0] == FileSystem.ROOT_DIR:
+            # Skip root directory marker if it's the first component
+            directories = directories[1:]
+
+        components = []
+        for directory in directories:
+            if directory == "..":
+                if components:
+                    components.pop()
+                continue
+            components.append(directory)
+
+        return tuple(components)
+
+    def lookup_path(self, components: Tuple[str, ...]) -> Optional[FileIndexNode]:
+        """
+        Finds the node at the given path components, walking only the part of the
+        path that is not in the dentry cache yet.
+
+        :param components: The components returned by split_path.
+        :return: The node, or None if the path does not exist.
+        """
+        if not components:
+            return self.index_manager.index[0]
+
+        try:
+            file_id = self.dentry_cache.get(components)
+        except KeyError:
+            parent_node = self.lookup_path(components[:-1])
+            child = (
+                self.find_child(parent_node, components[-1]) if parent_node else None
+            )
+            self.dentry_cache.put(components, child.id if child else None)
+            return child
+
+        return None if file_id is None else self.index_manager.index[file_id]
+
     def resolve_path(
         self, path: str, return_parent: bool = False
     ) -> Union[FileIndexNode, Tuple[FileIndexNode, FileIndexNode]]:
@@ -100,86 +219,158 @@ class FileSystem:
         :param return_parent: If True, return both the parent and the target node.
         :return: The resolved FileIndexNode, or a tuple of (parent_node, target_node) if return_parent is True.
         """
-        # Normalize and split the path into components
-        directories = [d for d in path.split("/") if d not in ("", ".")]
+        components = self.split_path(path)
+        node = self.lookup_path(components)
+        if node is None:
+            raise FileNotFoundError(f"File or directory '{path}' not found.")
 
-        # Start from the root or current directory based on the path
-        current_id = 0 if path.startswith("/") else self.index_manager.index[0].id
-        parent_id = 0 if path.startswith("/") else self.index_manager.index[0].id
+        if return_parent:
+            return self.lookup_path(components[:-1]), node
 
-        # Handle edge case for root path
-        if not directories:  # Path is `/` or equivalent
-            root_node = self.index_manager.index[current_id]
-            return (root_node, root_node) if return_parent else root_node
+        return node
 
-        for i, directory in enumerate(directories):
-            if directory == "..":
-                # Move to the parent directory
-                parent_id = current_id
-                parent_dir = self.index_manager.index[current_id]
-                current_id = parent_dir.id
-                continue
+    def lookup(self, path: str) -> FileHandle:
+        """
+        Resolves a path once and returns a handle that the other operations
+        accept in place of the path.
 
-            if i == 0 and directory == FileSystem.ROOT_DIR:
-                # Skip root directory marker if it's the first component
-                continue
+        :param path: The path to resolve.
+        :return: A handle to the node.
+        """
+        components = self.split_path(path)
+        node = self.lookup_path(components)
+        if node is None:
+            raise FileNotFoundError(f"File or directory '{path}' not found.")
+
+        return FileHandle(node.id, node.generation, "/" + "/".join(components))
 
-            # Check if it's the last component
-            is_last_component = i == len(directories) - 1
+    def get_node(self, target: Union[str, FileHandle, FileIndexNode]) -> FileIndexNode:
+        """
+        Returns the node behind a path, a handle or a node.
 
-            # Traverse to the child directory or file
-            for child in self.index_manager.index[current_id].load_children(self):
-                if child.file_name == directory:
-                    # Update parent and current IDs
-                    parent_id = current_id
-                    current_id = child.id
+        :param target: The path, handle or node.
+        :return: The node.
+        """
+        if isinstance(target, FileIndexNode):
+            return target
+        if isinstance(target, FileHandle):
+            node = self.index_manager.find_file_by_id(target.file_id)
+            if node is None or node.generation != target.generation:
+                raise FileNotFoundError(
+                    f"File or directory '{target.path}' no longer exists."
+                )
+            return node
+        if isinstance(target, str):
+            return self.resolve_path(target)
 
-                    # If it's the last component and not a directory, stop traversal
-                    if is_last_component and not child.is_directory:
-                        if return_parent:
-                            return self.index_manager.index[parent_id], child
-                        return child
+        raise ValueError("Target must be a str, FileHandle or FileIndexNode")
 
-                    break
-            else:
-                raise FileNotFoundError(f"File or directory '{directory}' not found.")
+    def get_path(self, target: Union[str, FileHandle]) -> str:
+        """
+        Returns the path of a path or handle. The path of a handle is only
+        trusted while it still leads to the same node.
 
-        # Handle return_parent for directories
-        if return_parent:
-            return (
-                self.index_manager.index[parent_id],
-                self.index_manager.index[current_id],
+        :param target: The path or handle.
+        :return: The path.
+        """
+        if not isinstance(target, FileHandle):
+            return target
+
+        node = self.get_node(target)
+        if self.lookup_path(self.split_path(target.path)) is not node:
+            raise FileNotFoundError(
+                f"File or directory '{target.path}' no longer exists."
             )
+        return target.path
 
-        return self.index_manager.index[current_id]
+    def invalidate_path(self, path: str, subtree: bool = False) -> None:
+        """
+        Drops the cached resolution of a path after it was created, removed or
+        renamed.
+
+        :param path: The path that changed.
+        :param subtree: Also drop every cached path below it.
+        """
+        if subtree:
+            self.dentry_cache.invalidate_tree(self.split_path(path))
+        else:
+            self.dentry_cache.invalidate(self.split_path(path))
+
+    def find_child(
+        self, dir_node: FileIndexNode, file_name: str
+    ) -> Optional[FileIndexNode]:
+        """
+        Finds a direct child of a directory by name.
+
+        :param dir_node: The directory to search in.
+        :param file_name: The name of the child.
+        :return: The child node, or None if the directory has no such child.
+        """
+        if not dir_node.is_directory:
+            return None
+
+        if self.sorted_directory_manager:
+            return self.sorted_directory_manager.find_child(dir_node, file_name)
+
+        return next(
+            (
+                child
+                for child in dir_node.load_children(self)
+                if child.file_name == file_name
+            ),
+            None,
+        )
 
     """
     File Operations.
     """
 
-    def create_file(self, file_dir: str, file_data: bytes):
+    def create_file(
+        self, file_dir: str, file_data: bytes, compress: Optional[bool] = None
+    ):
         directories = [d for d in file_dir.split("/") if d not in ("", ".")]
         parent_node = self.resolve_path("/".join(directories[:-1]))
         # parent_node = self.get_file_by_name(parent_dir)
         if not parent_node.is_directory:
             raise Exception("Parent directory does not exist or is not a directory.")
 
+        # Files follow the compression default of their directory
+        if compress is None:
+            compress = parent_node.is_compressed
+        compressed_data = self.compress_data(file_data) if compress else None
+        if compressed_data is not None:
+            file_data = compressed_data
+        # Data that is not compressed leaves out its holes instead
+        sparse_data = self.sparse_data(file_data) if compressed_data is None else None
+        if sparse_data is not None:
+            file_data = sparse_data
+
         num_blocks_needed = math.ceil(len(file_data) / self.config_manager.block_size)
 
         num_blocks_needed = max(num_blocks_needed, 1)
-        free_blocks = self.bitmap_manager.find_free_space_bitmap(num_blocks_needed)
-        file_start_block_index = free_blocks[0]
+        padded_data = file_data.ljust(
+            num_blocks_needed * self.config_manager.block_size, b"\0"
+        )
+
+        # With inline deduplication data that is already stored is shared
+        digest = None
+        if self.config_manager.dedup:
+            flags = self.dedup_manager.extent_flags(
+                compressed_data is not None, sparse_data is not None, num_blocks_needed
+            )
+            digest = self.dedup_manager.digest(padded_data, flags)
+            match = self.dedup_manager.find(digest, padded_data, flags)
+            if match:
+                self.link_clone(file_dir, match)
+                return
+
+        file_start_block_index = self.bitmap_manager.find_free_space_bitmap(
+            num_blocks_needed
+        )[0]
 
         # TODO: later on we will make use of path so for parent_dir it will take a path and we will check files or folders in it to see if name exists or not
         # Check if the file exists
-        existing_file = next(
-            (
-                child
-                for child in parent_node.load_children(self)
-                if child.file_name == directories[-1]
-            ),
-            None,
-        )
+        existing_file = self.find_child(parent_node, directories[-1])
 
         if existing_file:
             raise Exception("File already exists.")
@@ -199,15 +390,11 @@ class FileSystem:
         #     current_offset += len(block_data)
 
         start_position = (
-            self.config_manager.bitmap_size
-            + self.config_manager.file_index_size
+            self.config_manager.data_start
             + file_start_block_index * self.config_manager.block_size
         )
 
-        self.fs.seek(start_position)
-        self.fs.write(
-            file_data.ljust(num_blocks_needed * self.config_manager.block_size, b"\0")
-        )
+        self.storage.write_at(start_position, padded_data)
 
         self.logger.info(
             f"Wrote {len(file_data)} bytes to start block {file_start_block_index}"
@@ -215,10 +402,10 @@ class FileSystem:
 
         # Update bitmap to reflect that these blocks are now used
         self.transaction_manager.add_operation(
-            self.bitmap_manager.mark_blocks,
-            rollback_func=self.bitmap_manager.free_blocks,
-            func_args=[free_blocks],
-            rollback_args=[free_blocks],
+            self.bitmap_manager.mark_range,
+            rollback_func=self.bitmap_manager.free_range,
+            func_args=[file_start_block_index, num_blocks_needed],
+            rollback_args=[file_start_block_index, num_blocks_needed],
         )
 
         # Update the file index
@@ -227,6 +414,8 @@ class FileSystem:
             file_start_block=file_start_block_index,
             file_blocks=num_blocks_needed,
             id=self.metedata_manager.increment_id(),
+            is_compressed=compressed_data is not None,
+            is_sparse=sparse_data is not None,
         )
 
         # self.transaction_manager.add_operation(
@@ -258,79 +447,452 @@ class FileSystem:
         )
 
         self.transaction_manager.commit()
+        self.invalidate_path(file_dir)
+        if digest:
+            self.dedup_manager.register(digest, file_index_node)
 
-    # TODO: i need to centralize this shit i dont want some to work like this and some to work like that but oh well
-    def read_file(self, file_dir: Union[str, FileIndexNode]) -> bytes:
-        if isinstance(file_dir, str):
-            file_node = self.resolve_path(file_dir)
-        elif isinstance(file_dir, FileIndexNode):
-            file_node = file_dir
-        else:
-            raise ValueError("File dir must be a str or FileIndexNode")
-        self.fs.seek(
-            self.config_manager.bitmap_size
-            + self.config_manager.file_index_size
-            + file_node.file_start_block * self.config_manager.block_size
+    def link_file(
+        self, file_dir: str, file_node: FileIndexNode, reserved: bool = False
+    ) -> None:
+        """
+        Adds a file whose blocks are already written and marked as used to its
+        parent directory and to the index.
+
+        :param file_dir: The path of the new file.
+        :param file_node: The node of the file, its name is taken from the path.
+        :param reserved: Whether the blocks are only reserved, they are then
+            marked as used in the same transaction.
+        """
+        directories = [d for d in file_dir.split("/") if d not in ("", ".")]
+        parent_node = self.resolve_path("/".join(directories[:-1]))
+        if not parent_node or not parent_node.is_directory:
+            raise Exception("Parent directory does not exist or is not a directory.")
+        if self.find_child(parent_node, directories[-1]):
+            raise Exception("File already exists.")
+
+        file_node.file_name = directories[-1]
+
+        if reserved:
+            self.transaction_manager.add_operation(
+                self.bitmap_manager.mark_range,
+                rollback_func=self.bitmap_manager.reserve_range,
+                func_args=[file_node.file_start_block, file_node.file_blocks],
+                rollback_args=[file_node.file_start_block, file_node.file_blocks],
+            )
+        self.transaction_manager.add_operation(
+            parent_node.add_child,
+            rollback_func=parent_node.remove_child,
+            func_args=[self, file_node],
+            rollback_args=[self, file_node.file_name],
+        )
+        self.transaction_manager.add_operation(
+            self.index_manager.write_to_index,
+            rollback_func=self.index_manager.delete_from_index,
+            func_args=[file_node],
+            rollback_args=[file_node],
+        )
+        self.transaction_manager.add_operation(
+            self.index_manager.write_to_index,
+            rollback_func=self.index_manager.delete_from_index,
+            func_args=[parent_node],
+            rollback_args=[parent_node],
         )
-        data = []
 
-        for i in range(file_node.file_blocks):
-            data.append(self.fs.read(self.config_manager.block_size))
+        self.transaction_manager.commit()
+        self.invalidate_path(file_dir)
 
-        return b"".join(data).rstrip(b"\x00")
+    def create_files(
+        self,
+        dir_path: str,
+        files: Dict[str, bytes],
+        compress: Optional[bool] = None,
+    ) -> None:
+        """
+        Creates many files in one directory in a single transaction. Names are
+        checked against one set of the existing children, space for every file is
+        found in one pass over the bitmap, file data is written with one write per
+        contiguous run, and the parent gets all child ids in one write.
+
+        :param dir_path: The directory to create the files in.
+        :param files: A mapping of file names to their data.
+        :param compress: Whether to compress the files, the default of the
+            directory when omitted.
+        """
+        parent_node = self.resolve_path(dir_path)
+        if not parent_node.is_directory:
+            raise Exception("Parent directory does not exist or is not a directory.")
 
-    def edit_file(self, file_dir: str, new_data: bytes):
+        existing_names = {child.file_name for child in parent_node.load_children(self)}
+        duplicates = existing_names.intersection(files)
+        if duplicates:
+            raise Exception(f"Files already exist: {', '.join(sorted(duplicates))}")
+
+        compressed_names = set()
+        if parent_node.is_compressed if compress is None else compress:
+            files = dict(files)
+            for name, data in files.items():
+                compressed_data = self.compress_data(data)
+                if compressed_data is not None:
+                    files[name] = compressed_data
+                    compressed_names.add(name)
+
+        # Files that are not compressed leave out their holes instead
+        sparse_files = {}
+        for name, data in files.items():
+            sparse_data = (
+                self.sparse_data(data) if name not in compressed_names else None
+            )
+            if sparse_data is not None:
+                sparse_files[name] = sparse_data
+        sparse_names = set(sparse_files)
+        if sparse_files:
+            files = {**files, **sparse_files}
+
+        block_size = self.config_manager.block_size
+        names = list(files)
+        padded_files = {
+            name: data.ljust(
+                max(math.ceil(len(data) / block_size), 1) * block_size, b"\0"
+            )
+            for name, data in files.items()
+        }
+
+        # With inline deduplication, files whose data is already stored, or is
+        # stored by an earlier file of the batch, share that extent
+        shared: Dict[str, Union[FileIndexNode, str]] = {}
+        digests: Dict[str, bytes] = {}
+        if self.config_manager.dedup:
+            shared, digests = self.dedup_manager.find_many(
+                {
+                    name: (
+                        padded_data,
+                        self.dedup_manager.extent_flags(
+                            name in compressed_names,
+                            name in sparse_names,
+                            len(padded_data) // block_size,
+                        ),
+                    )
+                    for name, padded_data in padded_files.items()
+                }
+            )
 
-        file_node = self.resolve_path(file_dir)
+        stored_names = [name for name in names if name not in shared]
+        start_blocks = self.bitmap_manager.find_free_space_for_files(
+            [len(padded_files[name]) // block_size for name in stored_names]
+        )
+        first_id = self.metedata_manager.reserve_ids(len(names))
+
+        start_by_name = dict(zip(stored_names, start_blocks))
+        for name, source in shared.items():
+            start_by_name[name] = (
+                start_by_name[source]
+                if isinstance(source, str)
+                else source.file_start_block
+            )
+        file_index_nodes = [
+            FileIndexNode(
+                file_name=name,
+                file_start_block=start_by_name[name],
+                file_blocks=len(padded_files[name]) // block_size,
+                id=first_id + i,
+                is_compressed=name in compressed_names,
+                is_sparse=name in sparse_names,
+            )
+            for i, name in enumerate(names)
+        ]
 
-        if not file_node:
-            raise FileNotFoundError("File does not exist.")
-        if file_node.is_directory:
-            raise ValueError("The specified path is a directory.")
+        # Files placed back to back form one run that is written in one go
+        runs = []
+        for node in file_index_nodes:
+            if node.file_name in shared:
+                continue
+            padded_data = padded_files[node.file_name]
+            if runs and runs[-1][0] + runs[-1][1] == node.file_start_block:
+                runs[-1][1] += node.file_blocks
+                runs[-1][2].append(padded_data)
+            else:
+                runs.append([node.file_start_block, node.file_blocks, [padded_data]])
 
-        new_data_blocks = math.ceil(len(new_data) / self.config_manager.block_size)
-        factor = math.ceil(new_data_blocks / file_node.file_blocks)
-        if factor >= 2:
-            # self.realign(file_node, factor)
+        for start_block, run_blocks, run_data in runs:
+            self.storage.writev_at(self.data_offset(start_block), run_data)
 
             self.transaction_manager.add_operation(
-                func=self.realign,
-                rollback_func=self.realign,
-                func_args=[file_node, factor],
-                rollback_args=[file_node, 1 / factor],
+                self.bitmap_manager.mark_range,
+                rollback_func=self.bitmap_manager.free_range,
+                func_args=[start_block, run_blocks],
+                rollback_args=[start_block, run_blocks],
             )
 
-        start_position = (
-            self.config_manager.bitmap_size
-            + self.config_manager.file_index_size
-            + file_node.file_start_block * self.config_manager.block_size
+        self.logger.info(
+            f"Wrote {len(names)} files in {len(runs)} runs to {dir_path}"
+        )
+
+        if shared:
+            shared_extents = [start_by_name[name] for name in shared]
+            self.transaction_manager.add_operation(
+                self.index_manager.share_extents,
+                rollback_func=self.index_manager.release_extents,
+                func_args=[shared_extents],
+                rollback_args=[shared_extents],
+            )
+
+        self.transaction_manager.add_operation(
+            parent_node.add_children,
+            rollback_func=parent_node.truncate_children,
+            func_args=[self, file_index_nodes],
+            rollback_args=[self, parent_node.children_count],
         )
+
         self.transaction_manager.add_operation(
-            func=self.fs.seek,
-            rollback_func=self.fs.seek,
-            func_args=[start_position],
-            rollback_args=[start_position],
+            self.index_manager.write_many_to_index,
+            rollback_func=self.index_manager.delete_many_from_index,
+            func_args=[file_index_nodes],
+            rollback_args=[file_index_nodes],
         )
 
         self.transaction_manager.add_operation(
-            func=self.fs.write,
-            rollback_func=self.fs.write,
-            func_args=[
-                new_data.ljust(new_data_blocks * self.config_manager.block_size, b"\0")
-            ],
-            rollback_args=[
-                b"".join(
-                    [
-                        self.fs.read(self.config_manager.block_size)
-                        for _ in range(file_node.file_blocks)
-                    ]
-                ).rstrip(b"\0")
-            ],
+            self.index_manager.write_to_index,
+            rollback_func=self.index_manager.delete_from_index,
+            func_args=[parent_node],
+            rollback_args=[parent_node],
+        )
+
+        self.transaction_manager.commit()
+
+        for name in names:
+            self.invalidate_path(f"{dir_path}/{name}")
+
+        if digests:
+            nodes_by_name = {node.file_name: node for node in file_index_nodes}
+            self.dedup_manager.register_many(
+                [(digest, nodes_by_name[name]) for name, digest in digests.items()]
+            )
+
+    # TODO: i need to centralize this shit i dont want some to work like this and some to work like that but oh well
+    def read_file(self, file_dir: Union[str, FileHandle, FileIndexNode]) -> bytes:
+        file_node = self.get_node(file_dir)
+        if file_node.is_compressed:
+            layout = self.load_layout(file_node)
+            return b"".join(self.read_chunks(file_node, 0, len(layout.ends) - 1))
+        if file_node.is_sparse:
+            return self.read_sparse(file_node)
+
+        data = self.storage.read_at(
+            self.data_offset(file_node.file_start_block),
+            file_node.file_blocks * self.config_manager.block_size,
+        )
+        return bytes(data).rstrip(b"\x00")
+
+    def get_file_length(self, file_node: FileIndexNode) -> int:
+        """
+        Returns the length of a file's data, which ends at its last non zero byte
+        just like the data returned by read_file. The first call reads the tail of
+        the extent, walking back in growing chunks until data is found, and the
+        result is cached on the node.
+
+        :param file_node: The node of the file.
+        :return: The length in bytes.
+        """
+        if file_node.data_length is not None:
+            return file_node.data_length
+        if file_node.is_compressed:
+            file_node.data_length = self.load_layout(file_node).length
+            return file_node.data_length
+        if file_node.is_sparse:
+            file_node.data_length = self.load_sparse_layout(file_node).length
+            return file_node.data_length
+
+        block_size = self.config_manager.block_size
+        chunk_blocks = 64
+        end_block = file_node.file_blocks
+        # Only the final length is stored, readers on other threads may use it
+        length = 0
+
+        while end_block > 0:
+            start_block = max(0, end_block - chunk_blocks)
+            chunk = self.storage.read_at(
+                self.data_offset(file_node.file_start_block + start_block),
+                (end_block - start_block) * block_size,
+            )
+            data_length = len(bytes(chunk).rstrip(b"\x00"))
+            if data_length:
+                length = start_block * block_size + data_length
+                break
+            end_block = start_block
+            chunk_blocks *= 2
+
+        file_node.data_length = length
+        return length
+
+    def read_into(
+        self, file_node: FileIndexNode, offset: int, buffer: memoryview
+    ) -> int:
+        """
+        Reads the extent of a file starting at offset straight into buffer,
+        without building intermediate bytes objects.
+
+        :param file_node: The node of the file.
+        :param offset: The byte offset in the file to read from.
+        :param buffer: The writable buffer to fill.
+        :return: The number of bytes read, which stops at the end of the extent,
+            or at the end of the data for a compressed or sparse file.
+        """
+        if file_node.is_compressed:
+            return self.read_compressed_into(file_node, offset, buffer)
+        if file_node.is_sparse:
+            return self.read_sparse_into(file_node, offset, buffer)
+
+        capacity = file_node.file_blocks * self.config_manager.block_size
+        size = max(0, min(len(buffer), capacity - offset))
+        if size == 0:
+            return 0
+
+        return self.storage.readinto_at(
+            self.data_offset(file_node.file_start_block) + offset, buffer[:size]
+        )
+
+    def write_at(self, file_node: FileIndexNode, offset: int, data: bytes) -> int:
+        """
+        Writes data into a file at offset, growing the file first when the data
+        goes past its last block.
+
+        :param file_node: The node of the file.
+        :param offset: The byte offset in the file to write at.
+        :param data: The data to write.
+        :return: The number of bytes written.
+        """
+        if not data:
+            return 0
+        if file_node.is_sparse:
+            return self.write_sparse_at(file_node, offset, data)
+
+        block_size = self.config_manager.block_size
+        required_blocks = math.ceil((offset + len(data)) / block_size)
+        if required_blocks > file_node.file_blocks:
+            self.grow_file(file_node, required_blocks)
+        elif self.index_manager.is_extent_shared(file_node.file_start_block):
+            self.unshare_extent(file_node)
+
+        self.storage.write_at(
+            self.data_offset(file_node.file_start_block) + offset, data
         )
 
+        end = offset + len(data)
+        if file_node.data_length is not None and end >= file_node.data_length:
+            # The write covers the old end, so the data now ends inside it, or
+            # somewhere before it if it only wrote zeros
+            data_length = len(data.rstrip(b"\0"))
+            file_node.data_length = offset + data_length if data_length else None
+        return len(data)
+
+    def pread(self, file_node: FileIndexNode, offset: int, length: int) -> bytes:
+        """
+        Reads up to length bytes of a file starting at offset, touching only the
+        blocks that hold them.
+
+        :param file_node: The node of the file.
+        :param offset: The byte offset to read from.
+        :param length: The maximum number of bytes to read.
+        :return: The data, shorter than length when the file ends first.
+        """
+        if file_node.is_directory:
+            raise ValueError("The specified path is a directory.")
+
+        length = max(0, min(length, self.get_file_length(file_node) - offset))
+        buffer = bytearray(length)
+        read = self.read_into(file_node, offset, memoryview(buffer))
+        return bytes(buffer[:read])
+
+    def pwrite(self, file_node: FileIndexNode, offset: int, data: bytes) -> int:
+        """
+        Writes data into a file at offset as one transaction. Only the blocks the
+        data covers are read for the rollback, and the file is grown first when
+        the data goes past its last block. A rolled back growth keeps the extra
+        zeroed blocks.
+
+        :param file_node: The node of the file.
+        :param offset: The byte offset to write at.
+        :param data: The data to write.
+        :return: The number of bytes written.
+        """
+        if file_node.is_directory:
+            raise ValueError("The specified path is a directory.")
+        if not data:
+            return 0
+        if file_node.is_compressed:
+            return self.pwrite_compressed(file_node, offset, data)
+        if file_node.is_sparse:
+            return self.pwrite_sparse(file_node, offset, data)
+
+        block_size = self.config_manager.block_size
+        required_blocks = math.ceil((offset + len(data)) / block_size)
+        if required_blocks > file_node.file_blocks:
+            self.transaction_manager.add_operation(
+                self.grow_file, func_args=[file_node, required_blocks]
+            )
+
+        first_block = offset // block_size
+        last_block = min(required_blocks, file_node.file_blocks)
+        undo_data = b""
+        if first_block < last_block:
+            undo_data = bytes(
+                self.storage.read_at(
+                    self.data_offset(file_node.file_start_block + first_block),
+                    (last_block - first_block) * block_size,
+                )
+            )
+
+        # Positions are computed when the operations run, after a relocation
+        self.transaction_manager.add_operation(
+            self.write_at,
+            rollback_func=self.write_at,
+            func_args=[file_node, offset, data],
+            rollback_args=[file_node, first_block * block_size, undo_data],
+        )
         self.transaction_manager.commit()
+        return len(data)
+
+    def append_file(self, file_dir: Union[str, FileHandle], data: bytes) -> int:
+        """
+        Appends data to the end of a file. Only the tail block and any new blocks
+        are written, and the file is extended in place when the blocks after it
+        are free.
+
+        :param file_dir: The path, handle or node of the file.
+        :param data: The data to append.
+        :return: The number of bytes appended.
+        """
+        file_node = self.get_node(file_dir)
+        if not file_node:
+            raise FileNotFoundError("File does not exist.")
+
+        return self.pwrite(file_node, self.get_file_length(file_node), data)
+
+    def edit_file(self, file_dir: Union[str, FileHandle], new_data: bytes):
+
+        file_node = self.get_node(file_dir)
 
-    def delete_file(self, file_dir: str) -> None:
+        if not file_node:
+            raise FileNotFoundError("File does not exist.")
+        if file_node.is_directory:
+            raise ValueError("The specified path is a directory.")
+        if (
+            file_node.is_compressed
+            or file_node.is_sparse
+            or SparseLayout.has_holes(new_data)
+        ):
+            # Rewriting the whole file compresses the new data as well, or
+            # leaves out its holes
+            self.store_file_data(file_node, new_data, file_node.is_compressed)
+            return
+
+        # Zero whatever is left of the old data past the new end
+        old_length = self.get_file_length(file_node)
+        padding = bytes(max(0, old_length - len(new_data)))
+        self.pwrite(file_node, 0, new_data + padding)
+
+    def delete_file(self, file_dir: Union[str, FileHandle]) -> None:
+        file_dir = self.get_path(file_dir)
         parent_node, file_node = self.resolve_path(file_dir, True)
 
         if not file_node:
@@ -338,12 +900,7 @@ class FileSystem:
         if file_node.is_directory:
             raise ValueError("Not a file")
 
-        self.transaction_manager.add_operation(
-            self.bitmap_manager.free_blocks,
-            rollback_func=self.bitmap_manager.mark_blocks,
-            func_args=[range(file_node.file_blocks), file_node.file_start_block],
-            rollback_args=[range(file_node.file_blocks), file_node.file_start_block],
-        )
+        self.add_release_extent(self.transaction_manager, file_node)
         self.transaction_manager.add_operation(
             parent_node.remove_child,
             rollback_func=parent_node.add_child,
@@ -365,30 +922,81 @@ class FileSystem:
         )
 
         self.transaction_manager.commit()
+        file_node.generation += 1
+        self.invalidate_path(file_dir)
 
-    def rename_file(self, old_dir: str, new_name: str) -> None:
-        file_node = self.resolve_path(old_dir)
+    def rename_file(self, old_dir: Union[str, FileHandle], new_name: str) -> None:
+        old_dir = self.get_path(old_dir)
+        parent_node, file_node = self.resolve_path(old_dir, True)
         if not file_node:
             raise FileNotFoundError(f"File '{old_dir}' not found.")
 
-        file_node.file_name = new_name
+        existing = self.find_child(parent_node, new_name)
+        if existing and existing.id != file_node.id:
+            raise FileExistsError(f"File '{new_name}' already exists.")
+
+        old_name = file_node.file_name
 
+        def rename() -> None:
+            parent_node.rename_child(self, old_name, new_name)
+            file_node.file_name = new_name
+
+        def undo() -> None:
+            parent_node.rename_child(self, new_name, old_name)
+            file_node.file_name = old_name
+            self.index_manager.write_to_index(file_node)
+
+        self.transaction_manager.add_operation(rename, rollback_func=undo)
         self.transaction_manager.add_operation(
-            self.index_manager.write_to_index,
-            rollback_func=self.index_manager.delete_from_index,
-            func_args=[file_node],
-            rollback_args=[file_node],
+            self.index_manager.write_to_index, func_args=[file_node]
         )
         self.transaction_manager.commit()
+        file_node.generation += 1
+
+        # Misses cached below the new path would hide what was renamed there
+        components = self.split_path(old_dir)
+        self.dentry_cache.invalidate_tree(components)
+        self.dentry_cache.invalidate_tree(components[:-1] + (new_name,))
+
+    def copy_file(self, old_dir: Union[str, FileHandle], new_dir: str) -> None:
+        """
+        Copies a file as a clone that shares the blocks of the original, so the
+        copy takes constant time and no space. Whichever of the two is written
+        first gets a private copy of the extent at that point.
 
-    def copy_file(self, old_dir: str, new_dir: str) -> None:
-        file_node = self.resolve_path(old_dir)
+        :param old_dir: The path, handle or node of the file to copy.
+        :param new_dir: The path of the copy.
+        """
+        file_node = self.get_node(old_dir)
         if not file_node:
             raise FileNotFoundError(f"File '{old_dir}' not found.")
+        if file_node.is_directory:
+            raise ValueError("The specified path is a directory.")
 
-        self.create_file(new_dir, self.read_file(old_dir))
+        self.link_clone(new_dir, file_node)
 
-    def move_file(self, old_dir: str, new_dir: str) -> None:
+    def link_clone(self, file_dir: str, file_node: FileIndexNode) -> None:
+        """
+        Adds a new file at file_dir that shares the extent of file_node.
+
+        :param file_dir: The path of the new file.
+        :param file_node: The file whose extent is shared.
+        """
+        clone = FileIndexNode(
+            file_name=file_node.file_name,
+            file_start_block=file_node.file_start_block,
+            file_blocks=file_node.file_blocks,
+            id=self.metedata_manager.increment_id(),
+            is_compressed=file_node.is_compressed,
+            is_sparse=file_node.is_sparse,
+        )
+        clone.data_length = file_node.data_length
+
+        self.link_file(file_dir, clone)
+        self.index_manager.share_extent(clone.file_start_block)
+
+    def move_file(self, old_dir: Union[str, FileHandle], new_dir: str) -> None:
+        old_dir = self.get_path(old_dir)
         parent_node, file_node = self.resolve_path(old_dir, True)
         target_node = self.resolve_path("/".join(new_dir.split("/")[:-1]) or "/")
         if not file_node:
@@ -400,7 +1008,7 @@ class FileSystem:
         if not target_node.is_directory:
             raise FileNotFoundError(f"{file_node} is not a directory.")
 
-        if file_node.file_name in target_node.load_children(self):
+        if self.find_child(target_node, file_node.file_name):
             raise Exception(
                 f"File '{file_node.file_name}' already exists in '{new_dir}'."
             )
@@ -416,7 +1024,7 @@ class FileSystem:
             target_node.add_child,
             rollback_func=target_node.remove_child,
             func_args=[self, file_node],
-            rollback_args=[self, file_node],
+            rollback_args=[self, file_node.file_name],
         )
 
         self.transaction_manager.add_operation(
@@ -434,9 +1042,13 @@ class FileSystem:
         )
 
         self.transaction_manager.commit()
+        file_node.generation += 1
 
-    def get_file_size(self, file_dir: str) -> int:
-        file_node = self.resolve_path(file_dir)
+        self.invalidate_path(old_dir, subtree=True)
+        self.invalidate_path(new_dir, subtree=True)
+
+    def get_file_size(self, file_dir: Union[str, FileHandle]) -> int:
+        file_node = self.get_node(file_dir)
         return file_node.file_blocks * self.config_manager.block_size
 
     """
@@ -449,40 +1061,34 @@ class FileSystem:
         parent_node = self.resolve_path("/".join(directories[:-1]) or "/")
         if not parent_node or not parent_node.is_directory:
             raise Exception("Parent directory does not exist or is not a directory.")
-        children = parent_node.load_children(self)
-        if any(child.file_name == directories[-1] for child in children):
+        if self.find_child(parent_node, directories[-1]):
             raise Exception("Directory already exists.")
 
-        free_block = self.bitmap_manager.find_free_space_bitmap(1)[0]
+        initial_blocks = self.config_manager.directory_initial_blocks
+        free_block = self.bitmap_manager.find_free_space_bitmap(initial_blocks)[0]
 
         new_dir_node = FileIndexNode(
             file_name=directories[-1],
             file_start_block=free_block,
-            file_blocks=1,
+            file_blocks=initial_blocks,
             is_directory=True,
             children_count=0,
             id=self.metedata_manager.increment_id(),
+            is_compressed=parent_node.is_compressed,
         )
 
         self.transaction_manager.add_operation(
-            self.bitmap_manager.mark_used,
-            rollback_func=self.bitmap_manager.free_block,
-            func_args=[free_block],
-            rollback_args=[free_block],
-        )
-
-        self.transaction_manager.add_operation(
-            self.clear_block_data,
-            rollback_func=None,
-            func_args=[free_block],
-            rollback_args=[],
+            self.bitmap_manager.mark_range,
+            rollback_func=self.bitmap_manager.free_range,
+            func_args=[free_block, initial_blocks],
+            rollback_args=[free_block, initial_blocks],
         )
 
         self.transaction_manager.add_operation(
             parent_node.add_child,
             rollback_func=parent_node.remove_child,
             func_args=[self, new_dir_node],
-            rollback_args=[self, new_dir_node],
+            rollback_args=[self, new_dir_node.file_name],
         )
 
         self.transaction_manager.add_operation(
@@ -499,22 +1105,128 @@ class FileSystem:
             rollback_args=[parent_node],
         )
         self.transaction_manager.commit()
+        self.invalidate_path(dir_name)
+
+    def list_directory_contents(
+        self,
+        dir_name: Union[str, FileHandle],
+        start_after: Optional[str] = None,
+        limit: Optional[int] = None,
+    ) -> List[str]:
+        """
+        Lists the names in a directory, ordered by name when the volume keeps
+        sorted directories and in slot order otherwise.
+
+        :param dir_name: The directory to list.
+        :param start_after: Only return the names that come after this one.
+        :param limit: The maximum number of names to return.
+        :return: The names of the children.
+        """
+        return [
+            child.file_name
+            for child in self.scan_directory(dir_name, start_after, limit)
+        ]
 
-    def list_directory_contents(self, dir_name: str) -> List[str]:
+    def scan_directory(
+        self,
+        dir_name: Union[str, FileHandle],
+        start_after: Optional[str] = None,
+        limit: Optional[int] = None,
+    ) -> List[FileIndexNode]:
+        """
+        Returns the index nodes of the children of a directory in the same order
+        as list_directory_contents, reading the children area once.
+
+        :param dir_name: The directory to scan.
+        :param start_after: Only return the children that come after this name.
+            Without sorted_directories the children follow slot order, and a
+            name that is not in the directory has nothing after it.
+        :param limit: The maximum number of children to return.
+        :return: The nodes of the children.
+        """
         # dir_node = self.get_file_by_name(dir_name)
-        dir_node = self.resolve_path(dir_name)
+        dir_node = self.get_node(dir_name)
         if not dir_node or not dir_node.is_directory:
             raise Exception("Directory does not exist or is not a directory.")
 
+        if self.sorted_directory_manager:
+            return self.sorted_directory_manager.list_children(
+                dir_node, start_after, limit
+            )
+
         children = dir_node.load_children(self)
-        return [child.file_name for child in children]
+        start = 0
+        if start_after is not None:
+            names = [child.file_name for child in children]
+            if start_after not in names:
+                return []
+            start = names.index(start_after) + 1
+        end = len(children) if limit is None else start + limit
+        return children[start:end]
+
+    def list_page(
+        self,
+        dir_name: Union[str, FileHandle],
+        cursor: Optional[str] = None,
+        limit: int = PAGE_SIZE,
+    ) -> Tuple[List[FileIndexNode], Optional[str]]:
+        """
+        Returns one page of the children of a directory, reading only the part of
+        the children area the page covers.
+
+        Sorted volumes page in name order and the cursor remembers the last name,
+        so entries added or removed between calls are handled. Otherwise pages
+        follow slot order and a removal between calls can move an entry that was
+        not listed yet in front of the cursor.
+
+        :param dir_name: The directory to list.
+        :param cursor: The cursor returned with the previous page, None to start.
+        :param limit: The maximum number of children in the page.
+        :return: The nodes of the page and the cursor of the next page, None once
+            the directory is exhausted.
+        """
+        dir_node = self.get_node(dir_name)
+        if not dir_node or not dir_node.is_directory:
+            raise Exception("Directory does not exist or is not a directory.")
+        if limit <= 0:
+            raise ValueError("The page limit must be positive.")
+
+        position = self._decode_cursor(cursor) if cursor else None
 
-    def delete_directory(self, dir_path: str) -> None:
+        if self.sorted_directory_manager:
+            children = self.sorted_directory_manager.list_children(
+                dir_node, position, limit
+            )
+            if len(children) < limit:
+                return children, None
+            return children, self._encode_cursor(children[-1].file_name)
+
+        start = int(position) if position else 0
+        children = [
+            self.index_manager.index[child_id]
+            for child_id in dir_node.read_children_ids(self, start, limit)
+        ]
+        if start + len(children) >= dir_node.children_count:
+            return children, None
+        return children, self._encode_cursor(str(start + len(children)))
+
+    @staticmethod
+    def _encode_cursor(position: str) -> str:
+        return base64.urlsafe_b64encode(position.encode("utf-8")).decode("ascii")
+
+    @staticmethod
+    def _decode_cursor(cursor: str) -> str:
+        try:
+            return base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8")
+        except (ValueError, UnicodeError):
+            raise ValueError(f"Invalid cursor '{cursor}'.")
+
+    def delete_directory(self, dir_path: Union[str, FileHandle]) -> None:
 
         local_transcation_manager = TransactionManager()
+        dir_path = self.get_path(dir_path)
 
         parent_node, dir_node = self.resolve_path(dir_path, True)
-        children = dir_node.load_children(self)
 
         if not dir_node:
             raise ValueError("Directory doesn't exist")
@@ -522,67 +1234,82 @@ class FileSystem:
             raise ValueError("Not a directory")
 
         local_transcation_manager.add_operation(
-            self.bitmap_manager.free_blocks,
-            rollback_func=self.bitmap_manager.mark_blocks,
-            func_args=[range(dir_node.file_blocks), dir_node.file_start_block],
-            rollback_args=[range(dir_node.file_blocks), dir_node.file_start_block],
+            parent_node.remove_child,
+            rollback_func=parent_node.add_child,
+            func_args=[self, dir_node.file_name],
+            rollback_args=[self, dir_node],
         )
 
-        for child in children:
-            if child.is_directory:
-                local_transcation_manager.add_operation(
-                    self.delete_directory,
-                    rollback_func=None,
-                    func_args=[dir_path + "/" + child.file_name],
-                    rollback_args=[],
-                )
-                continue
+        deleted_directories = self.add_delete_tree(local_transcation_manager, dir_node)
 
-            local_transcation_manager.add_operation(
-                self.bitmap_manager.free_blocks,
-                rollback_func=self.bitmap_manager.mark_blocks,
-                func_args=[range(child.file_blocks), child.file_start_block],
-                rollback_args=[range(child.file_blocks), child.file_start_block],
-            )
+        local_transcation_manager.add_operation(
+            self.index_manager.write_to_index,
+            rollback_func=self.index_manager.delete_from_index,
+            func_args=[parent_node],
+            rollback_args=[parent_node],
+        )
 
-            local_transcation_manager.add_operation(
-                dir_node.remove_child,
-                rollback_func=dir_node.add_child,
-                func_args=[self, child.file_name],
-                rollback_args=[self, child],
-            )
+        local_transcation_manager.commit()
+        self.invalidate_path(dir_path, subtree=True)
 
-            local_transcation_manager.add_operation(
+        for deleted in deleted_directories:
+            deleted.generation += 1
+            if self.sorted_directory_manager:
+                self.sorted_directory_manager.forget(deleted.id)
+
+    def add_delete_tree(
+        self, transaction_manager: TransactionManager, dir_node: FileIndexNode
+    ) -> List[FileIndexNode]:
+        """
+        Adds the operations freeing a directory, everything below it and their
+        index entries to a transaction. Children are not unlinked one by one,
+        the children areas they are listed in are freed with their directories.
+
+        :param transaction_manager: The transaction to add the operations to.
+        :param dir_node: The directory to delete, already unlinked from its
+            parent.
+        :return: Every directory deleted, dir_node included.
+        """
+        deleted_directories = [dir_node]
+        transaction_manager.add_operation(
+            self.bitmap_manager.free_range,
+            rollback_func=self.bitmap_manager.mark_range,
+            func_args=[dir_node.file_start_block, dir_node.file_blocks],
+            rollback_args=[dir_node.file_start_block, dir_node.file_blocks],
+        )
+
+        for child in dir_node.load_children(self):
+            if child.is_directory:
+                deleted_directories += self.add_delete_tree(transaction_manager, child)
+                continue
+
+            self.add_release_extent(transaction_manager, child)
+            transaction_manager.add_operation(
                 self.index_manager.delete_from_index,
                 rollback_func=self.index_manager.write_to_index,
                 func_args=[child],
                 rollback_args=[child],
             )
 
-        local_transcation_manager.add_operation(
-            parent_node.remove_child,
-            rollback_func=parent_node.add_child,
-            func_args=[self, dir_node.file_name],
-            rollback_args=[self, dir_node],
-        )
-
-        local_transcation_manager.add_operation(
+        transaction_manager.add_operation(
             self.index_manager.delete_from_index,
             rollback_func=self.index_manager.write_to_index,
             func_args=[dir_node],
             rollback_args=[dir_node],
         )
-
-        local_transcation_manager.add_operation(
-            self.index_manager.write_to_index,
-            rollback_func=self.index_manager.delete_from_index,
-            func_args=[parent_node],
-            rollback_args=[parent_node],
-        )
-
-        local_transcation_manager.commit()
+        return deleted_directories
 
     def copy_directory(self, dir_path: str, new_dir_path: str) -> None:
+        """
+        Copies a directory tree in a single transaction. The source subtree is
+        walked once from the index, every copied directory is placed in one pass
+        over the bitmap with its child list already sized, and the child lists
+        are written with one write per run of neighbouring directories. Files are
+        copied as clones sharing the extents of the originals, like copy_file.
+
+        :param dir_path: The directory to copy.
+        :param new_dir_path: The path of the copy.
+        """
         dir_node = self.resolve_path(dir_path)
 
         if not dir_node:
@@ -591,18 +1318,118 @@ class FileSystem:
         if not dir_node.is_directory:
             raise ValueError("Not a directory")
 
-        children = dir_node.load_children(self)
+        directories = [d for d in new_dir_path.split("/") if d not in ("", ".")]
+        parent_node = self.resolve_path("/".join(directories[:-1]) or "/")
+        if not parent_node or not parent_node.is_directory:
+            raise Exception("Parent directory does not exist or is not a directory.")
+        if self.find_child(parent_node, directories[-1]):
+            raise Exception("Directory already exists.")
 
-        self.create_directory(new_dir_path)
-        for child in children:
-            if child.is_directory:
-                self.copy_directory(
-                    f"{dir_path}/{child.file_name}", f"{new_dir_path}/{child.file_name}"
-                )
-                continue
-            self.copy_file(
-                f"{dir_path}/{child.file_name}", f"{new_dir_path}/{child.file_name}"
+        # Breadth first, so the tree is read before anything is added to it even
+        # when the copy ends up inside the source
+        index = self.index_manager.index
+        sources = [dir_node]
+        children: List[List[int]] = []
+        for source in sources:
+            positions = []
+            if source.is_directory:
+                for child_id in source.read_children_ids(self):
+                    positions.append(len(sources))
+                    sources.append(index[child_id])
+            children.append(positions)
+
+        block_size = self.config_manager.block_size
+        initial_blocks = self.config_manager.directory_initial_blocks
+        directory_positions = [i for i, node in enumerate(sources) if node.is_directory]
+        blocks_per_directory = [
+            max(initial_blocks, 4 * len(children[i]) // block_size + 1)
+            for i in directory_positions
+        ]
+        start_blocks = self.bitmap_manager.find_free_space_for_files(
+            blocks_per_directory
+        )
+        first_id = self.metedata_manager.reserve_ids(len(sources))
+
+        clones = []
+        for i, source in enumerate(sources):
+            clone = FileIndexNode(
+                file_name=source.file_name,
+                file_start_block=source.file_start_block,
+                file_blocks=source.file_blocks,
+                id=first_id + i,
+                is_directory=source.is_directory,
+                children_count=len(children[i]),
+                is_compressed=source.is_compressed,
+                is_sparse=source.is_sparse,
+            )
+            clone.data_length = source.data_length
+            clones.append(clone)
+        clones[0].file_name = directories[-1]
+
+        runs = []
+        for i, start_block, blocks in zip(
+            directory_positions, start_blocks, blocks_per_directory
+        ):
+            clones[i].file_start_block = start_block
+            clones[i].file_blocks = blocks
+            child_ids = [first_id + position for position in children[i]]
+            padded_data = struct.pack(f">{len(child_ids)}I", *child_ids).ljust(
+                blocks * block_size, b"\0"
             )
+            if runs and runs[-1][0] + runs[-1][1] == start_block:
+                runs[-1][1] += blocks
+                runs[-1][2].append(padded_data)
+            else:
+                runs.append([start_block, blocks, [padded_data]])
+
+        for start_block, run_blocks, run_data in runs:
+            self.storage.writev_at(self.data_offset(start_block), run_data)
+
+            self.transaction_manager.add_operation(
+                self.bitmap_manager.mark_range,
+                rollback_func=self.bitmap_manager.free_range,
+                func_args=[start_block, run_blocks],
+                rollback_args=[start_block, run_blocks],
+            )
+
+        self.logger.info(
+            f"Cloned {len(sources)} entries of {dir_path} with "
+            f"{len(directory_positions)} directories in {len(runs)} runs"
+        )
+
+        shared_extents = [
+            clone.file_start_block for clone in clones if not clone.is_directory
+        ]
+        self.transaction_manager.add_operation(
+            self.index_manager.share_extents,
+            rollback_func=self.index_manager.release_extents,
+            func_args=[shared_extents],
+            rollback_args=[shared_extents],
+        )
+
+        self.transaction_manager.add_operation(
+            self.index_manager.write_many_to_index,
+            rollback_func=self.index_manager.delete_many_from_index,
+            func_args=[clones],
+            rollback_args=[clones],
+        )
+
+        self.transaction_manager.add_operation(
+            parent_node.add_child,
+            rollback_func=parent_node.remove_child,
+            func_args=[self, clones[0]],
+            rollback_args=[self, clones[0].file_name],
+        )
+
+        self.transaction_manager.add_operation(
+            self.index_manager.write_to_index,
+            rollback_func=self.index_manager.delete_from_index,
+            func_args=[parent_node],
+            rollback_args=[parent_node],
+        )
+
+        self.transaction_manager.commit()
+        self.invalidate_path(new_dir_path, subtree=True)
 
     def get_directory_size(self, dir_path: str) -> int:
         dir_node = self.resolve_path(dir_path)
@@ -626,35 +1453,743 @@ class FileSystem:
     Other Operations.
     """
 
-    # TODO: add a method which will also automically copy all the older blocks and expand
-    def realign(self, file_index: FileIndexNode, factor: Union[int, float] = 2) -> None:
-        if file_index.is_directory:
-            children = file_index.load_children(self)
-            self.bitmap_manager.free_blocks(
-                range(file_index.file_blocks), file_index.file_start_block
+    def grow_directory(self, dir_node: FileIndexNode, required_blocks: int) -> None:
+        """
+        Grows a directory so it spans at least required_blocks, following the
+        volume's growth policy. The directory is extended in place when the
+        blocks right after it are free, and relocated otherwise.
+
+        :param dir_node: The directory to grow.
+        :param required_blocks: The minimum number of blocks it needs.
+        """
+        new_blocks = math.ceil(
+            dir_node.file_blocks * self.config_manager.directory_growth_factor
+        )
+        new_blocks = min(
+            new_blocks,
+            dir_node.file_blocks + self.config_manager.directory_max_growth_blocks,
+        )
+        new_blocks = max(new_blocks, required_blocks, dir_node.file_blocks + 1)
+
+        directory_end = dir_node.file_start_block + dir_node.file_blocks
+        extra_blocks = new_blocks - dir_node.file_blocks
+        if self.bitmap_manager.is_range_free(directory_end, extra_blocks):
+            self.bitmap_manager.mark_range(directory_end, extra_blocks)
+            dir_node.file_blocks = new_blocks
+        else:
+            self._relocate_directory(dir_node, new_blocks)
+
+        self.index_manager.write_to_index(dir_node)
+
+    def grow_file(self, file_node: FileIndexNode, required_blocks: int) -> None:
+        """
+        Grows a file so it spans at least required_blocks, at least doubling it
+        like realign does. The file is extended in place when the blocks right
+        after it are free, and relocated otherwise. The new blocks are zeroed so
+        stale data of deleted files never shows up at the end of the file.
+
+        :param file_node: The file to grow.
+        :param required_blocks: The minimum number of blocks it needs.
+        """
+        self.grow_extent(
+            file_node, max(required_blocks, file_node.file_blocks * 2), True
+        )
+        self.index_manager.write_to_index(file_node)
+
+    def grow_extent(
+        self,
+        file_node: FileIndexNode,
+        new_blocks: int,
+        zero_fill: bool,
+        reserve: bool = False,
+    ) -> None:
+        """
+        Extends the extent of a node to new_blocks in place when possible and
+        moves it to a new run otherwise, copying the old blocks in bounded chunks.
+        The index entry is left to the caller. With reserve the new blocks are
+        only reserved, like the extent of a file that is still being written.
+        """
+        block_size = self.config_manager.block_size
+        extra_blocks = new_blocks - file_node.file_blocks
+        file_end = file_node.file_start_block + file_node.file_blocks
+        # An extent shared with clones is never changed in place
+        shared = self.index_manager.is_extent_shared(file_node.file_start_block)
+
+        if not shared and self.bitmap_manager.is_range_free(file_end, extra_blocks):
+            if reserve:
+                self.bitmap_manager.reserve_range(file_end, extra_blocks)
+            else:
+                self.bitmap_manager.mark_range(file_end, extra_blocks)
+            if zero_fill:
+                self.storage.write_at(
+                    self.data_offset(file_end), bytes(extra_blocks * block_size)
+                )
+        else:
+            start_block = self.allocate_extent(new_blocks, reserve)
+            old_size = file_node.file_blocks * block_size
+            for offset in range(0, old_size, self.COPY_CHUNK_SIZE):
+                chunk = self.storage.read_at(
+                    self.data_offset(file_node.file_start_block) + offset,
+                    min(self.COPY_CHUNK_SIZE, old_size - offset),
+                )
+                self.storage.write_at(self.data_offset(start_block) + offset, chunk)
+            if zero_fill:
+                self.storage.write_at(
+                    self.data_offset(start_block) + old_size,
+                    bytes(extra_blocks * block_size),
+                )
+
+            if self.index_manager.release_extent(file_node.file_start_block):
+                self.bitmap_manager.free_range(
+                    file_node.file_start_block, file_node.file_blocks
+                )
+            file_node.file_start_block = start_block
+
+        file_node.file_blocks = new_blocks
+
+    def unshare_extent(self, file_node: FileIndexNode) -> None:
+        """
+        Gives a file that shares its extent with clones a private copy of it,
+        called before the file's data is changed.
+
+        :param file_node: The file to unshare.
+        """
+        self.grow_extent(file_node, file_node.file_blocks, False)
+        self.index_manager.write_to_index(file_node)
+
+    def add_release_extent(
+        self, transaction_manager: TransactionManager, file_node: FileIndexNode
+    ) -> None:
+        """
+        Queues dropping a deleted file's reference to its extent. The blocks are
+        only freed once no clone shares them anymore.
+
+        :param transaction_manager: The transaction to add the operation to.
+        :param file_node: The file being deleted.
+        """
+        start_block, blocks = file_node.file_start_block, file_node.file_blocks
+        freed = []
+
+        def release() -> None:
+            if self.index_manager.release_extent(start_block):
+                self.bitmap_manager.free_range(start_block, blocks)
+                freed.append(True)
+
+        def undo() -> None:
+            if freed:
+                self.bitmap_manager.mark_range(start_block, blocks)
+            else:
+                self.index_manager.share_extent(start_block)
+
+        transaction_manager.add_operation(release, rollback_func=undo)
+
+    def add_move_to_extent(
+        self,
+        transaction_manager: TransactionManager,
+        file_node: FileIndexNode,
+        start_block: int,
+    ) -> None:
+        """
+        Queues pointing a file at another extent that holds the same data,
+        taking a reference to it. The old extent is left to the caller.
+
+        :param transaction_manager: The transaction to add the operations to.
+        :param file_node: The file to move.
+        :param start_block: The first block of the extent to share.
+        """
+        old_start_block = file_node.file_start_block
+
+        def move() -> None:
+            file_node.file_start_block = start_block
+            self.index_manager.share_extent(start_block)
+
+        def undo() -> None:
+            file_node.file_start_block = old_start_block
+            self.index_manager.release_extent(start_block)
+            self.index_manager.write_to_index(file_node)
+
+        transaction_manager.add_operation(move, rollback_func=undo)
+        transaction_manager.add_operation(
+            self.index_manager.write_to_index, func_args=[file_node]
+        )
+
+    def add_forget_extent(
+        self, transaction_manager: TransactionManager, start_block: int
+    ) -> None:
+        """
+        Queues dropping the reference count of an extent no file points at
+        anymore.
+
+        :param transaction_manager: The transaction to add the operation to.
+        :param start_block: The first block of the extent.
+        """
+        extent_refs = self.index_manager.extent_refs
+        refs = []
+
+        def forget() -> None:
+            if start_block in extent_refs:
+                refs.append(extent_refs.pop(start_block))
+
+        def undo() -> None:
+            if refs:
+                extent_refs[start_block] = refs.pop()
+
+        transaction_manager.add_operation(forget, rollback_func=undo)
+
+    def compress_data(self, data: bytes) -> Optional[bytes]:
+        """
+        Compresses the data of a file with the codec of the volume.
+
+        :param data: The data, which ends at its last non zero byte like on disk.
+        :return: The contents of the compressed extent, or None when compressing
+            the data would not save enough space.
+        """
+        return self.compressor.compress(
+            data.rstrip(b"\0"), self.config_manager.block_size
+        )
+
+    def load_layout(self, file_node: FileIndexNode) -> CompressedLayout:
+        """Returns the chunk table of a compressed file, read on first use."""
+        layout = file_node.compressed_layout
+        if layout is None:
+            layout = CompressedLayout.from_bytes(
+                self.read_layout_head(file_node, CompressedLayout.size_of)
             )
+            file_node.compressed_layout = layout
+        return layout
 
-            free_blocks = self.bitmap_manager.find_free_space_bitmap(
-                int(math.ceil(file_index.file_blocks * factor))
+    def read_layout_head(
+        self, file_node: FileIndexNode, size_of: Callable[[bytes], int]
+    ) -> bytes:
+        """
+        Reads the header and table at the start of a compressed or sparse extent,
+        with a second read only when the table is larger than LAYOUT_READ_SIZE.
+
+        :param file_node: The node of the file.
+        :param size_of: Returns the size of the table from the start of it.
+        :return: The header and table.
+        """
+        offset = self.data_offset(file_node.file_start_block)
+        capacity = file_node.file_blocks * self.config_manager.block_size
+        head = bytes(
+            self.storage.read_at(offset, min(capacity, self.LAYOUT_READ_SIZE))
+        )
+        size = size_of(head)
+        if size > len(head):
+            head = bytes(self.storage.read_at(offset, size))
+        return head
+
+    def read_chunks(
+        self, file_node: FileIndexNode, first: int, last: int
+    ) -> List[bytes]:
+        """
+        Decodes the chunks first to last of a compressed file, reading all of
+        them with a single read.
+
+        :param file_node: The node of the file.
+        :param first: The index of the first chunk.
+        :param last: The index of the last chunk.
+        :return: The decoded chunks.
+        """
+        layout = self.load_layout(file_node)
+        if last < first:
+            return []
+
+        chunks = []
+        cached_index, cached_chunk = layout.last_chunk
+        if cached_index == first:
+            chunks.append(cached_chunk)
+            first += 1
+            if first > last:
+                return chunks
+
+        start, end = layout.chunk_span(first, last)
+        data = memoryview(
+            self.storage.read_at(
+                self.data_offset(file_node.file_start_block) + start, end - start
             )
-            start_block = free_blocks[0]
+        )
+        chunk_start = start
+        for index in range(first, last + 1):
+            _, chunk_end = layout.chunk_span(index, index)
+            chunks.append(
+                self.compressor.decompress(
+                    layout.codec, data[chunk_start - start : chunk_end - start]
+                )
+            )
+            chunk_start = chunk_end
+        layout.last_chunk = (last, chunks[-1])
+        return chunks
 
-            file_index.file_start_block = start_block
-            file_index.file_blocks = len(free_blocks)
+    def read_compressed_into(
+        self, file_node: FileIndexNode, offset: int, buffer: memoryview
+    ) -> int:
+        """
+        Reads a range of a compressed file into buffer, decoding only the chunks
+        the range covers.
 
-            children_data_start = (
-                self.config_manager.bitmap_size
-                + self.config_manager.file_index_size
-                + start_block * self.config_manager.block_size
+        :param file_node: The node of the file.
+        :param offset: The byte offset in the uncompressed data.
+        :param buffer: The writable buffer to fill.
+        :return: The number of bytes read, which stops at the end of the data.
+        """
+        layout = self.load_layout(file_node)
+        size = max(0, min(len(buffer), layout.length - offset))
+        if size == 0:
+            return 0
+
+        first = offset // layout.chunk_size
+        last = (offset + size - 1) // layout.chunk_size
+        position = 0
+        skip = offset - first * layout.chunk_size
+        for chunk in self.read_chunks(file_node, first, last):
+            part = memoryview(chunk)[skip : skip + size - position]
+            buffer[position : position + len(part)] = part
+            position += len(part)
+            skip = 0
+        return size
+
+    def pwrite_compressed(
+        self, file_node: FileIndexNode, offset: int, data: bytes
+    ) -> int:
+        """
+        Writes data into a compressed file at offset, recompressing only the
+        chunks it covers. The chunks after them are moved as they are stored, and
+        the extent is rewritten in place when it still fits and no clone shares
+        it.
+
+        :param file_node: The node of the file.
+        :param offset: The byte offset to write at.
+        :param data: The data to write.
+        :return: The number of bytes written.
+        """
+        layout = self.load_layout(file_node)
+        chunk_size = layout.chunk_size
+        count = len(layout.ends)
+        end = offset + len(data)
+        # Writing past the end fills the gap with zeros from the last chunk on
+        first = min(offset, layout.length) // chunk_size
+        last = min(count - 1, (end - 1) // chunk_size)
+        region_start = first * chunk_size
+        region = bytearray().join(self.read_chunks(file_node, first, last))
+        region.extend(bytes(max(0, offset - region_start - len(region))))
+        region[offset - region_start : end - region_start] = data
+
+        length = layout.length
+        if last == count - 1:
+            region = region.rstrip(b"\0")
+            length = region_start + len(region)
+            if not region and first:
+                # The data now ends in an earlier chunk, with zeros before
+                # the new end that stored chunks can not tell
+                full_data = bytearray(self.read_file(file_node))
+                full_data[offset:end] = data
+                self.store_file_data(file_node, bytes(full_data), True)
+                return len(data)
+
+        chunks = self.compressor.compress_chunks(
+            layout.codec, chunk_size, bytes(region)
+        )
+        prefix_end = layout.ends[first - 1] if first else 0
+        ends = layout.ends[:first]
+        for chunk in chunks:
+            ends.append((ends[-1] if ends else 0) + len(chunk))
+        suffix = b""
+        if last + 1 < count:
+            suffix_start, suffix_end = layout.chunk_span(last + 1, count - 1)
+            suffix = bytes(
+                self.storage.read_at(
+                    self.data_offset(file_node.file_start_block) + suffix_start,
+                    suffix_end - suffix_start,
+                )
             )
+            shift = ends[-1] - layout.ends[last]
+            ends += [chunk_end + shift for chunk_end in layout.ends[last + 1 :]]
+        new_layout = CompressedLayout(layout.codec, chunk_size, length, ends)
+
+        if len(ends) == count:
+            # The table keeps its size, the chunks before the write stay put
+            writes = [
+                (0, new_layout.to_bytes()),
+                (new_layout.data_start + prefix_end, b"".join(chunks) + suffix),
+            ]
+        else:
+            prefix = bytes(
+                self.storage.read_at(
+                    self.data_offset(file_node.file_start_block) + layout.data_start,
+                    prefix_end,
+                )
+            )
+            writes = [(0, new_layout.to_bytes() + prefix + b"".join(chunks) + suffix)]
+
+        capacity = file_node.file_blocks * self.config_manager.block_size
+        if new_layout.stored_size > capacity or self.index_manager.is_extent_shared(
+            file_node.file_start_block
+        ):
+            stored_data = writes[0][1]
+            if len(writes) > 1:
+                stored_data = bytearray(
+                    self.storage.read_at(
+                        self.data_offset(file_node.file_start_block),
+                        layout.stored_size,
+                    )
+                )
+                for position, part in writes:
+                    stored_data[position : position + len(part)] = part
+            self.replace_extent(
+                file_node,
+                bytes(stored_data[: new_layout.stored_size]),
+                True,
+                False,
+                length,
+            )
+            self.transaction_manager.add_operation(
+                self.index_manager.write_to_index,
+                rollback_func=self.index_manager.delete_from_index,
+                func_args=[file_node],
+                rollback_args=[file_node],
+            )
+            self.transaction_manager.commit()
+            return len(data)
 
-            for i, child in enumerate(children):
-                self.fs.seek(children_data_start + i * 4)
-                self.fs.write(child.id.to_bytes(4, byteorder="big"))
+        for position, part in writes:
+            position += self.data_offset(file_node.file_start_block)
+            self.transaction_manager.add_operation(
+                self.storage.write_at,
+                rollback_func=self.storage.write_at,
+                func_args=[position, part],
+                rollback_args=[
+                    position, bytes(self.storage.read_at(position, len(part)))
+                ],
+            )
+        self.transaction_manager.add_operation(
+            self._set_compressed_layout,
+            rollback_func=self._set_compressed_layout,
+            func_args=[file_node, new_layout],
+            rollback_args=[file_node, layout],
+        )
+        self.transaction_manager.add_operation(
+            self.index_manager.write_to_index, func_args=[file_node]
+        )
+        self.transaction_manager.commit()
+        return len(data)
 
-            for block in free_blocks:
-                self.bitmap_manager.mark_used(block)
+    @staticmethod
+    def _set_compressed_layout(
+        file_node: FileIndexNode, layout: CompressedLayout
+    ) -> None:
+        file_node.compressed_layout = layout
+        file_node.data_length = layout.length
 
+    def sparse_data(self, data: bytes) -> Optional[bytes]:
+        """
+        Packs the data of a file without its holes.
+
+        :param data: The data, which ends at its last non zero byte like on disk.
+        :return: The contents of the sparse extent, or None when the data has too
+            few holes to save space.
+        """
+        return SparseLayout.pack(data.rstrip(b"\0"), self.config_manager.block_size)
+
+    def load_sparse_layout(self, file_node: FileIndexNode) -> SparseLayout:
+        """Returns the run table of a sparse file, read on first use."""
+        layout = file_node.sparse_layout
+        if layout is None:
+            layout = SparseLayout.from_bytes(
+                self.read_layout_head(file_node, SparseLayout.size_of)
+            )
+            file_node.sparse_layout = layout
+        return layout
+
+    def read_sparse(self, file_node: FileIndexNode) -> bytes:
+        """
+        Reads the data of a sparse file with one read of its runs, the holes
+        between them are filled in with zeros.
+        """
+        layout = self.load_sparse_layout(file_node)
+        stored = memoryview(
+            self.storage.read_at(
+                self.data_offset(file_node.file_start_block) + layout.data_start,
+                layout.stored_size - layout.data_start,
+            )
+        )
+        parts = []
+        end = 0
+        for (offset, length), position in zip(layout.runs, layout.positions):
+            start = position - layout.data_start
+            parts.append(bytes(offset - end))
+            parts.append(stored[start : start + length])
+            end = offset + length
+        return b"".join(parts)
+
+    def read_sparse_into(
+        self, file_node: FileIndexNode, offset: int, buffer: memoryview
+    ) -> int:
+        """
+        Reads a range of a sparse file into buffer. Only the runs the range
+        covers are read, holes are zeroed in the buffer without any I/O.
+
+        :param file_node: The node of the file.
+        :param offset: The byte offset in the file.
+        :param buffer: The writable buffer to fill.
+        :return: The number of bytes read, which stops at the end of the data.
+        """
+        layout = self.load_sparse_layout(file_node)
+        size = max(0, min(len(buffer), layout.length - offset))
+        start = self.data_offset(file_node.file_start_block)
+        done = 0
+        for length, position in layout.pieces(offset, size):
+            if position is None:
+                buffer[done : done + length] = bytes(length)
+            else:
+                self.storage.readinto_at(
+                    start + position, buffer[done : done + length]
+                )
+            done += length
+        return size
+
+    def write_sparse_at(
+        self, file_node: FileIndexNode, offset: int, data: bytes
+    ) -> int:
+        """
+        Writes data in place into the runs of a sparse file, which have to cover
+        all of it. The length of the file stays the same.
+
+        :param file_node: The node of the file.
+        :param offset: The byte offset in the file to write at.
+        :param data: The data to write.
+        :return: The number of bytes written.
+        """
+        if self.index_manager.is_extent_shared(file_node.file_start_block):
+            self.unshare_extent(file_node)
+
+        layout = self.load_sparse_layout(file_node)
+        start = self.data_offset(file_node.file_start_block)
+        done = 0
+        for length, position in layout.pieces(offset, len(data)):
+            if position is None:
+                raise ValueError("Sparse files are only written in place in data.")
+            self.storage.write_at(start + position, data[done : done + length])
+            done += length
+        return done
+
+    def pwrite_sparse(self, file_node: FileIndexNode, offset: int, data: bytes) -> int:
+        """
+        Writes data into a sparse file at offset. Data that lands in the stored
+        runs is written in place as one transaction, anything that fills a hole
+        or extends the file rewrites it, which reads and writes only its runs
+        and leaves out whatever holes remain.
+
+        :param file_node: The node of the file.
+        :param offset: The byte offset to write at.
+        :param data: The data to write.
+        :return: The number of bytes written.
+        """
+        layout = self.load_sparse_layout(file_node)
+        end = offset + len(data)
+        # Zeros at the very end would shorten the file, so they rewrite it too
+        in_place = (end < layout.length or data[-1:] != b"\0") and all(
+            position is not None for _, position in layout.pieces(offset, len(data))
+        )
+        if not in_place:
+            new_data = bytearray(self.read_sparse(file_node))
+            if len(new_data) < end:
+                new_data.extend(bytes(end - len(new_data)))
+            new_data[offset:end] = data
+            self.store_file_data(file_node, bytes(new_data), False)
+            return len(data)
+
+        undo_data = bytearray(len(data))
+        self.read_sparse_into(file_node, offset, memoryview(undo_data))
+        self.transaction_manager.add_operation(
+            self.write_at,
+            rollback_func=self.write_at,
+            func_args=[file_node, offset, data],
+            rollback_args=[file_node, offset, bytes(undo_data)],
+        )
+        self.transaction_manager.commit()
+        return len(data)
+
+    def seek_data(self, file_node: FileIndexNode, offset: int) -> int:
+        """
+        Finds the next data in a file like lseek with SEEK_DATA. Only sparse
+        files have holes, other files are data up to their end.
+
+        :param file_node: The node of the file.
+        :param offset: The byte offset to search from.
+        :return: The first offset at or after offset that holds data.
+        :raises OSError: With ENXIO when there is no data after offset.
+        """
+        length = self.get_file_length(file_node)
+        data_offset = offset if 0 <= offset < length else None
+        if data_offset is not None and file_node.is_sparse:
+            data_offset = self.load_sparse_layout(file_node).seek_data(offset)
+        if data_offset is None:
+            raise OSError(errno.ENXIO, "No data after offset.", file_node.file_name)
+        return data_offset
+
+    def seek_hole(self, file_node: FileIndexNode, offset: int) -> int:
+        """
+        Finds the next hole in a file like lseek with SEEK_HOLE, the end of the
+        file counting as one.
+
+        :param file_node: The node of the file.
+        :param offset: The byte offset to search from.
+        :return: The first offset at or after offset in a hole or at the end.
+        :raises OSError: With ENXIO when offset is past the end of the file.
+        """
+        length = self.get_file_length(file_node)
+        if not 0 <= offset < length:
+            raise OSError(errno.ENXIO, "Offset is past the end.", file_node.file_name)
+        if file_node.is_sparse:
+            return min(self.load_sparse_layout(file_node).seek_hole(offset), length)
+        return length
+
+    def set_compression(
+        self, target: Union[str, FileHandle, FileIndexNode], enabled: bool
+    ) -> None:
+        """
+        Turns compression of a file or directory on or off. A file is rewritten
+        compressed or plain, and stays plain when compressing it does not pay
+        off. For a directory this sets the default of the files and directories
+        created in it later.
+
+        :param target: The path, handle or node of the file or directory.
+        :param enabled: Whether to compress.
+        """
+        file_node = self.get_node(target)
+        if not file_node:
+            raise FileNotFoundError(f"File '{target}' not found.")
+
+        if file_node.is_directory:
+            file_node.is_compressed = enabled
+            self.transaction_manager.add_operation(
+                self.index_manager.write_to_index,
+                rollback_func=self.index_manager.delete_from_index,
+                func_args=[file_node],
+                rollback_args=[file_node],
+            )
+            self.transaction_manager.commit()
+        elif file_node.is_compressed != enabled:
+            self.store_file_data(file_node, self.read_file(file_node), enabled)
+
+    def store_file_data(
+        self, file_node: FileIndexNode, data: bytes, compress: bool
+    ) -> None:
+        """
+        Replaces the data of a file with data written to a new extent, which is
+        compressed if compress is set and that pays off, and otherwise leaves out
+        the holes in the data when that pays off. The old extent is only freed
+        once no clone shares it.
+
+        :param file_node: The file to rewrite.
+        :param data: Its new data.
+        :param compress: Whether to try to compress the data.
+        """
+        data = data.rstrip(b"\0")
+        compressed_data = self.compress_data(data) if compress else None
+        sparse_data = self.sparse_data(data) if compressed_data is None else None
+        stored_data = data
+        if compressed_data is not None:
+            stored_data = compressed_data
+        elif sparse_data is not None:
+            stored_data = sparse_data
+
+        self.replace_extent(
+            file_node,
+            stored_data,
+            compressed_data is not None,
+            sparse_data is not None,
+            len(data),
+        )
+
+    def replace_extent(
+        self,
+        file_node: FileIndexNode,
+        stored_data: bytes,
+        is_compressed: bool,
+        is_sparse: bool,
+        length: int,
+    ) -> None:
+        """
+        Writes the contents of a file's extent to a new extent and switches the
+        file to it. The old extent is only freed once no clone shares it.
+
+        :param file_node: The file to rewrite.
+        :param stored_data: The extent as stored, compressed, sparse or plain.
+        :param is_compressed: Whether stored_data is compressed.
+        :param is_sparse: Whether stored_data leaves out holes.
+        :param length: The length of the data of the file.
+        """
+        block_size = self.config_manager.block_size
+        blocks = max(1, math.ceil(len(stored_data) / block_size))
+        start_block = self.allocate_extent(blocks)
+        self.storage.write_at(
+            self.data_offset(start_block),
+            stored_data.ljust(blocks * block_size, b"\0"),
+        )
+
+        if self.index_manager.release_extent(file_node.file_start_block):
+            self.bitmap_manager.free_range(
+                file_node.file_start_block, file_node.file_blocks
+            )
+        file_node.file_start_block = start_block
+        file_node.file_blocks = blocks
+        file_node.is_compressed = is_compressed
+        file_node.compressed_layout = None
+        file_node.is_sparse = is_sparse
+        file_node.sparse_layout = None
+        file_node.data_length = length
+
+        self.transaction_manager.add_operation(
+            self.index_manager.write_to_index,
+            rollback_func=self.index_manager.delete_from_index,
+            func_args=[file_node],
+            rollback_args=[file_node],
+        )
+        self.transaction_manager.commit()
+
+    def allocate_extent(self, blocks: int, reserve: bool = False) -> int:
+        """
+        Finds a contiguous run of free blocks and marks it as used.
+
+        :param blocks: The number of blocks in the run.
+        :param reserve: Only reserve the run in memory, it is then marked as used
+            in the image by link_file or given back with free_range.
+        :return: The first block of the run.
+        """
+        start_block = self.bitmap_manager.find_free_space_bitmap(blocks)[0]
+        if reserve:
+            self.bitmap_manager.reserve_range(start_block, blocks)
+        else:
+            self.bitmap_manager.mark_range(start_block, blocks)
+        return start_block
+
+    def data_offset(self, block: int) -> int:
+        """Returns the position of a data block in the volume file."""
+        return self.config_manager.data_start + block * self.config_manager.block_size
+
+    def _relocate_directory(self, dir_node: FileIndexNode, new_blocks: int) -> None:
+        """Moves the children area of a directory to a new run of new_blocks."""
+        start_block = self.bitmap_manager.find_free_space_bitmap(new_blocks)[0]
+
+        children_data = self.storage.read_at(
+            self.data_offset(dir_node.file_start_block), 4 * dir_node.children_count
+        )
+        self.storage.write_at(self.data_offset(start_block), children_data)
+
+        self.bitmap_manager.mark_range(start_block, new_blocks)
+        self.bitmap_manager.free_range(dir_node.file_start_block, dir_node.file_blocks)
+
+        dir_node.file_start_block = start_block
+        dir_node.file_blocks = new_blocks
+
+    # TODO: add a method which will also automically copy all the older blocks and expand
+    def realign(self, file_index: FileIndexNode, factor: Union[int, float] = 2) -> None:
+        if file_index.is_directory:
+            self._relocate_directory(
+                file_index, int(math.ceil(file_index.file_blocks * factor))
+            )
         else:
             file_data = self.read_file(file_index)
             self.bitmap_manager.free_blocks(
@@ -670,13 +2205,13 @@ class FileSystem:
             file_index.file_blocks = len(free_blocks)
 
             file_data_start = (
-                self.config_manager.bitmap_size
-                + self.config_manager.file_index_size
+                self.config_manager.data_start
                 + start_block * self.config_manager.block_size
             )
 
-            self.fs.seek(file_data_start)
-            self.fs.write(file_data.ljust(self.config_manager.block_size, b"\0"))
+            self.storage.write_at(
+                file_data_start, file_data.ljust(self.config_manager.block_size, b"\0")
+            )
 
             for block in free_blocks:
                 self.bitmap_manager.mark_used(block)
@@ -684,13 +2219,128 @@ class FileSystem:
         self.index_manager.write_to_index(file_index)
 
     def reserve_file(self) -> None:
-        self.fs.seek(
-            self.config_manager.bitmap_size
-            + self.config_manager.file_index_size
-            + self.config_manager.file_system_size
-            - 1
+        with open(self.fs_path_name, "ab") as image:
+            image.truncate(
+                self.config_manager.data_start
+                + self.config_manager.file_system_size
+            )
+
+    def grow(self, new_size: int, new_index_size: Optional[int] = None) -> None:
+        """
+        Grows the volume while it is mounted. The data region is extended at its
+        end, in the large block region when there is one, so no block changes
+        number and no file data is moved. Bitmaps and an index that no longer
+        fit where they are are written past everything in use, and the metadata
+        switches to the new layout with one atomic rename. A crash before it
+        leaves the volume as it was, only with a longer image.
+
+        :param new_size: The new size of the data region in bytes.
+        :param new_index_size: The new size of the file index in bytes, kept
+            when omitted.
+        """
+        config = self.config_manager
+        if new_index_size is None:
+            new_index_size = config.file_index_size
+        if (
+            new_size < config.file_system_size
+            or new_index_size < config.file_index_size
+        ):
+            raise ValueError("A volume can only grow.")
+
+        added = new_size - config.file_system_size
+        if config.large_num_blocks:
+            # The large region comes last, so its new blocks number after all
+            # existing ones
+            added -= added % config.large_block_size
+        if not added and new_index_size == config.file_index_size:
+            return
+
+        metadata = dataclasses.replace(
+            self.metedata_manager.metadata,
+            file_system_size=config.file_system_size + added,
+            file_index_size=new_index_size,
+            large_region_size=config.large_region_size
+            + (added if config.large_num_blocks else 0),
+            bitmap_offset=config.bitmap_offset,
+            index_offset=config.index_offset,
+            data_start=config.data_start,
+        )
+        new_config = ConfigManager(metadata)
+        data_end = config.data_start + new_config.file_system_size
+
+        # Structures the data region now reaches, or whose size or format
+        # changes, are rebuilt past the end of the current layout
+        old_bitmaps = (config.bitmap_offset, config.bitmap_offset + config.bitmap_size)
+        old_index = (config.index_offset, config.index_offset + config.file_index_size)
+        tail = max(data_end, old_bitmaps[1], old_index[1])
+        move_bitmaps = new_config.bitmap_size != config.bitmap_size or (
+            old_bitmaps[0] < data_end and old_bitmaps[1] > config.data_start
+        )
+        move_index = (
+            new_index_size != config.file_index_size
+            or new_config.index_entry_size != config.index_entry_size
+            or (old_index[0] < data_end and old_index[1] > config.data_start)
+        )
+        if move_bitmaps:
+            metadata.bitmap_offset = tail
+            tail += new_config.bitmap_size
+        if move_index:
+            metadata.index_offset = tail
+            tail += new_index_size
+        new_config = ConfigManager(metadata)
+        if len(self.index_manager.index) > new_config.max_index_entries:
+            raise ValueError("The new file index is too small for the files in it.")
+
+        # The image is only extended, everything in use stays where it is
+        self.storage.sync()
+        self.storage.close()
+        if os.path.getsize(self.fs_path_name) < tail:
+            os.truncate(self.fs_path_name, tail)
+        self.storage = self._open_storage()
+        self.index_manager.storage = self.storage
+        self.transaction_manager.on_commit = self.storage.sync
+
+        if move_bitmaps:
+            bitmaps = bytearray(new_config.bitmap_size)
+            bitmaps[: config.small_bitmap_size] = self.storage.read_at(
+                config.bitmap_offset, config.small_bitmap_size
+            )
+            large_offset = new_config.small_bitmap_size
+            bitmaps[large_offset : large_offset + config.large_bitmap_size] = (
+                self.storage.read_at(
+                    config.bitmap_offset + config.small_bitmap_size,
+                    config.large_bitmap_size,
+                )
+            )
+            self.storage.write_at(new_config.bitmap_offset, bytes(bitmaps))
+        if move_index:
+            self.index_manager.relocate(new_config)
+        else:
+            self.index_manager.config_manager = new_config
+        self.storage.sync()
+
+        self.metedata_manager.replace_metadata(metadata)
+        self.config_manager = new_config
+        # Extents of files still being written are only reserved in memory
+        reserved = list(self.bitmap_manager.iter_reserved_runs())
+        self.bitmap_manager = self._load_bitmaps()
+        for start_block, blocks in reserved:
+            self.bitmap_manager.reserve_range(start_block, blocks)
+
+        # What the data region took over from the old layout is free space now
+        for moved, (start, end) in (
+            (move_bitmaps, old_bitmaps),
+            (move_index, old_index),
+        ):
+            start, end = max(start, config.data_start), min(end, data_end)
+            if moved and start < end:
+                self.storage.write_at(start, bytes(end - start))
+        self.storage.sync()
+
+        self.logger.info(
+            f"Grew the volume to {new_config.file_system_size} bytes of data and "
+            f"{new_index_size} bytes of index"
         )
-        self.fs.write(b"\0")
 
     def get_free_space(self) -> int:
         return (
@@ -698,14 +2348,10 @@ class FileSystem:
         )
 
     def list_all_files(self) -> List[FileIndexNode]:
-        return list(self.index_manager.index.values())
+        return self.index_manager.list_all_files()
 
     def find_file_by_name(self, file_name: str) -> Optional[FileIndexNode]:
-        for file_index in self.index_manager.index.values():
-            if file_index.file_name == file_name:
-                return file_index
-
-        return None
+        return self.index_manager.find_file_by_name(file_name)
 
     def calculate_fragmentation(self):
         # Sort the file nodes by start block
@@ -746,27 +2392,89 @@ class FileSystem:
         file_nodes = sorted(
             self.index_manager.index.values(), key=lambda node: node.file_start_block
         )
-        next_block_idx = 0
+        # Extents are packed within their region, on whole large blocks in the
+        # large one
+        small_num_blocks = self.config_manager.small_num_blocks
+        large_block = self.config_manager.blocks_per_large_block
+        next_block_idx = {False: 0, True: small_num_blocks}
+        # Clones are sorted next to each other and moved together
+        moved_extents = {}
         for node in file_nodes:
-            file_data = self.read_file(node)
-            node.file_start_block = next_block_idx
+            if not node.is_directory and node.file_start_block in moved_extents:
+                node.file_start_block = moved_extents[node.file_start_block]
+                self.index_manager.write_to_index(node)
+                continue
+            is_large = node.file_start_block >= small_num_blocks
+            start_block = next_block_idx[is_large]
+            if not node.is_directory:
+                moved_extents[node.file_start_block] = start_block
+
+            # The extent is copied as stored, compressed or not
+            file_data = self.storage.read_at(
+                self.data_offset(node.file_start_block),
+                node.file_blocks * self.config_manager.block_size,
+            )
+            node.file_start_block = start_block
             self.index_manager.write_to_index(node)
-            self.fs.seek(
-                self.config_manager.bitmap_size
-                + self.config_manager.file_index_size
-                + next_block_idx * self.config_manager.block_size
-            )
-            next_block_idx += node.file_blocks
-            self.fs.write(
-                file_data.ljust(
-                    node.file_blocks * self.config_manager.block_size, b"\0"
+            self.storage.write_at(self.data_offset(start_block), file_data)
+            next_block_idx[is_large] += node.file_blocks
+            if is_large:
+                next_block_idx[True] += -node.file_blocks % large_block
+        self.index_manager.rebuild_extent_refs()
+
+    def deduplicate(self) -> Dict[str, int]:
+        """
+        Makes files whose stored data is identical share one extent, the offline
+        counterpart of inline deduplication for volumes that already hold
+        copies. Every extent is hashed once, a match is compared byte by byte
+        before the duplicate is freed, and the digest index is rewritten from
+        what is stored now.
+
+        :return: The number of extents freed and the bytes they held.
+        """
+        dedup_manager = self.dedup_manager
+        extents: Dict[int, List[FileIndexNode]] = {}
+        for node in self.index_manager.index.values():
+            if not node.is_directory and node is not dedup_manager.index_node:
+                extents.setdefault(node.file_start_block, []).append(node)
+
+        kept: Dict[bytes, FileIndexNode] = {}
+        moved_files = 0
+        freed_extents = 0
+        freed_bytes = 0
+        for start_block, nodes in sorted(extents.items()):
+            digest = dedup_manager.hash_extent(nodes[0])
+            keeper = kept.setdefault(digest, nodes[0])
+            if keeper is nodes[0] or not dedup_manager.same_extents(keeper, nodes[0]):
+                continue
+
+            # Every file on the duplicate extent, clones included, moves over
+            for node in nodes:
+                self.add_move_to_extent(
+                    self.transaction_manager, node, keeper.file_start_block
                 )
+            self.add_forget_extent(self.transaction_manager, start_block)
+            self.transaction_manager.add_operation(
+                self.bitmap_manager.free_range,
+                rollback_func=self.bitmap_manager.mark_range,
+                func_args=[start_block, keeper.file_blocks],
+                rollback_args=[start_block, keeper.file_blocks],
             )
-            self.fs.flush()
+            moved_files += len(nodes)
+            freed_extents += 1
+            freed_bytes += keeper.file_blocks * self.config_manager.block_size
+
+        self.transaction_manager.commit()
+        dedup_manager.files_deduplicated += moved_files
+        dedup_manager.bytes_saved += freed_bytes
+        dedup_manager.rewrite({digest: node.id for digest, node in kept.items()})
+        self.logger.info(f"Deduplicated {freed_extents} extents, {freed_bytes} bytes")
+        return {"extents_freed": freed_extents, "bytes_saved": freed_bytes}
 
     def clear_block_data(self, block_number: int) -> None:
-        self.fs.seek(block_number * self.config_manager.block_size)
-        self.fs.write(b"\0" * self.config_manager.block_size)
+        self.storage.write_at(
+            self.data_offset(block_number), b"\0" * self.config_manager.block_size
+        )
 
     def clear_blocks_data(self, blocks: List[int]) -> None:
         for block in blocks:
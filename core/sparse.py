@@ -0,0 +1,156 @@
+"""
+Module containing the SparseLayout class, which stores file data without the
+runs of zeros in it, so holes take no blocks and are read back as zeros
+without touching the volume.
+"""
+
+import bisect
+import math
+import struct
+from typing import List, Optional, Tuple
+
+# Zeros are only left out in aligned chunks of this size
+HOLE_SIZE = 4096
+# Like compression, a file is only stored sparse when that saves this much
+MIN_SAVINGS = 0.125
+
+ZERO_CHUNK = bytes(HOLE_SIZE)
+
+
+class SparseLayout:
+    """
+    The start of a sparse file's extent: a header with the length of the data
+    and the number of data runs, followed by the offset and length of every run
+    in the file. The runs follow the table back to back, and everything between
+    them is a hole.
+    """
+
+    HEADER = struct.Struct(">QI")
+    RUN = struct.Struct(">QI")
+
+    def __init__(self, length: int, runs: List[Tuple[int, int]]) -> None:
+        self.length = length
+        self.runs = runs
+        self.offsets = [offset for offset, _ in runs]
+        # Where every run starts in the extent
+        self.positions = []
+        position = self.data_start
+        for _, run_length in runs:
+            self.positions.append(position)
+            position += run_length
+        self.stored_size = position
+
+    @property
+    def data_start(self) -> int:
+        return self.HEADER.size + self.RUN.size * len(self.runs)
+
+    def pieces(self, offset: int, size: int) -> List[Tuple[int, Optional[int]]]:
+        """
+        Splits a range of the file into the parts that are stored and the holes.
+
+        :param offset: The byte offset in the file.
+        :param size: The length of the range.
+        :return: The length of every part in order, with its position in the
+            extent or None for a hole.
+        """
+        pieces: List[Tuple[int, Optional[int]]] = []
+        end = offset + size
+        index = max(0, bisect.bisect_right(self.offsets, offset) - 1)
+        while offset < end:
+            if index < len(self.runs):
+                run_offset, run_length = self.runs[index]
+            else:
+                run_offset, run_length = end, 0
+
+            if offset < run_offset:
+                length = min(run_offset, end) - offset
+                pieces.append((length, None))
+            elif offset < run_offset + run_length:
+                length = min(run_offset + run_length, end) - offset
+                pieces.append((length, self.positions[index] + offset - run_offset))
+            else:
+                index += 1
+                continue
+            offset += length
+        return pieces
+
+    def seek_data(self, offset: int) -> Optional[int]:
+        """Returns the first offset at or after offset holding data, if any."""
+        index = bisect.bisect_right(self.offsets, offset) - 1
+        if index >= 0 and offset < sum(self.runs[index]):
+            return offset
+        if index + 1 < len(self.runs):
+            return self.offsets[index + 1]
+        return None
+
+    def seek_hole(self, offset: int) -> int:
+        """Returns the first offset at or after offset in a hole or at the end."""
+        index = bisect.bisect_right(self.offsets, offset) - 1
+        if index >= 0 and offset < sum(self.runs[index]):
+            return sum(self.runs[index])
+        return min(offset, self.length)
+
+    def pays_off(self, block_size: int) -> bool:
+        """Tells whether leaving out the holes saves enough whole blocks."""
+        if self.stored_size - self.data_start == self.length:
+            # Nothing is left out, whatever the blocks round to
+            return False
+        raw_blocks = math.ceil(self.length / block_size)
+        return self.stored_size <= raw_blocks * (1 - MIN_SAVINGS) * block_size
+
+    def to_bytes(self) -> bytes:
+        return self.HEADER.pack(self.length, len(self.runs)) + b"".join(
+            self.RUN.pack(offset, length) for offset, length in self.runs
+        )
+
+    @classmethod
+    def size_of(cls, head: bytes) -> int:
+        """Returns the size of the header and table that start with head."""
+        _, count = cls.HEADER.unpack_from(head)
+        return cls.HEADER.size + cls.RUN.size * count
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "SparseLayout":
+        length, count = cls.HEADER.unpack_from(data)
+        runs = [
+            cls.RUN.unpack_from(data, cls.HEADER.size + cls.RUN.size * i)
+            for i in range(count)
+        ]
+        return cls(length, runs)
+
+    @staticmethod
+    def has_holes(data: bytes) -> bool:
+        """Tells whether data may hold an aligned chunk of zeros, cheaply."""
+        return ZERO_CHUNK in data
+
+    @classmethod
+    def pack(cls, data: bytes, block_size: int) -> Optional[bytes]:
+        """
+        Encodes data as the contents of a sparse extent.
+
+        :param data: The data of the file, ending at its last non zero byte.
+        :param block_size: The block size of the volume, savings are counted in
+            whole blocks.
+        :return: The extent, or None when leaving out the holes does not pay off.
+        """
+        if not cls.has_holes(data):
+            return None
+
+        runs: List[Tuple[int, int]] = []
+        run_start = None
+        for offset in range(0, len(data), HOLE_SIZE):
+            if data[offset : offset + HOLE_SIZE] == ZERO_CHUNK:
+                if run_start is not None:
+                    runs.append((run_start, offset - run_start))
+                    run_start = None
+            elif run_start is None:
+                run_start = offset
+        if run_start is not None:
+            runs.append((run_start, len(data) - run_start))
+
+        layout = cls(len(data), runs)
+        if not layout.pays_off(block_size):
+            return None
+        return layout.to_bytes() + b"".join(
+            data[offset : offset + length] for offset, length in runs
+        )
@@ -0,0 +1,315 @@
+"""
+Storage backends the file system reads and writes its image through. Every
+access is positional, so callers never share a file position. The backend of a
+volume is chosen with the storage_backend field of its metadata.
+
+How durable writes are depends on the durability mode of the volume:
+
+- "sync": every write is on disk when it returns.
+- "commit": writes are buffered by the OS and sync, called once per
+  transaction, flushes them.
+- "group": like "commit", but transactions committing at about the same time,
+  from any session of the same image, wait for one shared flush that runs
+  GROUP_COMMIT_INTERVAL seconds after the first of them, or right after the
+  flush in progress.
+"""
+
+import logging
+import mmap
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Dict, Sequence, Tuple, Union
+
+from core.block_device import BlockDevice
+
+DURABILITY_MODES = ("sync", "commit", "group")
+GROUP_COMMIT_INTERVAL = 0.0005
+
+
+class GroupCommit:
+    """
+    Batches the flushes of every backend open on one image. The first caller
+    of wait becomes the leader: it waits for the interval so other transactions
+    can join, then fsyncs the image once for all of them. fsync covers every
+    descriptor and shared mapping of the file, so one call serves all sessions.
+    Callers arriving while a flush runs are served by the next one.
+    """
+
+    def __init__(self, path: str, interval: float) -> None:
+        self.path = path
+        self.interval = interval
+        self.condition = threading.Condition()
+        self.requested = 0
+        self.completed = 0
+        self.flushing = False
+        self.fd = os.open(path, os.O_RDONLY)
+        # Backends sharing it, the descriptor is closed when the last one closes
+        self.users = 0
+
+    def wait(self) -> None:
+        with self.condition:
+            self.requested += 1
+            ticket = self.requested
+
+            while self.completed < ticket:
+                if self.flushing:
+                    self.condition.wait()
+                    continue
+
+                self.flushing = True
+                self.condition.release()
+                try:
+                    time.sleep(self.interval)
+                    with self.condition:
+                        batch = self.requested
+                    os.fsync(self.fd)
+                finally:
+                    self.condition.acquire()
+                    self.flushing = False
+                    self.condition.notify_all()
+                self.completed = max(self.completed, batch)
+                self.condition.notify_all()
+
+
+_group_commits: Dict[Tuple[int, int], GroupCommit] = {}
+_group_commits_lock = threading.Lock()
+
+
+def get_group_commit(path: str) -> GroupCommit:
+    """
+    Returns the group commit shared by every backend open on the image at path.
+    Images are told apart by device and inode, so an image that was deleted and
+    created again gets a group commit of its own. Every call must be matched by
+    a call to release_group_commit.
+    """
+    with _group_commits_lock:
+        stat = os.stat(path)
+        key = (stat.st_dev, stat.st_ino)
+        if key not in _group_commits:
+            _group_commits[key] = GroupCommit(path, GROUP_COMMIT_INTERVAL)
+        _group_commits[key].users += 1
+        return _group_commits[key]
+
+
+def release_group_commit(group_commit: GroupCommit) -> None:
+    """Drops a use of group_commit, closing it once no backend uses it."""
+    with _group_commits_lock:
+        group_commit.users -= 1
+        if group_commit.users:
+            return
+
+        for key, value in list(_group_commits.items()):
+            if value is group_commit:
+                del _group_commits[key]
+        os.close(group_commit.fd)
+
+
+class StorageBackend(ABC):
+    """Positional access to the bytes of a volume image."""
+
+    def __init__(self, path: str, durability: str = "sync") -> None:
+        if durability not in DURABILITY_MODES:
+            raise ValueError(f"Unsupported durability mode: {durability}")
+
+        self.path = path
+        self.durability = durability
+        self.group_commit = get_group_commit(path) if durability == "group" else None
+
+    @property
+    @abstractmethod
+    def closed(self) -> bool:
+        pass
+
+    @abstractmethod
+    def read_at(self, offset: int, size: int) -> Union[bytes, memoryview]:
+        """
+        Reads size bytes at offset. The result is a bytes-like object that may
+        share memory with the image, convert it with bytes() to keep it around.
+        """
+
+    @abstractmethod
+    def readinto_at(self, offset: int, buffer: memoryview) -> int:
+        """Fills buffer with the bytes at offset and returns how many were read."""
+
+    @abstractmethod
+    def write_at(self, offset: int, data: bytes) -> int:
+        """Writes data at offset and returns the number of bytes written."""
+
+    def readv_at(self, offset: int, buffers: Sequence[memoryview]) -> int:
+        """
+        Fills the buffers one after the other with the bytes starting at offset
+        and returns how many were read.
+        """
+        read = 0
+        for buffer in buffers:
+            buffer_read = self.readinto_at(offset + read, buffer)
+            read += buffer_read
+            if buffer_read < len(buffer):
+                break
+        return read
+
+    def writev_at(self, offset: int, buffers: Sequence[bytes]) -> int:
+        """
+        Writes the buffers back to back starting at offset and returns the number
+        of bytes written.
+        """
+        written = 0
+        for buffer in buffers:
+            written += self.write_at(offset + written, buffer)
+        return written
+
+    def sync(self) -> None:
+        """Makes every write so far durable, following the durability mode."""
+        if self.group_commit:
+            self.group_commit.wait()
+        else:
+            self.flush()
+
+    @abstractmethod
+    def flush(self) -> None:
+        """Flushes the buffered writes to disk right away."""
+
+    @abstractmethod
+    def close(self) -> None:
+        pass
+
+    def release_group_commit(self) -> None:
+        """Called by close, lets go of the group commit of the image if any."""
+        if self.group_commit:
+            release_group_commit(self.group_commit)
+            self.group_commit = None
+
+
+class FileBackend(StorageBackend):
+    """
+    Reads and writes through a BlockDevice, one positional syscall per access.
+    In "sync" mode the image is opened with O_SYNC so flush has nothing left to
+    do, otherwise flush fsyncs.
+    """
+
+    def __init__(self, path: str, durability: str = "sync") -> None:
+        super().__init__(path, durability)
+        self.device = BlockDevice(path, synchronous=durability == "sync")
+
+    @property
+    def closed(self) -> bool:
+        return self.device.closed
+
+    def read_at(self, offset: int, size: int) -> bytes:
+        return self.device.read_at(offset, size)
+
+    def readinto_at(self, offset: int, buffer: memoryview) -> int:
+        return self.device.readinto_at(offset, buffer)
+
+    def write_at(self, offset: int, data: bytes) -> int:
+        return self.device.write_at(offset, data)
+
+    def readv_at(self, offset: int, buffers: Sequence[memoryview]) -> int:
+        return self.device.readv_at(offset, buffers)
+
+    def writev_at(self, offset: int, buffers: Sequence[bytes]) -> int:
+        return self.device.writev_at(offset, buffers)
+
+    def flush(self) -> None:
+        if self.durability != "sync" and not self.device.closed:
+            self.device.sync()
+
+    def close(self) -> None:
+        if not self.device.closed:
+            self.flush()
+            self.device.close()
+            self.release_group_commit()
+
+
+class MmapBackend(StorageBackend):
+    """
+    Maps the whole image into memory. Reads are memoryview slices of the map
+    without any copy, writes are copies into the map and flush msyncs the pages
+    written since the last flush. In "sync" mode every write is flushed.
+    """
+
+    def __init__(self, path: str, durability: str = "sync") -> None:
+        super().__init__(path, durability)
+        self.fd = os.open(path, os.O_RDWR)
+        self.map = mmap.mmap(self.fd, 0)
+        self.view = memoryview(self.map)
+        self.size = len(self.map)
+        self._closed = False
+
+        # The byte range written since the last sync
+        self._dirty_start = self.size
+        self._dirty_end = 0
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def read_at(self, offset: int, size: int) -> memoryview:
+        return self.view[offset : min(offset + size, self.size)]
+
+    def readinto_at(self, offset: int, buffer: memoryview) -> int:
+        size = max(0, min(len(buffer), self.size - offset))
+        buffer[:size] = self.view[offset : offset + size]
+        return size
+
+    def write_at(self, offset: int, data: bytes) -> int:
+        if offset + len(data) > self.size:
+            raise ValueError("Write past the end of the volume.")
+
+        self.map[offset : offset + len(data)] = data
+        self._dirty_start = min(self._dirty_start, offset)
+        self._dirty_end = max(self._dirty_end, offset + len(data))
+        if self.durability == "sync":
+            self.flush()
+        return len(data)
+
+    def flush(self) -> None:
+        if self._closed or self._dirty_start >= self._dirty_end:
+            return
+
+        # msync needs a page aligned start
+        start = self._dirty_start - self._dirty_start % mmap.PAGESIZE
+        self.map.flush(start, self._dirty_end - start)
+        self._dirty_start = self.size
+        self._dirty_end = 0
+
+    def close(self) -> None:
+        if self._closed:
+            return
+
+        self.flush()
+        self._closed = True
+        self.view.release()
+        try:
+            self.map.close()
+        except BufferError:
+            # A caller still holds a slice, the map is unmapped once it is gone
+            logging.getLogger(__name__).warning(
+                "Slices of %s are still in use, leaving it mapped.", self.path
+            )
+        os.close(self.fd)
+        self.release_group_commit()
+
+
+STORAGE_BACKENDS = {
+    "file": FileBackend,
+    "mmap": MmapBackend,
+}
+
+
+def open_storage(
+    path: str, backend: str = "file", durability: str = "sync"
+) -> StorageBackend:
+    """
+    Opens the image at path with the named backend.
+
+    :param path: The path of the image, which must already have its full size.
+    :param backend: "file" or "mmap".
+    :param durability: "sync", "commit" or "group".
+    :return: The opened backend.
+    """
+    if backend not in STORAGE_BACKENDS:
+        raise ValueError(f"Unsupported storage backend: {backend}")
+    return STORAGE_BACKENDS[backend](path, durability)
@@ -5,10 +5,14 @@ Simple API to interact with the file system
 import logging
 import os
 import datetime
-from typing import Any, Dict, List, Optional
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, Union
 from dataclasses import dataclass
 
 from core.file_system import FileSystem
+from structs.file_handle import FileHandle
+from structs.file_index_node import FileIndexNode
+from structs.file_stream import FileStream
+from structs.file_writer import FileWriter
 from structs.metadata import Metadata
 
 
@@ -21,6 +25,8 @@ class FileMetadata:
     children_count: Optional[int] = 0
     creation_date: Optional[datetime.datetime] = None
     modification_date: Optional[datetime.datetime] = None
+    is_compressed: bool = False
+    is_sparse: bool = False
 
     def __post_init__(self):
         """
@@ -51,7 +57,18 @@ class FileSystemApi:
 
     FS_PATH = "file_system_disk"
 
-    def __init__(self, user_id: str, file_system: Optional[FileSystem] = None):
+    def __init__(
+        self,
+        user_id: str,
+        file_system: Optional[FileSystem] = None,
+        durability: Optional[str] = None,
+    ):
+        """
+        :param user_id: The user whose file system is mounted.
+        :param file_system: An already mounted file system to use.
+        :param durability: "sync", "commit" or "group" to override the durability
+            mode stored with the volume for this mount.
+        """
         self.user_id = user_id
 
         self.logger = logging.getLogger(self.user_id)
@@ -62,6 +79,7 @@ class FileSystemApi:
             self.file_system = FileSystem(
                 file_system_name=f"{FileSystemApi.FS_PATH}/{user_id}",
                 user_id=self.user_id,
+                durability=durability,
             )
         self.current_directory = "/"
 
@@ -73,7 +91,8 @@ class FileSystemApi:
         Creates a new file system and returns an instance of the API.
 
         :param user_id: The user ID.
-        :param metadata: A dictionary containing the metadata.
+        :param metadata: A dictionary containing the metadata, for example
+            {"durability": "commit"} to pick the durability mode of the volume.
         :return: An instance of the API.
         """
 
@@ -137,6 +156,25 @@ class FileSystemApi:
         )
         return self.normalize_path(os.path.normpath(resolved_path))
 
+    def lookup(self, file_path: str) -> FileHandle:
+        """
+        Resolves a path once and returns a handle to the file or directory. The
+        handle can be passed to the other operations instead of a path so they
+        don't resolve it again.
+
+        :param file_path: The path to resolve.
+        :return: A handle to the file or directory.
+        """
+        return self.file_system.lookup(self.resolve_path(file_path))
+
+    def _get_handle(self, target: Union[str, FileHandle]) -> FileHandle:
+        return target if isinstance(target, FileHandle) else self.lookup(target)
+
+    def _get_path(self, target: Union[str, FileHandle]) -> str:
+        if isinstance(target, FileHandle):
+            return target.path
+        return self.resolve_path(target)
+
     # Navigation Operations.
 
     def change_directory(self, file_path: str) -> None:
@@ -159,20 +197,18 @@ class FileSystemApi:
         :param file_path: The path to check.
         :return: True if the path is valid, False otherwise.
         """
-        try:
-            self.file_system.resolve_path(file_path)
-        except Exception:
-            return False
-
-        return True
+        return self.file_system.exists(file_path)
 
-    def is_directory(self, file_path: str) -> bool:
+    def is_directory(self, file_path: Union[str, FileHandle]) -> bool:
         """
         Checks if the given path is a directory.
 
-        :param file_path: The path to check.
+        :param file_path: The path or handle to check.
         :return: True if the path is a directory, False otherwise.
         """
+        if isinstance(file_path, FileHandle):
+            return self.file_system.get_node(file_path).is_directory
+
         resolved_path = self.resolve_path(file_path)
         return self.file_system.is_directory(resolved_path)
 
@@ -198,152 +234,350 @@ class FileSystemApi:
         self.file_system.create_file(resolved_path, b"")
         self.logger.info("Created empty file at %s", resolved_path)
 
-    def create_file(self, file_path: str, file_data: bytes) -> None:
+    def create_file(
+        self, file_path: str, file_data: bytes, compress: Optional[bool] = None
+    ) -> None:
         """
         Creates a new file with the given data at the specified file path.
 
         :param file_path: The path where the new file will be created.
         :param file_data: The data to be written to the new file.
+        :param compress: Whether to store the file compressed, the default of
+            its directory when omitted.
         """
         if type(file_data) is not bytes:
             raise ValueError("new_data must be of type bytes")
 
         resolved_path = self.resolve_path(file_path)
-        self.file_system.create_file(resolved_path, file_data)
+        self.file_system.create_file(resolved_path, file_data, compress)
         self.logger.info(
             "Created new file at %s with data of length %d",
             resolved_path,
             len(file_data),
         )
 
-    def read_file(self, file_path: str) -> bytes:
+    def create_files(self, dir_path: str, files: Dict[str, bytes]) -> None:
+        """
+        Creates many files in one directory in a single operation.
+
+        :param dir_path: The directory where the new files will be created.
+        :param files: A mapping of file names to the data of each file.
+        """
+        if any(type(file_data) is not bytes for file_data in files.values()):
+            raise ValueError("file data must be of type bytes")
+
+        resolved_path = self.resolve_path(dir_path)
+        self.file_system.create_files(resolved_path, files)
+        self.logger.info("Created %d files in %s", len(files), resolved_path)
+
+    def read_file(self, file_path: Union[str, FileHandle]) -> bytes:
         """
         Reads and returns the contents of the file at the specified file path.
 
-        :param file_path: The path of the file to be read.
+        :param file_path: The path or handle of the file to be read.
         :return: The contents of the file as bytes.
         """
-        if self.is_directory(file_path):
-            raise ValueError(f"The path '{file_path}' is a directory.")
+        handle = self._get_handle(file_path)
+        if self.file_system.get_node(handle).is_directory:
+            raise ValueError(f"The path '{handle.path}' is a directory.")
 
-        resolved_path = self.resolve_path(file_path)
-        data = self.file_system.read_file(resolved_path)
-        self.logger.info(f"Read {resolved_path} with data of length {len(data)}")
+        data = self.file_system.read_file(handle)
+        self.logger.info(f"Read {handle.path} with data of length {len(data)}")
         return data
 
-    def edit_file(self, file_path: str, new_data: bytes) -> None:
+    def set_compression(
+        self, file_path: Union[str, FileHandle], enabled: bool
+    ) -> None:
+        """
+        Turns compression on or off for a file, which is rewritten, or for a
+        directory, which sets the default of what is created in it later.
+
+        :param file_path: The path or handle of the file or directory.
+        :param enabled: Whether to compress.
+        """
+        handle = self._get_handle(file_path)
+        self.file_system.set_compression(handle, enabled)
+        self.logger.info(
+            f"Turned compression {'on' if enabled else 'off'} for {handle.path}"
+        )
+
+    def get_compression_report(self) -> Dict[str, float]:
+        """
+        Returns how much compression saved since the volume was mounted.
+
+        :return: The number of files compressed and skipped, the compression
+            ratio and the throughput of compressing and decompressing in MB/s.
+        """
+        return self.file_system.compressor.report()
+
+    def create_writer(
+        self,
+        file_path: str,
+        size_hint: Optional[int] = None,
+        on_progress: Optional[Callable[[int, Optional[int]], None]] = None,
+    ) -> FileWriter:
+        """
+        Returns a streaming writer that creates a new file from data written in
+        chunks. Blocks are only allocated once the size is known or the writer's
+        buffer fills up, and the file appears when the writer is closed. Call
+        cancel on the writer to discard it instead. Like with create_file, the
+        data is compressed when the directory compresses its files, and stored
+        sparse otherwise when leaving out its holes pays off.
+
+        :param file_path: The path of the new file.
+        :param size_hint: The expected size of the file, used to place it in one
+            contiguous run.
+        :param on_progress: Called after every write with the number of bytes
+            written so far and the size hint.
+        :return: The writer.
+        """
+        resolved_path = self.resolve_path(file_path)
+        if self.exists(resolved_path):
+            raise FileExistsError(f"File '{resolved_path}' already exists.")
+
+        parent_path = os.path.dirname(resolved_path)
+        if not self.exists(parent_path) or not self.is_directory(parent_path):
+            raise FileNotFoundError(f"Directory '{parent_path}' not found.")
+
+        return FileWriter(self.file_system, resolved_path, size_hint, on_progress)
+
+    def open(self, file_path: Union[str, FileHandle], mode: str = "rb") -> FileStream:
+        """
+        Opens a file as a seekable raw binary stream, which can be wrapped in an
+        io.BufferedReader or passed to shutil.copyfileobj.
+
+        :param file_path: The path or handle of the file.
+        :param mode: "rb" to read, "r+b" to read and write, "ab" to append. In
+            append mode the file is created when it does not exist.
+        :return: The stream of the file.
+        """
+        if mode not in FileStream.MODES:
+            raise ValueError(f"Unsupported mode: {mode}")
+
+        if mode == "ab" and isinstance(file_path, str) and not self.exists(file_path):
+            self.create_file(file_path, b"")
+
+        handle = self._get_handle(file_path)
+        self.logger.info(f"Opened {handle.path} in mode {mode}")
+        return FileStream(self.file_system, self.file_system.get_node(handle), mode)
+
+    def edit_file(self, file_path: Union[str, FileHandle], new_data: bytes) -> None:
         """
         Edits the file at the specified file path with the new data provided.
 
-        :param file_path: The path of the file to be edited.
+        :param file_path: The path or handle of the file to be edited.
         :param new_data: The new data to overwrite the existing file content.
         """
-        if self.is_directory(file_path):
-            raise ValueError(f"The path '{file_path}' is a directory.")
+        handle = self._get_handle(file_path)
+        if self.file_system.get_node(handle).is_directory:
+            raise ValueError(f"The path '{handle.path}' is a directory.")
 
         if type(new_data) is not bytes:
             raise ValueError("new_data must be of type bytes")
 
-        resolved_path = self.resolve_path(file_path)
-        self.file_system.edit_file(resolved_path, new_data)
+        self.file_system.edit_file(handle, new_data)
         self.logger.info(
-            f"Edited {resolved_path} with new data of length {len(new_data)}"
+            f"Edited {handle.path} with new data of length {len(new_data)}"
+        )
+
+    def append_file(self, file_path: Union[str, FileHandle], data: bytes) -> int:
+        """
+        Appends data to the end of a file, writing only the bytes appended.
+
+        :param file_path: The path or handle of the file.
+        :param data: The data to append.
+        :return: The number of bytes appended.
+        """
+        if type(data) is not bytes:
+            raise ValueError("data must be of type bytes")
+
+        handle = self._get_handle(file_path)
+        if self.file_system.get_node(handle).is_directory:
+            raise ValueError(f"The path '{handle.path}' is a directory.")
+
+        appended = self.file_system.append_file(handle, data)
+        self.logger.info(f"Appended {appended} bytes to {handle.path}")
+        return appended
+
+    def pread(
+        self, file_path: Union[str, FileHandle], offset: int, length: int
+    ) -> bytes:
+        """
+        Reads part of a file without reading the rest of it.
+
+        :param file_path: The path or handle of the file.
+        :param offset: The byte offset to read from.
+        :param length: The maximum number of bytes to read.
+        :return: The data read, shorter than length at the end of the file.
+        """
+        handle = self._get_handle(file_path)
+        return self.file_system.pread(self.file_system.get_node(handle), offset, length)
+
+    def pwrite(
+        self, file_path: Union[str, FileHandle], offset: int, data: bytes
+    ) -> int:
+        """
+        Overwrites part of a file in place, growing the file when the data goes
+        past its end. Only the blocks the data covers are touched.
+
+        :param file_path: The path or handle of the file.
+        :param offset: The byte offset to write at.
+        :param data: The data to write.
+        :return: The number of bytes written.
+        """
+        if type(data) is not bytes:
+            raise ValueError("data must be of type bytes")
+
+        handle = self._get_handle(file_path)
+        written = self.file_system.pwrite(
+            self.file_system.get_node(handle), offset, data
         )
+        self.logger.info(f"Wrote {written} bytes to {handle.path} at offset {offset}")
+        return written
 
-    def delete_file(self, file_path: str) -> None:
+    def delete_file(self, file_path: Union[str, FileHandle]) -> None:
         """
         Deletes the file at the specified file path.
 
-        :param file_path: The path of the file to be deleted.
+        :param file_path: The path or handle of the file to be deleted.
         """
-        resolved_path = self.resolve_path(file_path)
+        handle = self._get_handle(file_path)
 
-        if self.is_directory(resolved_path):
-            raise ValueError(f"The path '{resolved_path}' is a directory.")
+        if self.file_system.get_node(handle).is_directory:
+            raise ValueError(f"The path '{handle.path}' is a directory.")
 
-        self.file_system.delete_file(resolved_path)
-        self.logger.info(f"Deleted {resolved_path}")
+        self.file_system.delete_file(handle)
+        self.logger.info(f"Deleted {handle.path}")
 
-    def rename_file(self, file_path: str, new_name: str) -> None:
+    def rename_file(self, file_path: Union[str, FileHandle], new_name: str) -> None:
         """
         Renames the file at the specified file path to the new name.
 
-        :param file_path: The current path of the file to be renamed.
+        :param file_path: The current path or handle of the file to be renamed.
         :param new_name: The new name for the file.
         """
-        resolved_path = self.resolve_path(file_path)
-        self.file_system.rename_file(resolved_path, new_name)
-        self.logger.info(f"Renamed {resolved_path} to {new_name}")
+        handle = self._get_handle(file_path)
+        self.file_system.rename_file(handle, new_name)
+        self.logger.info(f"Renamed {handle.path} to {new_name}")
 
-    def move_file(self, file_path: str, new_path: str) -> None:
+    def move_file(
+        self, file_path: Union[str, FileHandle], new_path: Union[str, FileHandle]
+    ) -> None:
         """
         Moves the file from the specified file path to a new path.
 
-        :param file_path: The current path of the file to be moved.
-        :param new_path: The new path where the file will be moved.
+        :param file_path: The current path or handle of the file to be moved.
+        :param new_path: The directory, or its handle, the file will be moved to.
         """
-        resolved_path = self.resolve_path(file_path)
-        resolved_output_path = self.resolve_path(new_path)
+        handle = self._get_handle(file_path)
         resolved_output_path = self.normalize_path(
-            os.path.join(resolved_output_path, os.path.basename(file_path))
+            os.path.join(self._get_path(new_path), os.path.basename(handle.path))
         )
 
-        self.file_system.move_file(resolved_path, resolved_output_path)
-        self.logger.info(f"Moving {file_path} to {new_path}")
+        self.file_system.move_file(handle, resolved_output_path)
+        self.logger.info(f"Moving {handle.path} to {resolved_output_path}")
 
-    def copy_file(self, file_path: str, copy_path: str) -> None:
+    def copy_file(
+        self, file_path: Union[str, FileHandle], copy_path: Union[str, FileHandle]
+    ) -> None:
         """
         Copies the file from the specified file path to a new path.
 
-        :param file_path: The current path of the file to be copied.
-        :param copy_path: The path where the file will be copied to.
+        :param file_path: The current path or handle of the file to be copied.
+        :param copy_path: The directory, or its handle, the file will be copied to.
         """
-        resolved_path = self.resolve_path(file_path)
-        resolved_output_path = self.resolve_path(copy_path)
-
+        handle = self._get_handle(file_path)
         resolved_output_path = self.normalize_path(
-            os.path.join(resolved_output_path, os.path.basename(file_path))
+            os.path.join(self._get_path(copy_path), os.path.basename(handle.path))
         )
 
-        self.file_system.copy_file(resolved_path, resolved_output_path)
-        self.logger.info(f"Copied {resolved_path} to {resolved_output_path}")
+        self.file_system.copy_file(handle, resolved_output_path)
+        self.logger.info(f"Copied {handle.path} to {resolved_output_path}")
 
     # Will create a simple metadata for each file with timecreated, modification date file size etc
 
-    def get_file_metadata(self, file_path: str) -> "FileMetadata":
-        """
-        Returns a dictionary containing metadata for the given file.
-
-        :param file_path: The path of the file to retrieve metadata for.
-        :return: A dictionary containing file metadata.
-        """
-        resolved_path = self.resolve_path(file_path)
-        index_node = self.file_system.resolve_path(resolved_path)
-        file_metadata = FileMetadata(
+    def _build_metadata(self, index_node: FileIndexNode, path: str) -> "FileMetadata":
+        return FileMetadata(
             file_name=index_node.file_name,
-            file_path=resolved_path,
+            file_path=path,
             file_size=self.file_system.config_manager.block_size
             * index_node.file_blocks,
             is_directory=index_node.is_directory,
             children_count=index_node.children_count,
             creation_date=index_node.creation_date,
             modification_date=index_node.modification_date,
+            is_compressed=index_node.is_compressed,
+            is_sparse=index_node.is_sparse,
         )
-        return file_metadata
 
-    def get_file_size(self, file_path: str) -> int:
+    def stat(self, file_path: Union[str, FileHandle]) -> "FileMetadata":
+        """
+        Returns the metadata of a file or directory.
+
+        :param file_path: The path or handle of the file.
+        :return: The metadata of the file.
+        """
+        handle = self._get_handle(file_path)
+        return self._build_metadata(self.file_system.get_node(handle), handle.path)
+
+    def stat_many(self, file_paths: List[str]) -> List[Optional["FileMetadata"]]:
+        """
+        Returns the metadata of several paths. Each distinct parent directory is
+        resolved and read only once.
+
+        :param file_paths: The paths to look up.
+        :return: The metadata of every path in the same order, None for paths
+            that do not exist.
+        """
+        resolved_paths = [self.resolve_path(file_path) for file_path in file_paths]
+        children_by_parent: Dict[str, Optional[Dict[str, FileIndexNode]]] = {}
+
+        results = []
+        for resolved_path in resolved_paths:
+            parent_path, name = os.path.split(resolved_path)
+            if not name:
+                results.append(self.stat(resolved_path))
+                continue
+
+            if parent_path not in children_by_parent:
+                try:
+                    children_by_parent[parent_path] = {
+                        child.file_name: child
+                        for child in self.file_system.scan_directory(parent_path)
+                    }
+                except Exception:
+                    children_by_parent[parent_path] = None
+
+            children = children_by_parent[parent_path]
+            child = children.get(name) if children else None
+            results.append(
+                self._build_metadata(child, resolved_path) if child else None
+            )
+
+        return results
+
+    def get_file_metadata(self, file_path: Union[str, FileHandle]) -> "FileMetadata":
+        """
+        Returns a dictionary containing metadata for the given file.
+
+        :param file_path: The path or handle of the file to retrieve metadata for.
+        :return: A dictionary containing file metadata.
+        """
+        return self.stat(file_path)
+
+    def get_file_size(self, file_path: Union[str, FileHandle]) -> int:
         """
         Returns the size of the file in bytes.
 
-        :param file_path: The path of the file to retrieve size for.
+        :param file_path: The path or handle of the file to retrieve size for.
         :return: The size of the file in bytes.
         """
-        resolved_path = self.resolve_path(file_path)
+        handle = self._get_handle(file_path)
 
-        if self.is_directory(file_path):
+        if self.file_system.get_node(handle).is_directory:
             raise ValueError("Cannot get size of a directory.")
 
-        return self.file_system.get_file_size(resolved_path)
+        return self.file_system.get_file_size(handle)
 
     """
     Directory Operations.
@@ -358,70 +592,147 @@ class FileSystemApi:
         resolved_path = self.resolve_path(dir_path)
         self.file_system.create_directory(resolved_path)
 
-    def list_directory_contents(self, dir_path: str) -> List[str]:
+    def list_directory_contents(
+        self,
+        dir_path: Union[str, FileHandle],
+        start_after: Optional[str] = None,
+        limit: Optional[int] = None,
+    ) -> List[str]:
         """
-        Returns a list of the contents of the given directory.
+        Returns a list of the contents of the given directory. On volumes created
+        with sorted_directories the names are ordered by name.
 
-        :param dir_path: The path of the directory to list contents for.
+        :param dir_path: The path or handle of the directory to list contents for.
+        :param start_after: Only list the names that come after this one.
+        :param limit: The maximum number of names to return.
         :return: A list of the contents of the given directory.
         """
-        resolved_path = self.resolve_path(dir_path)
+        handle = self._get_handle(dir_path)
 
-        if not self.is_directory(resolved_path):
-            raise ValueError(f"The path '{resolved_path}' is not a directory.")
+        if not self.file_system.get_node(handle).is_directory:
+            raise ValueError(f"The path '{handle.path}' is not a directory.")
 
-        files = self.file_system.list_directory_contents(resolved_path)
+        files = self.file_system.list_directory_contents(handle, start_after, limit)
         return files
 
-    def delete_directory(self, dir_path: str) -> None:
+    def scan_directory(
+        self,
+        dir_path: Union[str, FileHandle],
+        start_after: Optional[str] = None,
+        limit: Optional[int] = None,
+    ) -> Iterator["FileMetadata"]:
+        """
+        Yields the metadata of every child of a directory, taken straight from the
+        in-memory index in a single pass.
+
+        :param dir_path: The path or handle of the directory to scan.
+        :param start_after: Only yield the children that come after this name.
+        :param limit: The maximum number of children to yield.
+        :return: An iterator over the metadata of the children.
+        """
+        handle = self._get_handle(dir_path)
+
+        if not self.file_system.get_node(handle).is_directory:
+            raise ValueError(f"The path '{handle.path}' is not a directory.")
+
+        parent_path = handle.path.rstrip("/")
+        for child in self.file_system.scan_directory(handle, start_after, limit):
+            yield self._build_metadata(child, f"{parent_path}/{child.file_name}")
+
+    def list_page(
+        self,
+        dir_path: Union[str, FileHandle],
+        cursor: Optional[str] = None,
+        limit: int = FileSystem.PAGE_SIZE,
+    ) -> Tuple[List["FileMetadata"], Optional[str]]:
+        """
+        Returns one page of the children of a directory with their metadata.
+
+        :param dir_path: The path or handle of the directory.
+        :param cursor: The opaque cursor returned with the previous page, None to
+            start from the beginning.
+        :param limit: The maximum number of children in the page.
+        :return: The metadata of the page and the cursor of the next page, None
+            once every child has been returned.
+        """
+        handle = self._get_handle(dir_path)
+        children, next_cursor = self.file_system.list_page(handle, cursor, limit)
+
+        parent_path = handle.path.rstrip("/")
+        page = [
+            self._build_metadata(child, f"{parent_path}/{child.file_name}")
+            for child in children
+        ]
+        return page, next_cursor
+
+    def iter_directory(
+        self, dir_path: Union[str, FileHandle], limit: int = FileSystem.PAGE_SIZE
+    ) -> Iterator["FileMetadata"]:
+        """
+        Yields the metadata of the children of a directory one page at a time, so
+        the first children are available before the rest of the directory is read.
+
+        :param dir_path: The path or handle of the directory.
+        :param limit: The number of children read per page.
+        :return: An iterator over the metadata of the children.
+        """
+        handle = self._get_handle(dir_path)
+        cursor = None
+        while True:
+            page, cursor = self.list_page(handle, cursor, limit)
+            yield from page
+            if cursor is None:
+                return
+
+    def delete_directory(self, dir_path: Union[str, FileHandle]) -> None:
         """
         Deletes a directory in the filesystem.
 
-        :param dir_path: The path of the directory to delete.
+        :param dir_path: The path or handle of the directory to delete.
         """
-        resolved_path = self.resolve_path(dir_path)
+        handle = self._get_handle(dir_path)
 
-        if not self.is_directory(resolved_path):
-            raise ValueError(f"The path '{resolved_path}' is not a directory.")
+        if not self.file_system.get_node(handle).is_directory:
+            raise ValueError(f"The path '{handle.path}' is not a directory.")
 
-        self.file_system.delete_directory(resolved_path)
+        self.file_system.delete_directory(handle)
 
-    def rename_directory(self, dir_path: str, new_name: str) -> None:
+    def rename_directory(self, dir_path: Union[str, FileHandle], new_name: str) -> None:
         """
         Renames a directory in the filesystem.
 
-        :param dir_path: The current path of the directory to be renamed.
+        :param dir_path: The current path or handle of the directory to be renamed.
         :param new_name: The new name for the directory.
         """
-        resolved_path = self.resolve_path(dir_path)
-        self.file_system.rename_file(resolved_path, new_name)
+        self.file_system.rename_file(self._get_handle(dir_path), new_name)
 
-    def move_directory(self, dir_path: str, new_path: str) -> None:
+    def move_directory(
+        self, dir_path: Union[str, FileHandle], new_path: Union[str, FileHandle]
+    ) -> None:
         """
         Moves a directory in the filesystem.
 
-        :param dir_path: The current path of the directory to be moved.
-        :param new_path: The new path where the directory will be moved.
+        :param dir_path: The current path or handle of the directory to be moved.
+        :param new_path: The directory, or its handle, it will be moved into.
         """
-        resolved_path = self.resolve_path(dir_path)
-        resolved_output_path = self.resolve_path(new_path)
+        handle = self._get_handle(dir_path)
         resolved_output_path = self.normalize_path(
-            os.path.join(resolved_output_path, os.path.basename(new_path))
+            os.path.join(self._get_path(new_path), os.path.basename(handle.path))
         )
-        self.file_system.move_file(resolved_path, resolved_output_path)
+        self.file_system.move_file(handle, resolved_output_path)
 
-    def copy_directory(self, dir_path: str, copy_path: str) -> None:
+    def copy_directory(
+        self, dir_path: Union[str, FileHandle], copy_path: Union[str, FileHandle]
+    ) -> None:
         """
         Copies a directory in the filesystem.
 
-        :param dir_path: The current path of the directory to be copied.
-        :param copy_path: The path where the directory will be copied to.
+        :param dir_path: The current path or handle of the directory to be copied.
+        :param copy_path: The directory, or its handle, it will be copied into.
         """
-        resolved_path = self.resolve_path(dir_path)
-        resolved_output_path = self.resolve_path(copy_path)
-
+        resolved_path = self._get_path(dir_path)
         resolved_output_path = self.normalize_path(
-            os.path.join(resolved_output_path, os.path.basename(dir_path))
+            os.path.join(self._get_path(copy_path), os.path.basename(resolved_path))
         )
 
         self.file_system.copy_directory(resolved_path, resolved_output_path)
@@ -442,6 +753,8 @@ class FileSystemApi:
             children_count=index_node.children_count,
             creation_date=index_node.creation_date,
             modification_date=index_node.modification_date,
+            is_compressed=index_node.is_compressed,
+            is_sparse=index_node.is_sparse,
         )
         return folder_metadata
 
@@ -499,6 +812,18 @@ class FileSystemApi:
         """
         return self.file_system.config_manager.file_system_size
 
+    def grow(self, new_size: int, new_index_size: Optional[int] = None) -> None:
+        """
+        Grows the filesystem in place while it stays mounted, without moving any
+        file data.
+
+        :param new_size: The new total amount of space in bytes.
+        :param new_index_size: The new size of the file index in bytes, which
+            bounds the number of files, kept when omitted.
+        """
+        self.file_system.grow(new_size, new_index_size)
+        self.logger.info("Grew the file system to %d bytes", self.get_total_space())
+
     def get_fragmentation_percentage(self) -> float:
         """
         Calculates the percentage of free space that is fragmented.
@@ -507,6 +832,31 @@ class FileSystemApi:
         """
         return self.file_system.calculate_fragmentation()
 
+    def deduplicate(self) -> Dict[str, int]:
+        """
+        Makes files with identical data share their blocks, for volumes that
+        already hold copies. Files created while the volume's dedup setting is
+        on are deduplicated as they are written.
+
+        :return: The number of extents freed and the bytes they held.
+        """
+        result = self.file_system.deduplicate()
+        self.logger.info(
+            "Deduplication freed %d extents, %d bytes",
+            result["extents_freed"],
+            result["bytes_saved"],
+        )
+        return result
+
+    def get_dedup_report(self) -> Dict[str, float]:
+        """
+        Returns how much deduplication saved since the volume was mounted.
+
+        :return: The files deduplicated, the bytes saved, the number of digests
+            in the index and the hashing throughput in MB/s.
+        """
+        return self.file_system.dedup_manager.report()
+
     def defragmentation(self) -> None:
         """
         Defragments the filesystem. This is a blocking operation and will take a
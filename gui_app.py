@@ -14,6 +14,7 @@ from typing import Callable, List, Optional
 from tkinterdnd2 import TkinterDnD, DND_FILES
 from PIL import Image, ImageTk
 from file_system_api import FileSystemApi
+from structs.file_handle import FileHandle
 
 
 def apply_syntax_highlighting(text_widget):
@@ -139,6 +140,7 @@ class MainGUI:
         self.history_index = -1
         self.copy_buffer: Optional[str] = None
         self.copy_buffer_mode: Optional[str] = None
+        self.pending_page: Optional[str] = None
 
         self.root = TkinterDnD.Tk()
         self.root.title("GUI File Explorer")
@@ -247,13 +249,47 @@ class MainGUI:
         clean_path = file_path.strip("{}")
         file_name = os.path.basename(clean_path)
         normalized_path = os.path.normpath(clean_path)
-        with open(normalized_path, "rb") as f:
-            file_data = f.read()
-
-        self.client.create_file(file_name, file_data)
+        self._import_file(normalized_path, file_name)
         self.load_directory(self.client.current_directory)
         print(f"File dropped: {file_path}")
 
+    def _import_file(self, host_path: str, file_name: str) -> None:
+        """
+        Streams a file from the host into the file system in chunks, showing a
+        progress window with a button to cancel the import.
+
+        :param host_path: The path of the file on the host.
+        :param file_name: The name of the new file in the current directory.
+        """
+        window = tk.Toplevel(self.root)
+        window.title(f"Importing {file_name}")
+        progress_bar = ttk.Progressbar(window, length=300, maximum=1.0)
+        progress_bar.pack(padx=10, pady=10)
+        cancelled = tk.BooleanVar(value=False)
+        tk.Button(window, text="Cancel", command=lambda: cancelled.set(True)).pack(
+            pady=5
+        )
+        set_window_to_center(window)
+
+        writer = self.client.create_writer(
+            file_name, size_hint=os.path.getsize(host_path)
+        )
+        try:
+            with open(host_path, "rb") as f:
+                for chunk in iter(lambda: f.read(writer.BUFFER_SIZE), b""):
+                    writer.write(chunk)
+                    progress_bar["value"] = writer.progress or 0
+                    window.update()
+                    if cancelled.get():
+                        writer.cancel()
+                        return
+            writer.close()
+        except Exception:
+            writer.cancel()
+            raise
+        finally:
+            window.destroy()
+
     def paste_buffer(self) -> None:
         """
         Pastes the contents of the copy buffer into the current directory.
@@ -277,16 +313,18 @@ class MainGUI:
             self._move_item()
 
     def _copy_item(self) -> None:
-        if self.client.is_directory(self.copy_buffer):
-            self.client.copy_directory(self.copy_buffer, self.client.current_directory)
+        handle = self.client.lookup(self.copy_buffer)
+        if self.client.is_directory(handle):
+            self.client.copy_directory(handle, self.client.current_directory)
         else:
-            self.client.copy_file(self.copy_buffer, self.client.current_directory)
+            self.client.copy_file(handle, self.client.current_directory)
 
     def _move_item(self) -> None:
-        if self.client.is_directory(self.copy_buffer):
-            self.client.move_directory(self.copy_buffer, self.client.current_directory)
+        handle = self.client.lookup(self.copy_buffer)
+        if self.client.is_directory(handle):
+            self.client.move_directory(handle, self.client.current_directory)
         else:
-            self.client.move_file(self.copy_buffer, self.client.current_directory)
+            self.client.move_file(handle, self.client.current_directory)
 
     def move(self) -> None:
         self._set_copy_buffer("move")
@@ -308,7 +346,8 @@ class MainGUI:
             messagebox.showwarning("No Selection", "Please select a file to save.")
             return
 
-        if self.client.is_directory(file_name):
+        file_handle = self.client.lookup(file_name)
+        if self.client.is_directory(file_handle):
             messagebox.showwarning("Invalid File", "Selected item is not a file.")
             return
 
@@ -322,9 +361,18 @@ class MainGUI:
 
         if file_path:
             try:
-                file_data = self.client.read_file(file_name)
-                with open(file_path, "wb") as f:
-                    f.write(file_data)
+                with self.client.open(file_handle) as source, open(
+                    file_path, "wb"
+                ) as f:
+                    # Holes are seeked over, so they stay holes on disk
+                    for start, end in source.data_ranges():
+                        source.seek(start)
+                        f.seek(start)
+                        while start < end:
+                            chunk = source.read(min(end - start, 1024 * 1024))
+                            f.write(chunk)
+                            start += len(chunk)
+                    f.truncate(source.seek(0, io.SEEK_END))
                 messagebox.showinfo("Success", f"File saved to {file_path}")
             except Exception as e:
                 messagebox.showerror("Error", f"Failed to save file: {str(e)}")
@@ -344,10 +392,11 @@ class MainGUI:
     def _delete_item(self) -> None:
         selected_item = self.tree.selection()[0]
         item_values = self.tree.item(selected_item, "values")
-        if not self.client.is_directory(item_values[0]):
-            self.client.delete_file(item_values[0])
+        handle = self.client.lookup(item_values[0])
+        if not self.client.is_directory(handle):
+            self.client.delete_file(handle)
         else:
-            self.client.delete_directory(item_values[0])
+            self.client.delete_directory(handle)
 
     def on_tree_click(self, event: tk.Event) -> None:
         item = self.tree.identify_row(event.y)
@@ -390,14 +439,15 @@ class MainGUI:
         if file_extension == ".py":
             text.bind("<<Modified>>", lambda event: self.on_text_modified(text))
 
-        text.insert(tk.END, self.client.read_file(file_path).decode())
+        file_handle = self.client.lookup(file_path)
+        text.insert(tk.END, self.client.read_file(file_handle).decode())
         if file_extension == ".py":
             apply_syntax_highlighting(text)
         set_window_to_center(file_window)
 
         file_window.protocol(
             "WM_DELETE_WINDOW",
-            lambda: self._close_file_window(file_window, text, file_path),
+            lambda: self._close_file_window(file_window, text, file_handle),
         )
 
     def on_text_modified(self, text_widget):
@@ -406,35 +456,37 @@ class MainGUI:
         apply_syntax_highlighting(text_widget)
 
     def _close_file_window(
-        self, file_window: tk.Tk, text: tk.Text, file_path: str
+        self, file_window: tk.Tk, text: tk.Text, file_handle: "FileHandle"
     ) -> None:
         """
         Closes the file window, optionally saving changes.
 
         :param file_window: The Tkinter window displaying the file contents.
         :param text: The Tkinter Text widget containing the file content.
-        :param file_path: The path of the file being edited.
+        :param file_handle: The handle of the file being edited.
         """
         if (
             text.get("1.0", tk.END).strip()
-            != self.client.read_file(file_path).decode().strip()
+            != self.client.read_file(file_handle).decode().strip()
         ):
             if messagebox.askokcancel(
                 "Save changes?", "Do you want to save changes to the file?"
             ):
-                self.save_file(file_window, text, file_path)
+                self.save_file(file_window, text, file_handle)
         file_window.destroy()
 
-    def save_file(self, file_window: tk.Tk, text_box: tk.Text, file_path: str) -> None:
+    def save_file(
+        self, file_window: tk.Tk, text_box: tk.Text, file_handle: "FileHandle"
+    ) -> None:
         """
         Saves the changes to a file and closes the file window.
 
         :param file_window: The window containing the file text box.
         :param text_box: The text box with the file content.
-        :param file_path: The path of the file to be saved.
+        :param file_handle: The handle of the file to be saved.
         :return: None
         """
-        self.client.edit_file(file_path, text_box.get("1.0", tk.END).encode())
+        self.client.edit_file(file_handle, text_box.get("1.0", tk.END).encode())
         file_window.destroy()
 
     def create_folder(self) -> None:
@@ -531,9 +583,21 @@ class MainGUI:
         :param path: The path of the directory to populate in the tree view.
         """
         self.tree.delete(*self.tree.get_children())
-        items = self.client.list_directory_contents(path)
-        for item in items:
-            details = self.client.get_file_metadata(os.path.join(path, item))
+        if self.pending_page:
+            self.root.after_cancel(self.pending_page)
+            self.pending_page = None
+        self._insert_page(self.client.lookup(path), None)
+
+    def _insert_page(self, dir_handle: FileHandle, cursor: Optional[str]) -> None:
+        """
+        Inserts one page of a directory into the tree view and schedules the next
+        one, so the first rows show up without waiting for the whole directory.
+
+        :param dir_handle: The handle of the directory being listed.
+        :param cursor: The cursor of the page to insert, None for the first page.
+        """
+        page, cursor = self.client.list_page(dir_handle, cursor)
+        for details in page:
             self.tree.insert(
                 "",
                 "end",
@@ -545,6 +609,12 @@ class MainGUI:
                 ),
             )
 
+        self.pending_page = None
+        if cursor is not None:
+            self.pending_page = self.root.after(
+                1, self._insert_page, dir_handle, cursor
+            )
+
     def _update_history(self, path) -> None:
         """
         Updates the history of directories visited.
@@ -1,33 +1,90 @@
-from typing import BinaryIO, Iterable, Optional
+from typing import Iterable, Iterator, List, Optional, Tuple
 import logging
+import re
+
+from core.storage_backend import StorageBackend
+
+# Used to skip over whole bytes of free or used blocks when scanning the bitmap
+_NOT_FREE_BYTE = re.compile(b"[^\\x00]")
+_NOT_USED_BYTE = re.compile(b"[^\\xff]")
 
 
 class BitmapManager:
+    """
+    Tracks which blocks of a region are used, one bit per block.
+
+    The bitmap of the large block region of a volume has a bit for every
+    blocks_per_bit blocks starting at first_block, while its methods still take
+    and return blocks numbered like everywhere else. A range then covers the
+    bits whose first block is in it, so extents always start on a bit and the
+    rest of their last bit belongs to them.
+
+    Blocks can also be reserved, which marks them as used in memory only. They
+    are not handed out again, but stay free in the image until mark_range
+    commits them or free_range gives them back, so a crash never leaks them.
+    """
+
     def __init__(
         self,
-        fs: BinaryIO,
+        storage: StorageBackend,
         num_blocks: int,
         block_size: int,
         bitmap_size: int,
         logger: "logging.Logger" = None,
+        offset: int = 0,
+        first_block: int = 0,
+        blocks_per_bit: int = 1,
     ):
-        self.fs = fs
+        """
+        :param storage: The image the bitmap is stored in.
+        :param num_blocks: The number of bits.
+        :param block_size: The size of the blocks a bit stands for.
+        :param bitmap_size: The size of the bitmap in bytes.
+        :param logger: Logs the blocks marked and freed one by one.
+        :param offset: Where the bitmap starts in the image.
+        :param first_block: The block of the first bit.
+        :param blocks_per_bit: How many blocks a bit stands for.
+        """
+        self.storage = storage
         self.num_blocks = num_blocks
         self.block_size = block_size
         self.logger = logger
         self.bitmap_size = bitmap_size
+        self.offset = offset
+        self.first_block = first_block
+        self.blocks_per_bit = blocks_per_bit
         self.load()
 
     def load(self):
-        self.fs.seek(0)
-        self.bitmap = bytearray(self.fs.read(self.bitmap_size))
+        self.bitmap = bytearray(self.storage.read_at(self.offset, self.bitmap_size))
+        # The bits of reserved blocks, None while nothing was ever reserved
+        self.reserved: Optional[bytearray] = None
+
+    def contains(self, block: int) -> bool:
+        return (
+            self.first_block
+            <= block
+            < self.first_block + self.num_blocks * self.blocks_per_bit
+        )
+
+    def _bits(self, start_block: int, count: int) -> Tuple[int, int]:
+        """Returns the first bit and the number of bits of a range of blocks."""
+        first_bit = -(-(start_block - self.first_block) // self.blocks_per_bit)
+        end_bit = -(-(start_block + count - self.first_block) // self.blocks_per_bit)
+        return first_bit, max(0, end_bit - first_bit)
 
     def mark_used(self, block: int):
-        byte_index = block // 8
-        bit_index = block % 8
+        bit, count = self._bits(block, 1)
+        if not count:
+            return
+        byte_index = bit // 8
+        bit_index = bit % 8
         self.bitmap[byte_index] |= 1 << bit_index
-        self.fs.seek(byte_index)
-        self.fs.write(bytes([self.bitmap[byte_index]]))
+        if self.reserved is not None:
+            self.reserved[byte_index] &= ~(1 << bit_index)
+        self.storage.write_at(
+            self.offset + byte_index, self._stored_bytes(byte_index, byte_index)
+        )
 
     def mark_blocks(self, blocks: Iterable[int], margin: Optional[int] = 0):
         if self.logger:
@@ -36,10 +93,20 @@ class BitmapManager:
         for block in blocks:
             self.mark_used(margin + block)
 
+    def mark_range(self, start_block: int, count: int) -> None:
+        """Marks count blocks starting at start_block as used with a single write."""
+        self._set_range(*self._bits(start_block, count), True)
+
     def free_block(self, block_number: int) -> None:
-        self.bitmap[block_number // 8] &= ~(1 << (block_number % 8))
-        self.fs.seek(block_number // 8)
-        self.fs.write(bytes([self.bitmap[block_number % 8]]))
+        bit, count = self._bits(block_number, 1)
+        if not count:
+            return
+        self.bitmap[bit // 8] &= ~(1 << (bit % 8))
+        if self.reserved is not None:
+            self.reserved[bit // 8] &= ~(1 << (bit % 8))
+        self.storage.write_at(
+            self.offset + bit // 8, self._stored_bytes(bit // 8, bit // 8)
+        )
         # self.fs.seek(block_number * self.block_size)
         # self.fs.write(b"\0" * self.block_size)
 
@@ -50,34 +117,296 @@ class BitmapManager:
         for block in blocks:
             self.free_block(margin + block)
 
-    def find_free_space_bitmap(self, required_blocks):
-        free_blocks = []
-        start_index = -1
-        count = 0
-        # Blocks info are stored as a bit in the bytes
-        # Each byte has 8 blocks
-        for i in range(self.num_blocks):
-            byte_index = i // 8
-            bit_index = i % 8
-
-            if not self.bitmap[byte_index] & (1 << bit_index):
-                if count == 0:
-                    start_index = i
-                count += 1
-
-                if count == required_blocks:
-                    free_blocks = list(
-                        range(start_index, start_index + required_blocks)
-                    )
-                    break
+    def free_range(self, start_block: int, count: int) -> None:
+        """Marks count blocks starting at start_block as free with a single write."""
+        self._set_range(*self._bits(start_block, count), False)
+
+    def reserve_range(self, start_block: int, count: int) -> None:
+        """
+        Marks count blocks starting at start_block as used in memory only, so
+        they are not handed out again while they stay free in the image.
+        """
+        start_bit, bits = self._bits(start_block, count)
+        if self.reserved is None:
+            self.reserved = bytearray(len(self.bitmap))
+        for bit in range(start_bit, start_bit + bits):
+            self.bitmap[bit // 8] |= 1 << (bit % 8)
+            self.reserved[bit // 8] |= 1 << (bit % 8)
+
+    def iter_reserved_runs(self) -> Iterator[Tuple[int, int]]:
+        """Yields (start_block, length) for every run of reserved blocks."""
+        if self.reserved is None:
+            return
+
+        run_start = None
+        run_end = None
+        for match in _NOT_FREE_BYTE.finditer(self.reserved):
+            byte = self.reserved[match.start()]
+            for bit_index in range(8):
+                if not byte & (1 << bit_index):
+                    continue
+                bit = match.start() * 8 + bit_index
+                if bit != run_end:
+                    if run_start is not None:
+                        yield self._run_blocks(run_start, run_end)
+                    run_start = bit
+                run_end = bit + 1
+        if run_start is not None:
+            yield self._run_blocks(run_start, run_end)
+
+    def _run_blocks(self, start_bit: int, end_bit: int) -> Tuple[int, int]:
+        return (
+            self.first_block + start_bit * self.blocks_per_bit,
+            (end_bit - start_bit) * self.blocks_per_bit,
+        )
+
+    def is_range_free(self, start_block: int, count: int) -> bool:
+        start_bit, bits = self._bits(start_block, count)
+        if start_block < self.first_block or start_bit + bits > self.num_blocks:
+            return False
+
+        return not any(
+            self.bitmap[bit // 8] & (1 << (bit % 8))
+            for bit in range(start_bit, start_bit + bits)
+        )
+
+    def _set_range(self, start_bit: int, bits: int, used: bool) -> None:
+        if bits <= 0:
+            return
+
+        for bit in range(start_bit, start_bit + bits):
+            if used:
+                self.bitmap[bit // 8] |= 1 << (bit % 8)
             else:
-                start_index = -1
-                count = 0
+                self.bitmap[bit // 8] &= ~(1 << (bit % 8))
+            if self.reserved is not None:
+                self.reserved[bit // 8] &= ~(1 << (bit % 8))
+
+        first_byte = start_bit // 8
+        last_byte = (start_bit + bits - 1) // 8
+        self.storage.write_at(
+            self.offset + first_byte, self._stored_bytes(first_byte, last_byte)
+        )
+
+    def _stored_bytes(self, first_byte: int, last_byte: int) -> bytes:
+        """Returns bytes of the bitmap as stored, where reserved blocks are free."""
+        data = bytes(self.bitmap[first_byte : last_byte + 1])
+        if self.reserved is None:
+            return data
+
+        mask = self.reserved[first_byte : last_byte + 1]
+        stored = int.from_bytes(data, "little") & ~int.from_bytes(mask, "little")
+        return stored.to_bytes(len(data), "little")
+
+    def iter_free_runs(self) -> Iterator[Tuple[int, int]]:
+        """
+        Yields (start_block, length) for every run of free blocks in block order.
+        """
+        for start_bit, bits in self._iter_free_bit_runs():
+            yield (
+                self.first_block + start_bit * self.blocks_per_bit,
+                bits * self.blocks_per_bit,
+            )
+
+    def _iter_free_bit_runs(self) -> Iterator[Tuple[int, int]]:
+        """
+        Yields (start_bit, length) for every run of free bits. Whole free or used
+        bytes are skipped without looking at their bits.
+        """
+        size = len(self.bitmap)
+        run_start = None
+        position = 0
+
+        while position < size:
+            byte = self.bitmap[position]
+
+            if byte == 0x00:
+                if run_start is None:
+                    run_start = position * 8
+                match = _NOT_FREE_BYTE.search(self.bitmap, position)
+                position = match.start() if match else size
+                continue
+
+            if byte == 0xFF:
+                if run_start is not None:
+                    yield run_start, position * 8 - run_start
+                    run_start = None
+                match = _NOT_USED_BYTE.search(self.bitmap, position)
+                position = match.start() if match else size
+                continue
+
+            for bit_index in range(8):
+                bit = position * 8 + bit_index
+                if byte & (1 << bit_index):
+                    if run_start is not None:
+                        yield run_start, bit - run_start
+                        run_start = None
+                elif run_start is None:
+                    run_start = bit
+            position += 1
+
+        if run_start is not None:
+            yield run_start, min(size * 8, self.num_blocks) - run_start
+
+    def find_free_space_bitmap(self, required_blocks):
+        for start_index, length in self.iter_free_runs():
+            if length >= required_blocks:
+                return list(range(start_index, start_index + required_blocks))
+
+        raise Exception("No continuous free space available.")
+
+    def find_free_space_for_files(self, blocks_per_file: List[int]) -> List[int]:
+        """
+        Places several files in one pass over the bitmap. Files are laid out back
+        to back in the order given, moving on to the next free run whenever the
+        next file does not fit in what is left of the current one.
+
+        :param blocks_per_file: The number of blocks each file needs.
+        :return: The start block of every file.
+        """
+        start_blocks = []
+        if not blocks_per_file:
+            return start_blocks
+
+        for run_start, run_length in self.iter_free_runs():
+            while (
+                len(start_blocks) < len(blocks_per_file)
+                and blocks_per_file[len(start_blocks)] <= run_length
+            ):
+                # The next file starts on a bit of its own
+                bits = -(-blocks_per_file[len(start_blocks)] // self.blocks_per_bit)
+                start_blocks.append(run_start)
+                run_start += bits * self.blocks_per_bit
+                run_length -= bits * self.blocks_per_bit
+
+            if len(start_blocks) == len(blocks_per_file):
+                return start_blocks
+
+        raise Exception("No continuous free space available.")
+
+    def get_free_blocks_count(self):
+        return self.bitmap.count(0) * 8 * self.blocks_per_bit
+
+
+class SizeClassBitmap:
+    """
+    The bitmaps of a volume with a small and a large block region, behind the
+    interface of BitmapManager. Blocks are numbered in small blocks across both
+    regions, so an extent is read and written the same way wherever it is.
+    Runs of at least large_run_blocks are looked for in the large region and
+    smaller ones in the small region, falling back to the other region when
+    the first one has no room, and blocks are marked and freed in the region
+    they are in.
+    """
+
+    def __init__(
+        self, small: BitmapManager, large: BitmapManager, large_run_blocks: int
+    ) -> None:
+        self.small = small
+        self.large = large
+        self.large_run_blocks = large_run_blocks
+
+    def load(self) -> None:
+        self.small.load()
+        self.large.load()
+
+    def region_of(self, block: int) -> BitmapManager:
+        return self.large if self.large.contains(block) else self.small
+
+    def regions_for(self, blocks: int) -> Tuple[BitmapManager, BitmapManager]:
+        """Returns the region a run of blocks belongs in, then the other one."""
+        if blocks >= self.large_run_blocks:
+            return self.large, self.small
+        return self.small, self.large
+
+    def mark_used(self, block: int) -> None:
+        self.region_of(block).mark_used(block)
+
+    def mark_blocks(self, blocks: Iterable[int], margin: Optional[int] = 0):
+        for block in blocks:
+            self.mark_used(margin + block)
+
+    def mark_range(self, start_block: int, count: int) -> None:
+        self.region_of(start_block).mark_range(start_block, count)
+
+    def reserve_range(self, start_block: int, count: int) -> None:
+        self.region_of(start_block).reserve_range(start_block, count)
+
+    def iter_reserved_runs(self) -> Iterator[Tuple[int, int]]:
+        yield from self.small.iter_reserved_runs()
+        yield from self.large.iter_reserved_runs()
+
+    def free_block(self, block_number: int) -> None:
+        self.region_of(block_number).free_block(block_number)
+
+    def free_blocks(self, blocks: Iterable[int], margin: Optional[int] = 0):
+        for block in blocks:
+            self.free_block(margin + block)
+
+    def free_range(self, start_block: int, count: int) -> None:
+        self.region_of(start_block).free_range(start_block, count)
+
+    def is_range_free(self, start_block: int, count: int) -> bool:
+        # Only an extent at the end of the small region is followed by the
+        # first large block, and extents never span both regions
+        if start_block == self.large.first_block:
+            return False
+        return self.region_of(start_block).is_range_free(start_block, count)
+
+    def iter_free_runs(self) -> Iterator[Tuple[int, int]]:
+        yield from self.small.iter_free_runs()
+        yield from self.large.iter_free_runs()
+
+    def find_free_space_bitmap(self, required_blocks):
+        for region in self.regions_for(required_blocks):
+            try:
+                return region.find_free_space_bitmap(required_blocks)
+            except Exception:
+                continue
+
+        raise Exception("No continuous free space available.")
+
+    def find_free_space_for_files(self, blocks_per_file: List[int]) -> List[int]:
+        """
+        Places several files, each in the region of its size, with one pass over
+        each bitmap.
 
-        if len(free_blocks) < required_blocks:
-            raise Exception("No continuous free space available.")
+        :param blocks_per_file: The number of blocks each file needs.
+        :return: The start block of every file.
+        """
+        regions = (self.small, self.large)
+        indexes_by_region = [
+            [
+                i
+                for i, blocks in enumerate(blocks_per_file)
+                if self.regions_for(blocks)[0] is region
+            ]
+            for region in regions
+        ]
+        try:
+            placements = [
+                (
+                    indexes,
+                    region.find_free_space_for_files(
+                        [blocks_per_file[i] for i in indexes]
+                    ),
+                )
+                for region, indexes in zip(regions, indexes_by_region)
+            ]
+        except Exception:
+            # Without room in its own region the whole batch goes to one region
+            for region in (self.large, self.small):
+                try:
+                    return region.find_free_space_for_files(blocks_per_file)
+                except Exception:
+                    continue
+            raise
 
-        return free_blocks
+        start_blocks = [0] * len(blocks_per_file)
+        for indexes, placed in placements:
+            for i, start_block in zip(indexes, placed):
+                start_blocks[i] = start_block
+        return start_blocks
 
     def get_free_blocks_count(self):
-        return self.bitmap.count(0) * 8
+        return self.small.get_free_blocks_count() + self.large.get_free_blocks_count()
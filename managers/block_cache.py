@@ -0,0 +1,305 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, List, Optional, Sequence, Set
+
+from core.storage_backend import StorageBackend
+
+
+class ArcCache:
+    """
+    Adaptive replacement cache. Pages seen once live in t1 and pages seen again
+    move to t2, while b1 and b2 remember recently evicted pages of each list so
+    the split between recency and frequency adapts to the workload. A single
+    scan through cold pages can only flush t1, never the frequently used t2.
+    """
+
+    def __init__(
+        self, capacity: int, on_evict: Callable[[int, bytearray], None]
+    ) -> None:
+        self.capacity = capacity
+        self.on_evict = on_evict
+        self.target_t1 = 0.0
+
+        self.t1: "OrderedDict[int, bytearray]" = OrderedDict()
+        self.t2: "OrderedDict[int, bytearray]" = OrderedDict()
+        self.b1: "OrderedDict[int, None]" = OrderedDict()
+        self.b2: "OrderedDict[int, None]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.t1) + len(self.t2)
+
+    def __contains__(self, page: int) -> bool:
+        return page in self.t1 or page in self.t2
+
+    def peek(self, page: int) -> Optional[bytearray]:
+        """Returns a cached page without counting it as a use."""
+        if page in self.t1:
+            return self.t1[page]
+        return self.t2.get(page)
+
+    def get(self, page: int) -> Optional[bytearray]:
+        data = self.t2.get(page)
+        if data is not None:
+            self.t2.move_to_end(page)
+            return data
+
+        data = self.t1.pop(page, None)
+        if data is not None:
+            self.t2[page] = data
+        return data
+
+    def put(self, page: int, data: bytearray) -> None:
+        """Adds a page that is not cached yet."""
+        if page in self.b1:
+            self.target_t1 = min(
+                self.capacity,
+                self.target_t1 + max(len(self.b2) / len(self.b1), 1),
+            )
+            self._replace(page)
+            del self.b1[page]
+            self.t2[page] = data
+            return
+
+        if page in self.b2:
+            self.target_t1 = max(
+                0.0, self.target_t1 - max(len(self.b1) / len(self.b2), 1)
+            )
+            self._replace(page)
+            del self.b2[page]
+            self.t2[page] = data
+            return
+
+        if len(self.t1) + len(self.b1) >= self.capacity:
+            if len(self.t1) < self.capacity:
+                self.b1.popitem(last=False)
+                self._replace(page)
+            else:
+                self._evict(*self.t1.popitem(last=False))
+        elif len(self.t1) + len(self.t2) + len(self.b1) + len(self.b2) >= self.capacity:
+            if len(self.t1) + len(self.t2) + len(self.b1) + len(self.b2) >= (
+                2 * self.capacity
+            ):
+                self.b2.popitem(last=False)
+            self._replace(page)
+        self.t1[page] = data
+
+    def _replace(self, page: int) -> None:
+        if len(self) < self.capacity:
+            return
+
+        if self.t1 and (
+            len(self.t1) > self.target_t1
+            or (page in self.b2 and len(self.t1) == self.target_t1)
+        ):
+            evicted, data = self.t1.popitem(last=False)
+            self.b1[evicted] = None
+        else:
+            evicted, data = self.t2.popitem(last=False)
+            self.b2[evicted] = None
+        self._evict(evicted, data)
+
+    def _evict(self, page: int, data: bytearray) -> None:
+        self.on_evict(page, data)
+
+    def clear(self) -> None:
+        for ordered in (self.t1, self.t2, self.b1, self.b2):
+            ordered.clear()
+        self.target_t1 = 0.0
+
+
+class BlockCache(StorageBackend):
+    """
+    A page cache between the file system and its storage backend. The image is
+    cached in PAGE_SIZE pages evicted with ARC. Writes update the cached pages
+    and are written back when the volume syncs, which happens on every commit,
+    or when a dirty page is evicted. With "sync" durability writes go straight
+    through to the backend as well, so nothing is ever only in the cache.
+
+    The cache can be shared by threads. Missing pages are read without holding
+    its lock, so reads that miss run in parallel.
+    """
+
+    PAGE_SIZE = 4096
+
+    def __init__(self, backend: StorageBackend, cache_size: int) -> None:
+        super().__init__(backend.path, backend.durability)
+        self.backend = backend
+        self.write_through = backend.durability == "sync"
+        # The backend syncs through its own group commit
+        self.release_group_commit()
+        self.size = os.path.getsize(backend.path)
+
+        self.pages = ArcCache(
+            max(1, cache_size // self.PAGE_SIZE), self._write_back
+        )
+        self.dirty: Set[int] = set()
+        self.lock = threading.Lock()
+        # Bumped by every write, pages read while it changed may be stale
+        self._generation = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.write_backs = 0
+
+    @property
+    def closed(self) -> bool:
+        return self.backend.closed
+
+    def read_at(self, offset: int, size: int) -> bytearray:
+        if size <= 0:
+            return bytearray()
+
+        first_page, start = divmod(offset, self.PAGE_SIZE)
+        last_page = (offset + size - 1) // self.PAGE_SIZE
+        if first_page == last_page:
+            with self.lock:
+                cached = self.pages.get(first_page)
+                if cached is not None:
+                    self.hits += 1
+                    return cached[start : start + size]
+            cached = self._load_pages(first_page, first_page)[0]
+            return cached[start : start + size]
+
+        data = bytearray().join(self._load_pages(first_page, last_page))
+        return data[start : start + size]
+
+    def readinto_at(self, offset: int, buffer: memoryview) -> int:
+        data = self.read_at(offset, len(buffer))
+        buffer[: len(data)] = data
+        return len(data)
+
+    def write_at(self, offset: int, data: bytes) -> int:
+        return self.writev_at(offset, [data])
+
+    def writev_at(self, offset: int, buffers: Sequence[bytes]) -> int:
+        with self.lock:
+            self._generation += 1
+            if self.write_through:
+                self.backend.writev_at(offset, buffers)
+
+            position = offset
+            for buffer in buffers:
+                position += self._write_pages(position, memoryview(buffer).cast("B"))
+        return position - offset
+
+    def flush(self) -> None:
+        """Writes the dirty pages back, each run of neighbouring pages at once."""
+        with self.lock:
+            run_start: Optional[int] = None
+            run: List[bytearray] = []
+            for page in sorted(self.dirty):
+                if run and page != run_start + len(run):
+                    self._write_run(run_start, run)
+                    run = []
+                if not run:
+                    run_start = page
+                run.append(self.pages.peek(page))
+
+            if run:
+                self._write_run(run_start, run)
+            self.dirty.clear()
+
+    def sync(self) -> None:
+        self.flush()
+        self.backend.sync()
+
+    def close(self) -> None:
+        if self.backend.closed:
+            return
+
+        self.flush()
+        with self.lock:
+            self.pages.clear()
+        self.backend.close()
+
+    def _load_pages(self, first_page: int, last_page: int) -> List[bytearray]:
+        with self.lock:
+            pages: List[Optional[bytearray]] = []
+            for page in range(first_page, last_page + 1):
+                cached = self.pages.get(page)
+                if cached is None:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+                pages.append(cached)
+            generation = self._generation
+        missing = [index for index, data in enumerate(pages) if data is None]
+        if not missing:
+            return pages
+
+        # Every run of missing pages is read with one vectored read, outside the
+        # lock so other threads can use the cache meanwhile
+        index = 0
+        while index < len(missing):
+            run_end = index
+            while (
+                run_end + 1 < len(missing)
+                and missing[run_end + 1] == missing[run_end] + 1
+            ):
+                run_end += 1
+            run = [bytearray(self.PAGE_SIZE) for _ in range(run_end - index + 1)]
+            self._read_pages(first_page + missing[index], run)
+            for offset, data in enumerate(run):
+                pages[missing[index] + offset] = data
+            index = run_end + 1
+
+        with self.lock:
+            for index in missing:
+                page = first_page + index
+                cached = self.pages.peek(page)
+                if cached is not None:
+                    # Another thread loaded or wrote the page first
+                    pages[index] = cached
+                elif generation == self._generation:
+                    self.pages.put(page, pages[index])
+        return pages
+
+    def _read_pages(self, first_page: int, pages: List[bytearray]) -> None:
+        # Pages past the end of the image stay zero
+        self.backend.readv_at(
+            first_page * self.PAGE_SIZE, [memoryview(page) for page in pages]
+        )
+
+    def _write_pages(self, offset: int, data: memoryview) -> int:
+        # Written through pages are only updated when they are already cached,
+        # otherwise every small write would first read its page
+        end = offset + len(data)
+        position = offset
+        while position < end:
+            page = position // self.PAGE_SIZE
+            page_start = page * self.PAGE_SIZE
+            page_end = min(page_start + self.PAGE_SIZE, end)
+
+            cached = self.pages.get(page)
+            if cached is None and self.write_through:
+                position = page_end
+                continue
+            if cached is None:
+                cached = bytearray(self.PAGE_SIZE)
+                if page_end - position < self.PAGE_SIZE:
+                    self._read_pages(page, [cached])
+                self.pages.put(page, cached)
+
+            cached[position - page_start : page_end - page_start] = data[
+                position - offset : page_end - offset
+            ]
+            if not self.write_through:
+                self.dirty.add(page)
+            position = page_end
+        return len(data)
+
+    def _write_run(self, first_page: int, pages: List[bytearray]) -> None:
+        offset = first_page * self.PAGE_SIZE
+        buffers = [memoryview(page) for page in pages]
+        # Padding of a short last page must not grow the image
+        overflow = offset + len(pages) * self.PAGE_SIZE - self.size
+        if overflow > 0:
+            buffers[-1] = buffers[-1][: max(0, self.PAGE_SIZE - overflow)]
+        self.backend.writev_at(offset, buffers)
+        self.write_backs += len(pages)
+
+    def _write_back(self, page: int, data: bytearray) -> None:
+        if page in self.dirty:
+            self.dirty.discard(page)
+            self._write_run(page, [data])
@@ -17,6 +17,22 @@ class ConfigManager:
         self.file_system_size = metadata.file_system_size
         self.file_name_size = metadata.file_name_size
 
+        # Directory growth policy
+        self.directory_initial_blocks = metadata.directory_initial_blocks
+        self.directory_growth_factor = metadata.directory_growth_factor
+        self.directory_max_growth_blocks = metadata.directory_max_growth_blocks
+
+        self.storage_backend = metadata.storage_backend
+        self.durability = metadata.durability
+        self.block_cache_size = metadata.block_cache_size
+        self.compression = metadata.compression
+        self.dedup = metadata.dedup
+        self.large_block_size = metadata.large_block_size
+        self.large_region_size = metadata.large_region_size
+        self.large_file_threshold = metadata.large_file_threshold
+        if self.large_region_size and self.large_block_size % self.block_size:
+            raise ValueError("The large block size must be a multiple of block_size.")
+
         # Dynamically calculated settings
         self.num_blocks = self.file_system_size // self.block_size
         self.max_file_blocks = self._calculate_max_file_blocks()
@@ -24,7 +40,28 @@ class ConfigManager:
         self.max_length_children = self.file_start_block_index_size
         self.index_entry_size = self._calculate_index_entry_size()
         self.max_index_entries = self.file_index_size // self.index_entry_size
-        self.bitmap_size = self.num_blocks // 8
+
+        # Blocks are numbered in small blocks across both regions, the large
+        # region starts after the last small block and has a bitmap of its own
+        # right after the one of the small region
+        self.large_num_blocks = self.large_region_size // self.large_block_size
+        self.blocks_per_large_block = self.large_block_size // self.block_size
+        self.small_num_blocks = (
+            self.num_blocks - self.large_num_blocks * self.blocks_per_large_block
+        )
+        self.small_bitmap_size = self.small_num_blocks // 8
+        self.large_bitmap_size = self.large_num_blocks // 8
+        self.bitmap_size = self.small_bitmap_size + self.large_bitmap_size
+
+        # A new volume is laid out as bitmaps, index, data. Growing it can move
+        # the bitmaps and the index past the data, which never moves.
+        self.bitmap_offset = metadata.bitmap_offset
+        self.index_offset = metadata.index_offset or (
+            self.bitmap_offset + self.bitmap_size
+        )
+        self.data_start = metadata.data_start or (
+            self.index_offset + self.file_index_size
+        )
 
     def _calculate_max_file_blocks(self):
         return math.ceil(math.log2(self.num_blocks) / 8)
@@ -50,12 +87,30 @@ class ConfigManager:
             f"  block_size={self.block_size},\n"
             f"  file_system_size={self.file_system_size},\n"
             f"  file_name_size={self.file_name_size},\n"
+            f"  directory_initial_blocks={self.directory_initial_blocks},\n"
+            f"  directory_growth_factor={self.directory_growth_factor},\n"
+            f"  directory_max_growth_blocks={self.directory_max_growth_blocks},\n"
+            f"  storage_backend={self.storage_backend},\n"
+            f"  durability={self.durability},\n"
+            f"  block_cache_size={self.block_cache_size},\n"
+            f"  compression={self.compression},\n"
+            f"  dedup={self.dedup},\n"
+            f"  large_block_size={self.large_block_size},\n"
+            f"  large_region_size={self.large_region_size},\n"
+            f"  large_file_threshold={self.large_file_threshold},\n"
             f"  num_blocks={self.num_blocks},\n"
             f"  max_file_blocks={self.max_file_blocks},\n"
             f"  file_start_block_index_size={self.file_start_block_index_size},\n"
             f"  max_length_children={self.max_length_children},\n"
             f"  index_entry_size={self.index_entry_size},\n"
             f"  max_index_entries={self.max_index_entries},\n"
-            f"  bitmap_size={self.bitmap_size}\n"
+            f"  small_num_blocks={self.small_num_blocks},\n"
+            f"  large_num_blocks={self.large_num_blocks},\n"
+            f"  small_bitmap_size={self.small_bitmap_size},\n"
+            f"  large_bitmap_size={self.large_bitmap_size},\n"
+            f"  bitmap_size={self.bitmap_size},\n"
+            f"  bitmap_offset={self.bitmap_offset},\n"
+            f"  index_offset={self.index_offset},\n"
+            f"  data_start={self.data_start}\n"
             f")"
         )
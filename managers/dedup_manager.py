@@ -0,0 +1,288 @@
+import hashlib
+import math
+import struct
+import time
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple, Union
+
+from structs.file_index_node import FileIndexNode
+
+if TYPE_CHECKING:
+    from core.file_system import FileSystem
+
+
+class DedupManager:
+    """
+    Finds files whose stored data is identical so they can share one extent,
+    reference counted like the clones made by copy_file. The SHA-256 digest of
+    every stored extent maps to a file holding it, and a match is compared byte
+    by byte before it is used, so entries left behind by files that were
+    changed or deleted since are harmless.
+
+    The digests are kept in the image as records appended to INDEX_NAME, a file
+    in the index that is in no directory. No path can reach it since names
+    never contain a slash, and IndexManager leaves it out of name lookups and
+    listings.
+
+    Attributes:
+        files_deduplicated (int): Files that were given an existing extent.
+        bytes_saved (int): The size of the extents that were not stored.
+        bytes_hashed (int): The size of everything hashed.
+        hash_time (float): Seconds spent hashing and comparing.
+    """
+
+    INDEX_NAME = "/dedup"
+    RECORD = struct.Struct(">32sI")
+
+    def __init__(self, file_system: "FileSystem") -> None:
+        self.file_system = file_system
+        # digest -> id of a file whose extent had that digest when it was stored
+        self.digests: Dict[bytes, int] = {}
+        self.records = 0
+        self.index_node: Optional[FileIndexNode] = (
+            file_system.index_manager.find_file_by_name(
+                self.INDEX_NAME, include_internal=True
+            )
+        )
+
+        self.files_deduplicated = 0
+        self.bytes_saved = 0
+        self.bytes_hashed = 0
+        self.hash_time = 0.0
+
+        if self.index_node:
+            self._load()
+
+    def extent_flags(self, is_compressed: bool, is_sparse: bool, blocks: int) -> int:
+        """
+        Returns the flags a new extent is stored with, an extent can only be
+        shared by files that read it the same way and keep it in the same
+        region.
+
+        :param is_compressed: Whether the extent holds compressed data.
+        :param is_sparse: Whether it leaves out holes.
+        :param blocks: Its size in blocks, which decides its region.
+        :return: The compressed, sparse and large flags of FileIndexNode.
+        """
+        config = self.file_system.config_manager
+        flags = 0
+        if is_compressed:
+            flags |= FileIndexNode.COMPRESSED_FLAG
+        if is_sparse:
+            flags |= FileIndexNode.SPARSE_FLAG
+        if (
+            config.large_num_blocks
+            and blocks >= config.large_file_threshold // config.block_size
+        ):
+            flags |= FileIndexNode.LARGE_FLAG
+        return flags
+
+    @staticmethod
+    def node_flags(file_node: FileIndexNode) -> int:
+        """Returns the flags of the extent a file is stored in, see extent_flags."""
+        flags = 0
+        if file_node.is_compressed:
+            flags |= FileIndexNode.COMPRESSED_FLAG
+        if file_node.is_sparse:
+            flags |= FileIndexNode.SPARSE_FLAG
+        if file_node.is_large:
+            flags |= FileIndexNode.LARGE_FLAG
+        return flags
+
+    def digest(self, data: bytes, flags: int) -> bytes:
+        """
+        Hashes the contents of an extent.
+
+        :param data: The extent exactly as stored, padded to whole blocks.
+        :param flags: The flags of the extent, from extent_flags.
+        :return: The digest.
+        """
+        start = time.perf_counter()
+        digest = hashlib.sha256(bytes([flags]))
+        digest.update(data)
+        self.hash_time += time.perf_counter() - start
+        self.bytes_hashed += len(data)
+        return digest.digest()
+
+    def hash_extent(self, file_node: FileIndexNode) -> bytes:
+        """Hashes the extent of a stored file, reading it in bounded chunks."""
+        start = time.perf_counter()
+        digest = hashlib.sha256(bytes([self.node_flags(file_node)]))
+        size = file_node.file_blocks * self.file_system.config_manager.block_size
+        offset = self.file_system.data_offset(file_node.file_start_block)
+        for position in range(0, size, self.file_system.COPY_CHUNK_SIZE):
+            digest.update(
+                self.file_system.storage.read_at(
+                    offset + position,
+                    min(self.file_system.COPY_CHUNK_SIZE, size - position),
+                )
+            )
+        self.hash_time += time.perf_counter() - start
+        self.bytes_hashed += size
+        return digest.digest()
+
+    def find(self, digest: bytes, data: bytes, flags: int) -> Optional[FileIndexNode]:
+        """
+        Looks for a stored extent holding exactly data.
+
+        :param digest: The digest of data.
+        :param data: The contents of a new extent, padded to whole blocks.
+        :param flags: The flags of the new extent, from extent_flags.
+        :return: A file with that extent and the same flags, or None.
+        """
+        file_node = self.file_system.index_manager.index.get(self.digests.get(digest))
+        block_size = self.file_system.config_manager.block_size
+        if (
+            file_node is None
+            or file_node.is_directory
+            or self.node_flags(file_node) != flags
+            or file_node.file_blocks * block_size != len(data)
+        ):
+            return None
+
+        start = time.perf_counter()
+        stored = self.file_system.storage.read_at(
+            self.file_system.data_offset(file_node.file_start_block), len(data)
+        )
+        self.hash_time += time.perf_counter() - start
+        if stored != data:
+            return None
+
+        self.count_saving(len(data))
+        return file_node
+
+    def same_extents(self, file_node: FileIndexNode, other: FileIndexNode) -> bool:
+        """Compares the extents of two files byte by byte."""
+        if (
+            file_node.file_blocks != other.file_blocks
+            or self.node_flags(file_node) != self.node_flags(other)
+        ):
+            return False
+
+        start = time.perf_counter()
+        size = file_node.file_blocks * self.file_system.config_manager.block_size
+        chunk_size = self.file_system.COPY_CHUNK_SIZE
+        offset = self.file_system.data_offset(file_node.file_start_block)
+        other_offset = self.file_system.data_offset(other.file_start_block)
+        same = all(
+            self.file_system.storage.read_at(
+                offset + position, min(chunk_size, size - position)
+            )
+            == self.file_system.storage.read_at(
+                other_offset + position, min(chunk_size, size - position)
+            )
+            for position in range(0, size, chunk_size)
+        )
+        self.hash_time += time.perf_counter() - start
+        return same
+
+    def count_saving(self, size: int) -> None:
+        self.files_deduplicated += 1
+        self.bytes_saved += size
+
+    def register(self, digest: bytes, file_node: FileIndexNode) -> None:
+        """Records that file_node stores the extent with digest."""
+        self.register_many([(digest, file_node)])
+
+    def register_many(self, entries: List[Tuple[bytes, FileIndexNode]]) -> None:
+        """Records several digests with one write to the index file."""
+        records = []
+        for digest, file_node in entries:
+            if self.digests.get(digest) != file_node.id:
+                self.digests[digest] = file_node.id
+                records.append(self.RECORD.pack(digest, file_node.id))
+        if not records:
+            return
+
+        if self.index_node is None:
+            self.index_node = self._create_index_node()
+        self.file_system.write_at(
+            self.index_node, self.records * self.RECORD.size, b"".join(records)
+        )
+        self.records += len(records)
+
+    def find_many(
+        self, extents: Dict[str, Tuple[bytes, int]]
+    ) -> Tuple[Dict[str, Union[FileIndexNode, str]], Dict[str, bytes]]:
+        """
+        Looks up the extents of a batch of new files, which may also repeat each
+        other.
+
+        :param extents: The padded contents of every file and their flags, from
+            extent_flags, by name.
+        :return: For the files that need not be stored, the stored file or the
+            name of the earlier file of the batch they share an extent with, and
+            the digest of every other file.
+        """
+        shared: Dict[str, Union[FileIndexNode, str]] = {}
+        digests: Dict[str, bytes] = {}
+        first_names: Dict[bytes, str] = {}
+        for name, (data, flags) in extents.items():
+            digest = self.digest(data, flags)
+            match = self.find(digest, data, flags)
+            if match:
+                shared[name] = match
+                continue
+
+            earlier = first_names.setdefault(digest, name)
+            if earlier != name and extents[earlier] == (data, flags):
+                self.count_saving(len(data))
+                shared[name] = earlier
+            else:
+                digests[name] = digest
+        return shared, digests
+
+    def rewrite(self, digests: Dict[bytes, int]) -> None:
+        """Replaces every record with digests, dropping entries gone stale."""
+        self.digests = dict(digests)
+        if self.index_node is None:
+            self.index_node = self._create_index_node()
+        self.file_system.store_file_data(
+            self.index_node,
+            b"".join(
+                self.RECORD.pack(digest, file_id)
+                for digest, file_id in self.digests.items()
+            ),
+            False,
+        )
+        self.records = len(self.digests)
+
+    def report(self) -> Dict[str, float]:
+        """
+        Sums up the deduplication done since the volume was mounted.
+
+        :return: The files deduplicated, the bytes saved, the number of digests
+            in the index and the hashing throughput in MB/s.
+        """
+        return {
+            "files_deduplicated": self.files_deduplicated,
+            "bytes_saved": self.bytes_saved,
+            "index_entries": len(self.digests),
+            "hash_mb_s": (
+                self.bytes_hashed / 1024 / 1024 / self.hash_time
+                if self.hash_time
+                else 0.0
+            ),
+        }
+
+    def _load(self) -> None:
+        # Records can end in zero bytes, which read_file strips
+        data = self.file_system.read_file(self.index_node)
+        self.records = math.ceil(len(data) / self.RECORD.size)
+        data = data.ljust(self.records * self.RECORD.size, b"\0")
+        for digest, file_id in self.RECORD.iter_unpack(data):
+            self.digests[digest] = file_id
+
+    def _create_index_node(self) -> FileIndexNode:
+        block_size = self.file_system.config_manager.block_size
+        index_node = FileIndexNode(
+            file_name=self.INDEX_NAME,
+            file_start_block=self.file_system.allocate_extent(1),
+            file_blocks=1,
+            id=self.file_system.metedata_manager.increment_id(),
+        )
+        self.file_system.storage.write_at(
+            self.file_system.data_offset(index_node.file_start_block),
+            bytes(block_size),
+        )
+        self.file_system.index_manager.write_to_index(index_node)
+        return index_node
@@ -0,0 +1,61 @@
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+
+class DentryCache:
+    """
+    A bounded LRU cache from normalized path components to node ids. Paths that
+    were found missing are cached as None so repeated misses stay cheap. Lookups
+    from several threads at once are safe.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.entries: "OrderedDict[Tuple[str, ...], Optional[int]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key: Tuple[str, ...]) -> Optional[int]:
+        """
+        Returns the cached id of a path, or None if the path is cached as missing.
+
+        :raises KeyError: If nothing is cached for the path.
+        """
+        with self.lock:
+            try:
+                file_id = self.entries[key]
+            except KeyError:
+                self.misses += 1
+                raise
+
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return file_id
+
+    def put(self, key: Tuple[str, ...], file_id: Optional[int]) -> None:
+        with self.lock:
+            self.entries[key] = file_id
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key: Tuple[str, ...]) -> None:
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def invalidate_tree(self, key: Tuple[str, ...]) -> None:
+        """Drops a path and every cached path below it."""
+        depth = len(key)
+        with self.lock:
+            for cached_key in [
+                cached_key
+                for cached_key in self.entries
+                if cached_key[:depth] == key
+            ]:
+                del self.entries[cached_key]
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
@@ -1,33 +1,91 @@
+import heapq
 import time
+from typing import Dict, List
+
+from core.storage_backend import StorageBackend
 from managers.config_manager import ConfigManager
 from structs.file_index_node import FileIndexNode
 
 
 class IndexManager:
-    def __init__(self, fs, config_manager: "ConfigManager"):
+    INTERNAL_PREFIX = "/"
+
+    def __init__(self, storage: StorageBackend, config_manager: "ConfigManager"):
 
-        self.fs = fs
+        self.storage = storage
         self.config_manager = config_manager
 
         # Cache for index entries
         self.index = {}
         self.index_locations = {}
+        # Heap of empty index slots so new entries don't have to scan the index
+        self.free_locations = []
+        # Start block -> number of files sharing that extent, for extents shared
+        # by copies. It is rebuilt from the index, where clones simply have the
+        # same start block, so it never has to be stored.
+        self.extent_refs: Dict[int, int] = {}
         self.load_index()
 
     def load_index(self):
-        for i in range(self.config_manager.max_index_entries):
-            self.fs.seek(
-                self.config_manager.bitmap_size
-                + i * self.config_manager.index_entry_size
+        # The whole index is read at once and sliced per entry
+        entry_size = self.config_manager.index_entry_size
+        index_data = bytes(
+            self.storage.read_at(
+                self.config_manager.index_offset,
+                self.config_manager.max_index_entries * entry_size,
             )
-            data = self.fs.read(self.config_manager.index_entry_size)
+        )
+        for i in range(self.config_manager.max_index_entries):
+            data = index_data[i * entry_size : (i + 1) * entry_size]
             if data.strip(b"\0") == b"":
+                self.free_locations.append(i)
                 continue
 
             file_index = FileIndexNode.from_bytes(data, self)
             self.index[file_index.id] = file_index
             self.index_locations[file_index.id] = i
 
+        self.rebuild_extent_refs()
+
+    def rebuild_extent_refs(self) -> None:
+        counts: Dict[int, int] = {}
+        for file_index in self.index.values():
+            if not file_index.is_directory:
+                start = file_index.file_start_block
+                counts[start] = counts.get(start, 0) + 1
+        self.extent_refs = {
+            start: count for start, count in counts.items() if count > 1
+        }
+
+    def is_extent_shared(self, start_block: int) -> bool:
+        return start_block in self.extent_refs
+
+    def share_extent(self, start_block: int) -> None:
+        """Adds a reference to the extent starting at start_block."""
+        self.extent_refs[start_block] = self.extent_refs.get(start_block, 1) + 1
+
+    def release_extent(self, start_block: int) -> bool:
+        """
+        Drops a reference to the extent starting at start_block.
+
+        :return: True if it was the last reference and the blocks can be freed.
+        """
+        count = self.extent_refs.get(start_block, 1) - 1
+        if count > 1:
+            self.extent_refs[start_block] = count
+        else:
+            self.extent_refs.pop(start_block, None)
+        return count == 0
+
+    def share_extents(self, start_blocks: List[int]) -> None:
+        for start_block in start_blocks:
+            self.share_extent(start_block)
+
+    def release_extents(self, start_blocks: List[int]) -> None:
+        """Drops references taken by share_extents, which never free blocks."""
+        for start_block in start_blocks:
+            self.release_extent(start_block)
+
     def write_to_index(self, file_index: FileIndexNode) -> None:
 
         if len(file_index.file_name) > self.config_manager.file_name_size:
@@ -37,63 +95,130 @@ class IndexManager:
         if file_index.id in self.index:
             self.index[file_index.id] = file_index
             # self.index_locations[file_index.id] = file_index.file_start_block
-            self.fs.seek(
-                self.config_manager.bitmap_size
+            self.storage.write_at(
+                self.config_manager.index_offset
                 + self.index_locations[file_index.id]
-                * self.config_manager.index_entry_size
-            )
-
-            self.fs.write(
-                file_index.to_bytes(
-                    self.config_manager.file_name_size,
-                    self.config_manager.max_file_blocks,
-                    self.config_manager.file_start_block_index_size,
-                    self.config_manager.max_length_children,
-                )
+                * self.config_manager.index_entry_size,
+                self._entry_bytes(file_index),
             )
             return
 
-        self.index[file_index.id] = file_index
+        if not self.free_locations:
+            raise Exception("No space in file index.")
 
-        for i in range(self.config_manager.max_index_entries):
-            self.fs.seek(
-                self.config_manager.bitmap_size
-                + i * self.config_manager.index_entry_size
-            )
-            data = self.fs.read(self.config_manager.index_entry_size)
-            if data.strip(b"\0") != b"":
-                continue
+        self.index[file_index.id] = file_index
 
-            # Update the file index
-            self.fs.seek(
-                self.config_manager.bitmap_size
-                + i * self.config_manager.index_entry_size
-            )
-            self.fs.write(
-                file_index.to_bytes(
-                    self.config_manager.file_name_size,
-                    self.config_manager.max_file_blocks,
-                    self.config_manager.file_start_block_index_size,
-                    self.config_manager.max_length_children,
-                )
-            )
-            # self.index[file_index.id] = file_index
+        i = heapq.heappop(self.free_locations)
+        self.storage.write_at(
+            self.config_manager.index_offset + i * self.config_manager.index_entry_size,
+            self._entry_bytes(file_index),
+        )
+        self.index_locations[file_index.id] = i
+
+    def write_many_to_index(self, file_indexes: List[FileIndexNode]) -> None:
+        """
+        Writes several new entries, merging entries that land in consecutive
+        index slots into a single write.
+
+        :param file_indexes: Nodes that are not in the index yet.
+        """
+        if len(self.free_locations) < len(file_indexes):
+            raise Exception("No space in file index.")
+
+        entries = []
+        for file_index in file_indexes:
+            if len(file_index.file_name) > self.config_manager.file_name_size:
+                raise ValueError("File name too long.")
+            file_index.modification_date = int(round(time.time()))
+            entries.append((heapq.heappop(self.free_locations), file_index))
+
+        run_start, run_data = None, []
+        for i, file_index in entries:
+            self.index[file_index.id] = file_index
             self.index_locations[file_index.id] = i
-            return
 
-        raise Exception("No space in file index.")
+            if run_data and i != run_start + len(run_data):
+                self._write_entries(run_start, run_data)
+                run_data = []
+            if not run_data:
+                run_start = i
+            run_data.append(self._entry_bytes(file_index))
+
+        if run_data:
+            self._write_entries(run_start, run_data)
+
+    def _entry_bytes(self, file_index: FileIndexNode) -> bytes:
+        # The region is recorded from where the extent is, after every move
+        file_index.is_large = (
+            file_index.file_start_block >= self.config_manager.small_num_blocks
+        )
+        return file_index.to_bytes(
+            self.config_manager.file_name_size,
+            self.config_manager.max_file_blocks,
+            self.config_manager.file_start_block_index_size,
+            self.config_manager.max_length_children,
+        )
+
+    def relocate(self, config_manager: "ConfigManager") -> None:
+        """
+        Starts using the index described by config_manager, which can be in
+        another place, of another size and with another entry format. Every
+        entry is written to it from the first slot on, the current index is left
+        as it is.
+
+        :param config_manager: The configuration of the grown volume.
+        """
+        if len(self.index) > config_manager.max_index_entries:
+            raise Exception("No space in file index.")
+
+        self.config_manager = config_manager
+        file_ids = sorted(self.index_locations, key=self.index_locations.get)
+        self.storage.write_at(
+            config_manager.index_offset,
+            b"".join(
+                self._entry_bytes(self.index[file_id]) for file_id in file_ids
+            ).ljust(config_manager.file_index_size, b"\0"),
+        )
+        self.index_locations = {file_id: i for i, file_id in enumerate(file_ids)}
+        self.free_locations = list(
+            range(len(file_ids), config_manager.max_index_entries)
+        )
+
+    def _write_entries(self, first_location: int, entries: List[bytes]) -> None:
+        self.storage.writev_at(
+            self.config_manager.index_offset
+            + first_location * self.config_manager.index_entry_size,
+            entries,
+        )
 
     def find_file_by_id(self, file_id: int) -> FileIndexNode:
         return self.index.get(file_id)
 
-    def find_file_by_name(self, file_name: str) -> FileIndexNode:
+    def find_file_by_name(
+        self, file_name: str, include_internal: bool = False
+    ) -> FileIndexNode:
+        if self.is_internal(file_name) and not include_internal:
+            return None
         for file_index in self.index.values():
             if file_index.file_name == file_name:
                 return file_index
         return None
 
     def list_all_files(self):
-        return list(self.index.values())
+        return [
+            file_index
+            for file_index in self.index.values()
+            if not self.is_internal(file_index.file_name)
+        ]
+
+    @classmethod
+    def is_internal(cls, file_name: str) -> bool:
+        """
+        Tells whether a name is one of the files the file system keeps for
+        itself in no directory, like the digest index of deduplication. Their
+        names start with a slash, which names of user files never contain.
+        """
+        return file_name.startswith(cls.INTERNAL_PREFIX)
 
     def delete_from_index(self, file_index: FileIndexNode) -> None:
         if file_index.id not in self.index:
@@ -101,9 +226,14 @@ class IndexManager:
 
         del self.index[file_index.id]
 
-        self.fs.seek(
-            self.config_manager.bitmap_size
-            + self.index_locations[file_index.id] * self.config_manager.index_entry_size
+        self.storage.write_at(
+            self.config_manager.index_offset
+            + self.index_locations[file_index.id]
+            * self.config_manager.index_entry_size,
+            b"\0".ljust(self.config_manager.index_entry_size, b"\0"),
         )
-        self.fs.write(b"\0".ljust(self.config_manager.index_entry_size, b"\0"))
-        del self.index_locations[file_index.id]
+        heapq.heappush(self.free_locations, self.index_locations.pop(file_index.id))
+
+    def delete_many_from_index(self, file_indexes: List[FileIndexNode]) -> None:
+        for file_index in file_indexes:
+            self.delete_from_index(file_index)
@@ -1,6 +1,8 @@
-from structs.metadata import Metadata
+from dataclasses import fields
 import os
 
+from structs.metadata import Metadata
+
 
 class MetadataManager:
     def __init__(self, file_path, metadata: Metadata = None):
@@ -21,33 +23,73 @@ class MetadataManager:
             data = f.read()
         values = data.split(",")
 
+        # Fields added after the first release are optional at the end of the
+        # file, older volumes simply fall back to their defaults.
         metadata = Metadata(
-            values[0],
-            int(values[1]),
-            int(values[2]),
-            int(values[3]),
-            int(values[4]),
-            int(values[5]),
+            *(
+                self._parse_value(field.type, value)
+                for field, value in zip(fields(Metadata), values)
+            )
         )
         return metadata
 
     def write_metadata_file(self):
-        metadata_values = [
-            self.metadata.file_system_path,
-            self.metadata.file_index_size,
-            self.metadata.block_size,
-            self.metadata.file_system_size,
-            self.metadata.file_name_size,
-            self.metadata.current_id,
-        ]
         with open(f"{self.file_path}.dt", "w") as f:
-            f.write(",".join(map(str, metadata_values)))
+            f.write(self._serialize(self.metadata))
+
+    def replace_metadata(self, metadata: Metadata) -> None:
+        """
+        Switches to metadata, which is written to a temporary file that is then
+        renamed over the current one, so a crash leaves either the old or the
+        new metadata on disk and never a mix of both.
+
+        :param metadata: The new metadata.
+        """
+        temp_path = f"{self.file_path}.dt.tmp"
+        with open(temp_path, "w") as f:
+            f.write(self._serialize(metadata))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, f"{self.file_path}.dt")
+
+        # The rename itself only lasts once the directory is synced
+        directory = os.open(
+            os.path.dirname(os.path.abspath(self.file_path)), os.O_RDONLY
+        )
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+        self.metadata = metadata
+
+    @staticmethod
+    def _serialize(metadata: Metadata) -> str:
+        return ",".join(
+            str(getattr(metadata, field.name)) for field in fields(Metadata)
+        )
+
+    @staticmethod
+    def _parse_value(field_type, value: str):
+        if field_type is bool:
+            return value == "True"
+        return field_type(value)
 
     def increment_id(self):
         self.metadata.current_id += 1
         self.write_metadata_file()
         return self.metadata.current_id
 
+    def reserve_ids(self, count: int) -> int:
+        """
+        Reserves count consecutive ids with a single metadata write.
+
+        :return: The first reserved id.
+        """
+        first_id = self.metadata.current_id + 1
+        self.metadata.current_id += count
+        self.write_metadata_file()
+        return first_id
+
     @property
     def current_id(self):
         return self.metadata.current_id
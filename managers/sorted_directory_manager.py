@@ -0,0 +1,89 @@
+from bisect import bisect_left, bisect_right
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+
+from structs.file_index_node import FileIndexNode
+
+if TYPE_CHECKING:
+    from core.file_system import FileSystem
+
+
+class SortedDirectoryManager:
+    """
+    Keeps an in-memory array of (name, id) pairs sorted by name for every
+    directory that has been accessed, so lookups can bisect and ordered listings
+    can start at any name without sorting the whole directory.
+    """
+
+    def __init__(self, file_system: "FileSystem"):
+        self.file_system = file_system
+
+        # directory id -> (sorted names, ids in the same order)
+        self.entries: Dict[int, Tuple[List[str], List[int]]] = {}
+
+    def load_entries(self, dir_node: FileIndexNode) -> Tuple[List[str], List[int]]:
+        if dir_node.id in self.entries:
+            return self.entries[dir_node.id]
+
+        index = self.file_system.index_manager.index
+        pairs = sorted(
+            (index[child_id].file_name, child_id)
+            for child_id in dir_node.read_children_ids(self.file_system)
+        )
+        entries = ([name for name, _ in pairs], [child_id for _, child_id in pairs])
+        self.entries[dir_node.id] = entries
+        return entries
+
+    def find_child(self, dir_node: FileIndexNode, name: str) -> Optional[FileIndexNode]:
+        names, ids = self.load_entries(dir_node)
+        position = bisect_left(names, name)
+        if position < len(names) and names[position] == name:
+            return self.file_system.index_manager.index[ids[position]]
+        return None
+
+    def list_children(
+        self,
+        dir_node: FileIndexNode,
+        start_after: Optional[str] = None,
+        limit: Optional[int] = None,
+    ) -> List[FileIndexNode]:
+        names, ids = self.load_entries(dir_node)
+        start = 0 if start_after is None else bisect_right(names, start_after)
+        end = len(names) if limit is None else start + limit
+        index = self.file_system.index_manager.index
+        return [index[child_id] for child_id in ids[start:end]]
+
+    def add_entry(self, dir_id: int, name: str, child_id: int) -> None:
+        if dir_id not in self.entries:
+            return
+
+        names, ids = self.entries[dir_id]
+        position = bisect_right(names, name)
+        names.insert(position, name)
+        ids.insert(position, child_id)
+
+    def remove_entry(self, dir_id: int, name: str) -> None:
+        if dir_id not in self.entries:
+            return
+
+        names, ids = self.entries[dir_id]
+        position = bisect_left(names, name)
+        if position < len(names) and names[position] == name:
+            del names[position]
+            del ids[position]
+
+    def rename_entry(self, dir_id: int, old_name: str, new_name: str) -> None:
+        if dir_id not in self.entries:
+            return
+
+        names, ids = self.entries[dir_id]
+        position = bisect_left(names, old_name)
+        if position < len(names) and names[position] == old_name:
+            child_id = ids[position]
+            del names[position]
+            del ids[position]
+            position = bisect_right(names, new_name)
+            names.insert(position, new_name)
+            ids.insert(position, child_id)
+
+    def forget(self, dir_id: int) -> None:
+        self.entries.pop(dir_id, None)
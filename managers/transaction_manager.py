@@ -1,7 +1,15 @@
+from typing import Callable, Optional
+
+
 class TransactionManager:
-    def __init__(self):
+    def __init__(self, on_commit: Optional[Callable[[], None]] = None):
+        """
+        :param on_commit: Called after every successful commit, used to make the
+            transaction's writes durable.
+        """
         self.operations = []
         self.active_transaction = False
+        self.on_commit = on_commit
 
     def add_operation(
         self, func, rollback_func=None, func_args=None, rollback_args=None
@@ -36,6 +44,8 @@ class TransactionManager:
                 # Execute the operation
                 operation["func"](*operation["func_args"])
                 executed_operations.append(operation)
+            if self.on_commit:
+                self.on_commit()
         except Exception as e:
             print(
                 f"doing roll back from {self.operations[len(executed_operations) - 1]}"
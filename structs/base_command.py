@@ -63,9 +63,10 @@ class BaseCommand(ABC):
 
         try:
             if append_mode:
-                existing_data = fs.read_file(file_path)
-                updated_data = existing_data + output.encode()
-                fs.edit_file(file_path, updated_data)
+                if fs.exists(file_path):
+                    fs.append_file(file_path, output.encode())
+                else:
+                    fs.create_file(file_path, output.encode())
 
             else:
                 if not fs.exists(file_path):
@@ -0,0 +1,24 @@
+"""
+Module containing the FileHandle class. A handle is returned by a lookup and
+lets later operations reach the node without resolving its path again.
+"""
+
+from dataclasses import dataclass
+
+
+@dataclass(frozen=True)
+class FileHandle:
+    """
+    An opaque reference to a resolved file or directory.
+
+    Attributes:
+        file_id (int): The id of the node.
+        generation (int): The generation of the node at lookup time. It changes
+            when the node is renamed, moved or deleted, which makes the handle
+            stale.
+        path (str): The absolute path the node was resolved from.
+    """
+
+    file_id: int
+    generation: int
+    path: str
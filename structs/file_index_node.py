@@ -1,15 +1,27 @@
-from typing import List, Optional
+import struct
+from typing import Dict, List, Optional
 from typing import TYPE_CHECKING
 import time
 
 if TYPE_CHECKING:
+    from core.compression import CompressedLayout
     from core.file_system import FileSystem
+    from core.sparse import SparseLayout
 
 # TODO: need to update code here a bit so it doesnt take the entire filesystem directly if it wants to do an operation
 # TODO: or if it will just dont name it config and pass only methods it might need
 
 
 class FileIndexNode:
+    # Bits of the flags byte of an index entry
+    DIRECTORY_FLAG = 1
+    # A compressed file, or for a directory that new files in it are compressed
+    COMPRESSED_FLAG = 2
+    # A file whose extent leaves out the holes in its data
+    SPARSE_FLAG = 4
+    # A file whose extent is in the large block region
+    LARGE_FLAG = 8
+
     # TODO : change id into file_id
     def __init__(
         self,
@@ -21,6 +33,9 @@ class FileIndexNode:
         children_count: Optional[int] = 0,
         creation_date: Optional[int] = None,
         modification_date: Optional[int] = None,
+        is_compressed: Optional[bool] = False,
+        is_sparse: Optional[bool] = False,
+        is_large: Optional[bool] = False,
     ) -> None:
         self.id = id
         self.file_name: str = file_name
@@ -28,10 +43,29 @@ class FileIndexNode:
         self.file_blocks: int = file_blocks
         self.file_size: int = 0  # To be calculated dynamically
         self.is_directory = is_directory
+        self.is_compressed = is_compressed
+        self.is_sparse = is_sparse
+        # Set by IndexManager from where the extent is whenever it is written
+        self.is_large = is_large
 
         self.set_dates(creation_date, modification_date)
         self.children_count = children_count
 
+        # Bumped whenever the node is renamed, moved or deleted, so handles
+        # taken before that are recognized as stale. Only kept in memory.
+        self.generation = 0
+
+        # The length of the file's data once it has been computed, kept up to
+        # date by FileSystem.write_at so appends do not scan the extent again
+        self.data_length: Optional[int] = None
+        # The parsed start of a compressed extent, loaded on the first read
+        self.compressed_layout: Optional["CompressedLayout"] = None
+        # The parsed run table of a sparse extent, loaded on the first read
+        self.sparse_layout: Optional["SparseLayout"] = None
+        # The slot of every child of a directory by name, built on the first
+        # removal and kept up to date by the methods changing the children
+        self.child_slots: Optional[Dict[str, int]] = None
+
     def set_dates(
         self,
         creation_date: Optional[int] = None,
@@ -55,6 +89,9 @@ class FileIndexNode:
             f"file_blocks={self.file_blocks}\n"
             f"file_size={self.file_size}\n"
             f"is_directory={self.is_directory}\n"
+            f"is_compressed={self.is_compressed}\n"
+            f"is_sparse={self.is_sparse}\n"
+            f"is_large={self.is_large}\n"
             f"children_count={self.children_count}\n"
             # f"children={self.children!r}\n"
             f"==========================\n"
@@ -76,7 +113,12 @@ class FileIndexNode:
         file_start_block_bytes = self.file_start_block.to_bytes(
             file_start_block_index_size, byteorder="big"
         )
-        is_directory_byte = b"\1" if self.is_directory else b"\0"
+        flags = (
+            (self.DIRECTORY_FLAG if self.is_directory else 0)
+            | (self.COMPRESSED_FLAG if self.is_compressed else 0)
+            | (self.SPARSE_FLAG if self.is_sparse else 0)
+            | (self.LARGE_FLAG if self.is_large else 0)
+        )
         children_count_bytes = self.children_count.to_bytes(
             max_length_children, byteorder="big"
         )
@@ -89,7 +131,7 @@ class FileIndexNode:
             + file_name_bytes
             + file_blocks_bytes
             + file_start_block_bytes
-            + is_directory_byte
+            + bytes([flags])
             + children_count_bytes
             + creation_date
             + modifaction_date
@@ -118,7 +160,7 @@ class FileIndexNode:
         ]
         offset_pointer += file_system.config_manager.file_start_block_index_size
 
-        is_directory_byte = data[offset_pointer : offset_pointer + 1]
+        flags = data[offset_pointer]
         offset_pointer += 1
 
         children_count_bytes = data[
@@ -137,7 +179,7 @@ class FileIndexNode:
         file_name = file_name_bytes.rstrip(b"\x00").decode("utf-8")
         file_blocks = int.from_bytes(file_blocks_bytes, byteorder="big")
         file_start_block = int.from_bytes(file_start_block_bytes, byteorder="big")
-        is_directory = is_directory_byte == b"\1"
+        is_directory = bool(flags & cls.DIRECTORY_FLAG)
         children_count = int.from_bytes(children_count_bytes, byteorder="big")
         creation_date = int.from_bytes(creation_date_bytes, byteorder="big")
         modification_date = int.from_bytes(modification_date_bytes, byteorder="big")
@@ -151,29 +193,48 @@ class FileIndexNode:
             children_count,
             creation_date,
             modification_date,
+            bool(flags & cls.COMPRESSED_FLAG),
+            bool(flags & cls.SPARSE_FLAG),
+            bool(flags & cls.LARGE_FLAG),
         )
         instance.calculate_file_size(file_system.config_manager.block_size)
         return instance
 
-    def load_children(self, file_system: "FileSystem") -> List["FileIndexNode"]:
-
+    def read_children_ids(
+        self, file_system: "FileSystem", start: int = 0, count: Optional[int] = None
+    ) -> List[int]:
+        """
+        Reads the ids stored in the children area of this directory with a single read.
+
+        :param file_system: The file system the directory belongs to.
+        :param start: The first slot to read.
+        :param count: The maximum number of slots to read, all remaining by default.
+        :return: The child ids in slot order.
+        """
         if not self.is_directory:
-            return
-        children = []
+            return []
+
+        end = self.children_count if count is None else start + count
+        count = min(end, self.children_count) - start
+        if count <= 0:
+            return []
+
         children_data_start = (
-            file_system.config_manager.bitmap_size
-            + file_system.config_manager.file_index_size
+            file_system.config_manager.data_start
             + self.file_start_block * file_system.config_manager.block_size
+            + 4 * start
         )
-        file_system.fs.seek(children_data_start)
-        for _ in range(self.children_count):
-            child_indentifier = file_system.fs.read(4)
-            child_node = file_system.index_manager.index[
-                int.from_bytes(child_indentifier, byteorder="big")
-            ]
-            children.append(child_node)
+        data = file_system.storage.read_at(children_data_start, 4 * count)
+        return list(struct.unpack(f">{count}I", data))
 
-        return children
+    def load_children(self, file_system: "FileSystem") -> List["FileIndexNode"]:
+
+        if not self.is_directory:
+            return
+        return [
+            file_system.index_manager.index[child_id]
+            for child_id in self.read_children_ids(file_system)
+        ]
 
     def add_child(
         self, file_system: "FileSystem", child_to_write: "FileIndexNode"
@@ -182,8 +243,7 @@ class FileIndexNode:
             return
 
         children_data_start = (
-            file_system.config_manager.bitmap_size
-            + file_system.config_manager.file_index_size
+            file_system.config_manager.data_start
             + self.file_start_block * file_system.config_manager.block_size
             + 4 * self.children_count
         )
@@ -192,54 +252,135 @@ class FileIndexNode:
             4 * (self.children_count + 1)
             >= self.file_blocks * file_system.config_manager.block_size
         ):
-            file_system.realign(self)
+            file_system.grow_directory(
+                self,
+                4 * (self.children_count + 1) // file_system.config_manager.block_size
+                + 1,
+            )
 
         children_data_start = (
-            file_system.config_manager.bitmap_size
-            + file_system.config_manager.file_index_size
+            file_system.config_manager.data_start
             + self.file_start_block * file_system.config_manager.block_size
             + 4 * self.children_count
         )
 
-        file_system.fs.seek(children_data_start)
-        file_system.fs.write(child_to_write.id.to_bytes(4, byteorder="big"))
-        file_system.fs.flush()
+        file_system.storage.write_at(
+            children_data_start, child_to_write.id.to_bytes(4, byteorder="big")
+        )
+        if self.child_slots is not None:
+            self.child_slots[child_to_write.file_name] = self.children_count
         self.children_count += 1
 
-    def remove_child(self, file_system: "FileSystem", child_dir: str) -> None:
+        if file_system.sorted_directory_manager:
+            file_system.sorted_directory_manager.add_entry(
+                self.id, child_to_write.file_name, child_to_write.id
+            )
+
+    def add_children(
+        self, file_system: "FileSystem", children: List["FileIndexNode"]
+    ) -> None:
+        """
+        Appends several children at once: the directory is grown at most once and
+        all child ids are written with a single write.
+        """
+        if not self.is_directory or not children:
+            return
 
-        children = self.load_children(file_system)
-        found = False
+        block_size = file_system.config_manager.block_size
+        required_blocks = 4 * (self.children_count + len(children)) // block_size + 1
+        if required_blocks > self.file_blocks:
+            file_system.grow_directory(self, required_blocks)
 
-        for i, child in enumerate(children):
-            if file_system.index_manager.index[child.id].file_name == child_dir:
-                found = True
-                continue
+        children_data_start = (
+            file_system.config_manager.data_start
+            + self.file_start_block * block_size
+            + 4 * self.children_count
+        )
 
-            if found:
-                child_data_start = (
-                    file_system.config_manager.bitmap_size
-                    + file_system.config_manager.file_index_size
-                    + self.file_start_block * file_system.config_manager.block_size
-                    + 4 * (i - 1)
+        file_system.storage.write_at(
+            children_data_start,
+            struct.pack(f">{len(children)}I", *(child.id for child in children)),
+        )
+        if self.child_slots is not None:
+            for slot, child in enumerate(children, self.children_count):
+                self.child_slots[child.file_name] = slot
+        self.children_count += len(children)
+
+        if file_system.sorted_directory_manager:
+            for child in children:
+                file_system.sorted_directory_manager.add_entry(
+                    self.id, child.file_name, child.id
                 )
 
-                if (
-                    4 * (i - 1)
-                    >= self.file_blocks * file_system.config_manager.block_size
-                ):
-                    raise ValueError(
-                        f"Directory {child_dir} is not a child of {self.file_name}"
-                    )
+    def truncate_children(self, file_system: "FileSystem", children_count: int) -> None:
+        """Drops every child after the first children_count, undoing add_children."""
+        self.children_count = children_count
+        self.child_slots = None
 
-                file_system.fs.seek(child_data_start)
-                file_system.fs.write(child.id.to_bytes(4, byteorder="big"))
+        if file_system.sorted_directory_manager:
+            file_system.sorted_directory_manager.forget(self.id)
 
-        if not found:
+    def remove_child(self, file_system: "FileSystem", child_dir: str) -> None:
+        """
+        Removes a child by moving the last child id into its slot. The slot is
+        found in child_slots, so a removal reads and writes at most two ids
+        whatever the size of the directory.
+        """
+        slot = self.find_child_slot(file_system, child_dir)
+        last_slot = self.children_count - 1
+        if slot != last_slot:
+            last_id = self.read_children_ids(file_system, last_slot, 1)[0]
+            child_data_start = (
+                file_system.config_manager.data_start
+                + self.file_start_block * file_system.config_manager.block_size
+                + 4 * slot
+            )
+            file_system.storage.write_at(
+                child_data_start, last_id.to_bytes(4, byteorder="big")
+            )
+            self.child_slots[file_system.index_manager.index[last_id].file_name] = slot
+
+        del self.child_slots[child_dir]
+        self.children_count -= 1
+
+        if file_system.sorted_directory_manager:
+            file_system.sorted_directory_manager.remove_entry(self.id, child_dir)
+
+    def find_child_slot(self, file_system: "FileSystem", child_dir: str) -> int:
+        """
+        Finds the slot of a child in the children area, reading the whole area
+        only the first time or when child_slots turns out to be out of date.
+
+        :param file_system: The file system the directory belongs to.
+        :param child_dir: The name of the child.
+        :return: The slot of the child.
+        """
+        index = file_system.index_manager.index
+        slot = None if self.child_slots is None else self.child_slots.get(child_dir)
+        if slot is not None and slot < self.children_count:
+            child_id = self.read_children_ids(file_system, slot, 1)[0]
+            if child_id in index and index[child_id].file_name == child_dir:
+                return slot
+
+        self.child_slots = {
+            index[child_id].file_name: i
+            for i, child_id in enumerate(self.read_children_ids(file_system))
+        }
+        if child_dir not in self.child_slots:
             raise ValueError(f"Child '{child_dir}' not found.")
+        return self.child_slots[child_dir]
 
-        file_system.fs.flush()
-        self.children_count -= 1
+    def rename_child(
+        self, file_system: "FileSystem", old_name: str, new_name: str
+    ) -> None:
+        """Updates the lookups of this directory kept in memory for a renamed child."""
+        if self.child_slots is not None and old_name in self.child_slots:
+            self.child_slots[new_name] = self.child_slots.pop(old_name)
+
+        if file_system.sorted_directory_manager:
+            file_system.sorted_directory_manager.rename_entry(
+                self.id, old_name, new_name
+            )
 
     # def remove_all_children(self, file_system: "FileSystem") -> None:
     #     file_system.bitmap_manager.free_blocks(
@@ -0,0 +1,144 @@
+"""
+Module containing the FileStream class, a raw binary stream over a single file
+of the file system that is returned by FileSystemApi.open.
+"""
+
+import io
+import os
+from typing import TYPE_CHECKING, Iterator, Optional, Tuple
+
+from structs.readahead import Readahead
+
+if TYPE_CHECKING:
+    from core.file_system import FileSystem
+    from structs.file_index_node import FileIndexNode
+
+# The lseek values on Linux, for platforms whose os module lacks them
+SEEK_DATA = getattr(os, "SEEK_DATA", 3)
+SEEK_HOLE = getattr(os, "SEEK_HOLE", 4)
+
+
+class FileStream(io.RawIOBase):
+    """
+    A seekable raw stream over a file. Sequential reads are served from windows
+    read ahead of them, other reads go straight from the volume into the caller's
+    buffer, and every write is a pwrite of the blocks it covers, so the file
+    never has to be held in memory as a whole.
+
+    Supported modes are "rb", "r+b" and "ab". Like read_file, the end of the file
+    is its last non zero byte. Like lseek, seek also takes SEEK_DATA and
+    SEEK_HOLE to find the holes of sparse files.
+    """
+
+    MODES = ("rb", "r+b", "ab")
+
+    def __init__(
+        self, file_system: "FileSystem", file_node: "FileIndexNode", mode: str
+    ) -> None:
+        if mode not in self.MODES:
+            raise ValueError(f"Unsupported mode: {mode}")
+        if file_node.is_directory:
+            raise IsADirectoryError(f"'{file_node.file_name}' is a directory.")
+
+        super().__init__()
+        self.file_system = file_system
+        self.file_node = file_node
+        self.mode = mode
+        self.name = file_node.file_name
+        self.readahead = Readahead(file_system, file_node)
+
+        self._position = self._length if mode == "ab" else 0
+
+    @property
+    def _length(self) -> int:
+        return self.file_system.get_file_length(self.file_node)
+
+    def readable(self) -> bool:
+        return self.mode != "ab"
+
+    def writable(self) -> bool:
+        return self.mode != "rb"
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        self._check_closed()
+        if not self.readable():
+            raise io.UnsupportedOperation("File not open for reading.")
+
+        view = memoryview(buffer).cast("B")
+        size = max(0, min(len(view), self._length - self._position))
+        if size == 0:
+            return 0
+
+        read = self.readahead.readinto(self._position, view[:size])
+        self._position += read
+        return read
+
+    def readline(self, size: Optional[int] = -1) -> bytes:
+        self._check_closed()
+        if not self.readable():
+            raise io.UnsupportedOperation("File not open for reading.")
+
+        remaining = max(0, self._length - self._position)
+        if size is not None and size >= 0:
+            remaining = min(size, remaining)
+
+        line = self.readahead.readline(self._position, remaining)
+        self._position += len(line)
+        return line
+
+    def write(self, data) -> int:
+        self._check_closed()
+        if not self.writable():
+            raise io.UnsupportedOperation("File not open for writing.")
+
+        if self.mode == "ab":
+            self._position = self._length
+
+        written = self.file_system.pwrite(self.file_node, self._position, bytes(data))
+        self.readahead.invalidate()
+        self._position += written
+        return written
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        self._check_closed()
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            position = self._length + offset
+        elif whence == SEEK_DATA:
+            position = self.file_system.seek_data(self.file_node, offset)
+        elif whence == SEEK_HOLE:
+            position = self.file_system.seek_hole(self.file_node, offset)
+        else:
+            raise ValueError(f"Invalid whence: {whence}")
+
+        if position < 0:
+            raise ValueError(f"Negative seek position {position}")
+        self._position = position
+        return position
+
+    def data_ranges(self) -> Iterator[Tuple[int, int]]:
+        """
+        Yields the start and end of every range of the file that holds data, so
+        exporters can skip the holes. The position of the stream is unchanged.
+        """
+        self._check_closed()
+        length = self._length
+        offset = 0
+        while offset < length:
+            start = self.file_system.seek_data(self.file_node, offset)
+            offset = self.file_system.seek_hole(self.file_node, start)
+            yield start, offset
+
+    def tell(self) -> int:
+        self._check_closed()
+        return self._position
+
+    def _check_closed(self) -> None:
+        if self.closed:
+            raise ValueError("I/O operation on closed file.")
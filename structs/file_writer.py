@@ -0,0 +1,416 @@
+"""
+Module containing the FileWriter class, a streaming write handle that creates a
+new file from data arriving in chunks and is returned by
+FileSystemApi.create_writer.
+"""
+
+import io
+import math
+from typing import TYPE_CHECKING, Callable, List, Optional, Tuple
+
+from core.compression import CompressedLayout
+from core.sparse import HOLE_SIZE, SparseLayout
+from structs.file_index_node import FileIndexNode
+
+if TYPE_CHECKING:
+    from core.file_system import FileSystem
+
+
+class FileWriter(io.RawIOBase):
+    """
+    A write-only stream that creates a file. Incoming chunks are buffered and no
+    blocks are allocated until the buffer fills up, flush is called or the writer
+    is closed, so the extent can be sized from the final or expected size and
+    placed in one contiguous run. The extent is only reserved in memory until the
+    file appears in its directory once the writer is closed, in the same
+    transaction, and cancel discards everything written so far.
+
+    In a directory that compresses its files the data is compressed chunk by
+    chunk as it arrives, and stored as it is when that does not pay off, like
+    create_file does. Otherwise aligned chunks of zeros are never written, the
+    chunks with data are stored back to back, and once the writer is closed
+    they get the table of a sparse file in front of them, or are spread out to
+    their offsets when leaving out the holes does not pay off.
+
+    Attributes:
+        bytes_written (int): The number of bytes accepted so far.
+        size_hint (Optional[int]): The expected final size, if known.
+        compress (bool): Whether the data is being compressed.
+    """
+
+    BUFFER_SIZE = 1024 * 1024
+
+    def __init__(
+        self,
+        file_system: "FileSystem",
+        file_path: str,
+        size_hint: Optional[int] = None,
+        on_progress: Optional[Callable[[int, Optional[int]], None]] = None,
+    ) -> None:
+        super().__init__()
+        self.file_system = file_system
+        self.file_path = file_path
+        self.name = file_path
+        self.size_hint = size_hint
+        self.on_progress = on_progress
+        self.bytes_written = 0
+        self.cancelled = False
+
+        # Files follow the compression default of their directory
+        parent_node = file_system.resolve_path(file_path.rsplit("/", 1)[0] or "/")
+        self.compress = bool(parent_node and parent_node.is_compressed)
+
+        self._buffer = bytearray()
+        self._file_node: Optional[FileIndexNode] = None
+        # The bytes of the file taken from the buffer and of the extent written
+        self._consumed = 0
+        self._stored = 0
+        self._finished = False
+        # The offset and length of every run of data stored so far
+        self._runs: List[Tuple[int, int]] = []
+
+        # While compressing, the end of every chunk written, and the last chunk
+        # with data, which is held back with the chunks of zeros after it since
+        # the file ends at its last non zero byte
+        self._chunk_ends: List[int] = []
+        self._held: Optional[Tuple[bytes, bytes]] = None
+        self._held_offset = 0
+        self._zero_chunks = 0
+        self._gave_up = False
+
+    @property
+    def progress(self) -> Optional[float]:
+        """The fraction of size_hint written so far, None without a hint."""
+        if not self.size_hint:
+            return None
+        return min(1.0, self.bytes_written / self.size_hint)
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        if self.closed:
+            raise ValueError("I/O operation on closed file.")
+
+        self._buffer += data
+        written = len(data)
+        self.bytes_written += written
+
+        if len(self._buffer) >= self.BUFFER_SIZE:
+            self._write_buffer()
+        if self.on_progress:
+            self.on_progress(self.bytes_written, self.size_hint)
+        return written
+
+    def flush(self) -> None:
+        # io.RawIOBase.close flushes too, after the file was created or discarded
+        if not (self.closed or self.cancelled or self._finished):
+            self._write_buffer()
+
+    def cancel(self) -> None:
+        """Discards the data written so far and releases its blocks."""
+        if self.closed:
+            return
+
+        self.cancelled = True
+        if self._file_node:
+            self.file_system.bitmap_manager.free_range(
+                self._file_node.file_start_block, self._file_node.file_blocks
+            )
+        self._buffer.clear()
+        super().close()
+
+    def close(self) -> None:
+        """Writes the remaining data, trims the extent and creates the file."""
+        if self.closed:
+            return
+
+        try:
+            self._write_buffer(True)
+            self._finish()
+        except Exception:
+            self.cancel()
+            raise
+        super().close()
+
+    def _write_buffer(self, final: bool = False) -> None:
+        if self.compress:
+            self._compress_buffer(final)
+        if not self.compress:
+            self._pack_buffer(final)
+
+    def _pack_buffer(self, final: bool) -> None:
+        """
+        Stores the whole chunks of HOLE_SIZE in the buffer, and the rest of it
+        with final, leaving out the chunks of zeros.
+        """
+        end = len(self._buffer)
+        if not final:
+            end -= end % HOLE_SIZE
+
+        run_start = None
+        for position in range(0, end, HOLE_SIZE):
+            chunk_end = min(position + HOLE_SIZE, end)
+            if self._buffer.count(0, position, chunk_end) < chunk_end - position:
+                if run_start is None:
+                    run_start = position
+            elif run_start is not None:
+                self._store_run(run_start, position)
+                run_start = None
+        if run_start is not None:
+            self._store_run(run_start, end)
+
+        self._consumed += end
+        del self._buffer[:end]
+
+    def _store_run(self, start: int, end: int) -> None:
+        """Stores the data between start and end of the buffer as a run."""
+        offset = self._consumed + start
+        if self._runs and sum(self._runs[-1]) == offset:
+            self._runs[-1] = (self._runs[-1][0], self._runs[-1][1] + end - start)
+        else:
+            self._runs.append((offset, end - start))
+        self._store(self._buffer[start:end])
+
+    def _compress_buffer(self, final: bool) -> None:
+        """
+        Compresses the whole chunks in the buffer, and the rest of it with final.
+        """
+        compressor = self.file_system.compressor
+        codec, chunk_size = compressor.codec, compressor.chunk_size
+        while len(self._buffer) >= chunk_size or (final and self._buffer):
+            chunk = bytes(self._buffer[:chunk_size])
+            if chunk.count(0) == len(chunk):
+                del self._buffer[:chunk_size]
+                self._zero_chunks += 1
+                self._consumed += len(chunk)
+                continue
+
+            compressed = compressor.compress_chunks(codec, chunk_size, chunk)[0]
+            if not self._consumed and not compressor.first_chunk_pays_off(
+                chunk, compressed
+            ):
+                # Like in create_file, data whose first chunk does not compress
+                # is given up on early
+                self.compress = False
+                self._gave_up = True
+                return
+
+            del self._buffer[:chunk_size]
+            self._store_held()
+            self._held = (chunk, compressed)
+            self._held_offset = self._consumed
+            self._consumed += len(chunk)
+
+    def _store_held(self) -> None:
+        """Writes the chunk held back and the chunks of zeros after it."""
+        if self._held is not None:
+            self._store_chunk(self._held[1])
+            self._held = None
+        if self._zero_chunks:
+            compressor = self.file_system.compressor
+            zeros = compressor.compress_chunks(
+                compressor.codec, compressor.chunk_size, bytes(compressor.chunk_size)
+            )[0]
+            for _ in range(self._zero_chunks):
+                self._store_chunk(zeros)
+            self._zero_chunks = 0
+
+    def _store_chunk(self, compressed: bytes) -> None:
+        self._store(compressed)
+        self._chunk_ends.append(self._stored)
+
+    def _store(self, data) -> None:
+        """Writes data to the extent after what was stored so far."""
+        self._reserve(self._stored + len(data))
+        if data:
+            self.file_system.storage.write_at(
+                self.file_system.data_offset(self._file_node.file_start_block)
+                + self._stored,
+                data,
+            )
+            self._stored += len(data)
+
+    def _reserve(self, size: int) -> None:
+        """Makes sure the extent holds at least size bytes."""
+        block_size = self.file_system.config_manager.block_size
+        required_blocks = max(1, math.ceil(size / block_size))
+
+        if self._file_node is None:
+            expected_blocks = math.ceil((self.size_hint or 0) / block_size)
+            blocks = max(required_blocks, expected_blocks)
+            self._file_node = FileIndexNode(
+                file_name="",
+                file_start_block=self.file_system.allocate_extent(blocks, True),
+                file_blocks=blocks,
+                id=0,
+            )
+        elif required_blocks > self._file_node.file_blocks:
+            # The estimate was short: grow geometrically so a long stream
+            # is only extended a logarithmic number of times
+            self.file_system.grow_extent(
+                self._file_node,
+                max(required_blocks, self._file_node.file_blocks * 2),
+                False,
+                reserve=True,
+            )
+
+    def _move(self, source: int, target: int, length: int) -> None:
+        """
+        Moves length bytes of the extent from source to a target after it,
+        copying from the end so nothing is overwritten before it is read.
+        """
+        storage = self.file_system.storage
+        start = self.file_system.data_offset(self._file_node.file_start_block)
+        end = length
+        while end > 0:
+            size = min(self.file_system.COPY_CHUNK_SIZE, end)
+            chunk = storage.read_at(start + source + end - size, size)
+            storage.write_at(start + target + end - size, chunk)
+            end -= size
+
+    def _finish_packed(self) -> int:
+        """
+        Puts the table of a sparse file in front of the runs, or moves the runs
+        to their offsets in the file and zeroes the holes between them.
+
+        :return: The length of the data, which ends at its last non zero byte.
+        """
+        file_system = self.file_system
+        storage = file_system.storage
+        if self._runs:
+            # Only the last chunk of the last run can end with zeros
+            offset, run_length = self._runs[-1]
+            tail_size = min(run_length, HOLE_SIZE)
+            tail = storage.read_at(
+                file_system.data_offset(self._file_node.file_start_block)
+                + self._stored
+                - tail_size,
+                tail_size,
+            )
+            trimmed = tail_size - len(bytes(tail).rstrip(b"\0"))
+            self._runs[-1] = (offset, run_length - trimmed)
+            self._stored -= trimmed
+
+        layout = SparseLayout(sum(self._runs[-1]) if self._runs else 0, self._runs)
+        if layout.pays_off(file_system.config_manager.block_size):
+            self._reserve(layout.stored_size)
+            start = file_system.data_offset(self._file_node.file_start_block)
+            self._move(0, layout.data_start, self._stored)
+            storage.write_at(start, layout.to_bytes())
+            self._stored = layout.stored_size
+            self._file_node.is_sparse = True
+            self._file_node.data_length = layout.length
+            return layout.length
+
+        # Stored as it is, the runs move towards the end, so the last one goes
+        # first, and whatever they leave between them is zeroed
+        self._reserve(layout.length)
+        start = file_system.data_offset(self._file_node.file_start_block)
+        for (offset, run_length), position in reversed(
+            list(zip(layout.runs, layout.positions))
+        ):
+            self._move(position - layout.data_start, offset, run_length)
+        hole_start = 0
+        for offset, run_length in layout.runs + [(layout.length, 0)]:
+            for position in range(hole_start, offset, file_system.COPY_CHUNK_SIZE):
+                size = min(file_system.COPY_CHUNK_SIZE, offset - position)
+                storage.write_at(start + position, bytes(size))
+            hole_start = offset + run_length
+        self._stored = layout.length
+        return layout.length
+
+    def _finish_compressed(self) -> None:
+        """
+        Writes the last chunk and the chunk table in front of the chunks, or
+        stores the data as it is when compressing it does not pay off.
+        """
+        file_system = self.file_system
+        compressor = file_system.compressor
+        length = 0
+        if self._held is not None:
+            chunk = self._held[0].rstrip(b"\0")
+            length = self._held_offset + len(chunk)
+            self._held = (
+                chunk,
+                compressor.compress_chunks(compressor.codec, len(chunk), chunk)[0],
+            )
+        # Chunks of zeros at the end are not part of the file
+        self._zero_chunks = 0
+        self._store_held()
+
+        layout = CompressedLayout(
+            compressor.codec, compressor.chunk_size, length, self._chunk_ends
+        )
+        block_size = file_system.config_manager.block_size
+        if not compressor.pays_off(length, layout.stored_size, block_size):
+            compressor.count_file(length, None)
+            self._decompress_extent(layout)
+            return
+
+        compressor.count_file(length, layout.stored_size)
+        self._reserve(layout.stored_size)
+        self._move(0, layout.data_start, self._stored)
+        file_system.storage.write_at(
+            file_system.data_offset(self._file_node.file_start_block),
+            layout.to_bytes(),
+        )
+        self._stored = layout.stored_size
+        self._file_node.is_compressed = True
+        self._file_node.data_length = length
+
+    def _decompress_extent(self, layout: CompressedLayout) -> None:
+        """Stores the chunks written so far without compression, in a new extent."""
+        compressor = self.file_system.compressor
+        storage = self.file_system.storage
+        compressed_node = self._file_node
+
+        self.compress = False
+        if compressed_node is None:
+            return
+
+        self._file_node = None
+        self._consumed = 0
+        self._stored = 0
+        start = self.file_system.data_offset(compressed_node.file_start_block)
+        chunk_start = 0
+        for chunk_end in layout.ends:
+            chunk = storage.read_at(start + chunk_start, chunk_end - chunk_start)
+            self._buffer += compressor.decompress(layout.codec, bytes(chunk))
+            self._pack_buffer(False)
+            chunk_start = chunk_end
+        self.file_system.bitmap_manager.free_range(
+            compressed_node.file_start_block, compressed_node.file_blocks
+        )
+
+    def _finish(self) -> None:
+        if self.compress:
+            self._finish_compressed()
+        if not self.compress:
+            self._pack_buffer(True)
+            length = self._finish_packed()
+            if self._gave_up:
+                self.file_system.compressor.count_file(length, None)
+
+        block_size = self.file_system.config_manager.block_size
+        self._reserve(self._stored)
+        used_blocks = max(1, math.ceil(self._stored / block_size))
+        file_node = self._file_node
+
+        # Zero the rest of the last block, the file ends at its last data byte
+        padding = used_blocks * block_size - self._stored
+        self.file_system.storage.write_at(
+            self.file_system.data_offset(file_node.file_start_block) + self._stored,
+            bytes(padding),
+        )
+
+        if file_node.file_blocks > used_blocks:
+            self.file_system.bitmap_manager.free_range(
+                file_node.file_start_block + used_blocks,
+                file_node.file_blocks - used_blocks,
+            )
+            file_node.file_blocks = used_blocks
+
+        file_node.id = self.file_system.metedata_manager.increment_id()
+        self.file_system.link_file(self.file_path, file_node, reserved=True)
+        self._finished = True
@@ -21,6 +21,41 @@ class Metadata:
         file_name_size (int): The size of each file name in bytes. Defaults to 36
             bytes.
         current_id (int): The current id of the metadata. Defaults to 1.
+        sorted_directories (bool): Whether directory entries are kept ordered by
+            name for lookups and listings. Defaults to False.
+        directory_initial_blocks (int): The number of blocks a new directory
+            starts with. Defaults to 4.
+        directory_growth_factor (float): How much a full directory grows by.
+            Defaults to 2.
+        directory_max_growth_blocks (int): The most blocks a directory grows by
+            at once. Defaults to 4096.
+        storage_backend (str): How the image is accessed, "file" for O_SYNC
+            reads and writes or "mmap" to map it into memory. Defaults to "file".
+        durability (str): When writes reach the disk, "sync" for every write,
+            "commit" for once per transaction or "group" for one flush shared
+            by the transactions of all sessions within a short window. Defaults
+            to "sync".
+        block_cache_size (int): The size in bytes of the in memory cache of
+            image pages, written back on every commit. Only used with the "file"
+            backend, 0 disables it. Defaults to 4MB.
+        compression (str): The codec of compressed files, "zlib" or "lzma".
+            Defaults to "zlib".
+        dedup (bool): Whether new files whose data is already stored share
+            the existing extent. Defaults to False.
+        large_block_size (int): The size of the blocks of the large block region.
+            Defaults to 4KB.
+        large_region_size (int): How many bytes at the end of file_system_size
+            form the large block region, the rest is made of blocks of
+            block_size. Defaults to 0, a single region.
+        large_file_threshold (int): Extents of at least this many bytes are
+            placed in the large block region. Defaults to 16KB.
+        bitmap_offset (int): Where the bitmaps are in the image. Defaults to 0,
+            the start of the image.
+        index_offset (int): Where the file index is in the image. Defaults to 0,
+            right after the bitmaps.
+        data_start (int): Where the first data block is in the image. Defaults
+            to 0, right after the file index. The three are only set once grow
+            has moved a structure.
     """
 
     file_system_path: str
@@ -29,3 +64,18 @@ class Metadata:
     file_system_size: int = 1024 * 1024 * 80
     file_name_size: int = 36
     current_id: int = 1
+    sorted_directories: bool = False
+    directory_initial_blocks: int = 4
+    directory_growth_factor: float = 2
+    directory_max_growth_blocks: int = 4096
+    storage_backend: str = "file"
+    durability: str = "sync"
+    block_cache_size: int = 1024 * 1024 * 4
+    compression: str = "zlib"
+    dedup: bool = False
+    large_block_size: int = 4096
+    large_region_size: int = 0
+    large_file_threshold: int = 16 * 1024
+    bitmap_offset: int = 0
+    index_offset: int = 0
+    data_start: int = 0
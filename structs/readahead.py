@@ -0,0 +1,165 @@
+"""
+Module containing the Readahead class, which detects sequential reads on a
+FileStream and fetches the data ahead of them in large windows.
+"""
+
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from core.file_system import FileSystem
+    from structs.file_index_node import FileIndexNode
+
+
+class Readahead:
+    """
+    Serves reads of one file from a reusable buffer. A read that starts where
+    the previous one ended, inside the buffer or at the start of the file is
+    sequential: the buffer is refilled from there with a single read of the
+    current window, which starts at INITIAL_WINDOW and doubles on every refill
+    up to max_window. A random read resets the window and goes straight to the
+    volume.
+
+    Attributes:
+        hits (int): Reads served entirely from the buffer.
+        misses (int): Reads that needed the volume.
+        fetches (int): Windows read ahead.
+        bytes_fetched (int): The total size of those windows.
+    """
+
+    INITIAL_WINDOW = 64 * 1024
+    # What readline reads at least when the window is reset
+    LINE_CHUNK = 4096
+    MAX_WINDOW = 2 * 1024 * 1024
+
+    def __init__(
+        self,
+        file_system: "FileSystem",
+        file_node: "FileIndexNode",
+        max_window: int = MAX_WINDOW,
+    ) -> None:
+        self.file_system = file_system
+        self.file_node = file_node
+        self.max_window = max_window
+        self.window = 0
+
+        self._buffer = bytearray()
+        self._buffer_start = 0
+        self._buffer_end = 0
+        self._next_offset = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.fetches = 0
+        self.bytes_fetched = 0
+
+    def readinto(self, offset: int, buffer: memoryview) -> int:
+        """
+        Fills buffer with the file's data at offset.
+
+        :param offset: The byte offset in the file.
+        :param buffer: The buffer to fill, no longer than the rest of the file.
+        :return: The number of bytes read.
+        """
+        size = len(buffer)
+        copied = self._copy_buffered(offset, buffer)
+        if copied == size:
+            self.hits += 1
+            self._next_offset = offset + size
+            return size
+
+        self.misses += 1
+        position = offset + copied
+        remaining = buffer[copied:]
+        # Reads that continue from the buffer are still sequential
+        self._advance_window(copied > 0 or offset == self._next_offset)
+
+        # Reads at least as large as the window gain nothing from the buffer
+        if len(remaining) < self.window:
+            self._fetch(position, self.window)
+            read = self._copy_buffered(position, remaining)
+        else:
+            read = self.file_system.read_into(self.file_node, position, remaining)
+
+        self._next_offset = position + read
+        return copied + read
+
+    def readline(self, offset: int, limit: int) -> bytes:
+        """
+        Reads a line by searching the buffer for the newline, so the data is
+        only copied once.
+
+        :param offset: The byte offset in the file the line starts at.
+        :param limit: The most bytes to return, no more than the rest of the file.
+        :return: The line including its newline, if one was found within limit.
+        """
+        # Most lines are found whole in the buffer
+        start = offset - self._buffer_start
+        if 0 <= start and offset < self._buffer_end:
+            end = min(self._buffer_end - self._buffer_start, start + limit)
+            newline = self._buffer.find(b"\n", start, end)
+            if newline != -1:
+                self.hits += 1
+                self._next_offset = self._buffer_start + newline + 1
+                return bytes(memoryview(self._buffer)[start : newline + 1])
+
+        line = bytearray()
+        fetched = False
+        while len(line) < limit:
+            if not self._buffer_start <= offset < self._buffer_end:
+                # A line running past the buffer continues sequentially
+                self._advance_window(offset == self._next_offset or bool(line))
+                self._fetch(offset, max(self.window, self.LINE_CHUNK))
+                fetched = True
+                if self._buffer_end <= offset:
+                    break
+
+            start = offset - self._buffer_start
+            end = min(self._buffer_end - self._buffer_start, start + limit - len(line))
+            newline = self._buffer.find(b"\n", start, end)
+            if newline != -1:
+                end = newline + 1
+            line += memoryview(self._buffer)[start:end]
+            offset += end - start
+            if newline != -1:
+                break
+
+        if fetched:
+            self.misses += 1
+        else:
+            self.hits += 1
+        self._next_offset = offset
+        return bytes(line)
+
+    def invalidate(self) -> None:
+        """Drops the buffered data, called after the file is written."""
+        self._buffer_start = self._buffer_end = 0
+
+    def _copy_buffered(self, offset: int, buffer: memoryview) -> int:
+        if not self._buffer_start <= offset < self._buffer_end:
+            return 0
+
+        size = min(len(buffer), self._buffer_end - offset)
+        start = offset - self._buffer_start
+        buffer[:size] = memoryview(self._buffer)[start : start + size]
+        return size
+
+    def _advance_window(self, sequential: bool) -> None:
+        if not sequential or not self.max_window:
+            self.window = 0
+        else:
+            self.window = min(
+                self.max_window,
+                self.window * 2 if self.window else self.INITIAL_WINDOW,
+            )
+
+    def _fetch(self, offset: int, size: int) -> None:
+        if len(self._buffer) < size:
+            self._buffer = bytearray(size)
+
+        read = self.file_system.read_into(
+            self.file_node, offset, memoryview(self._buffer)[:size]
+        )
+        self._buffer_start = offset
+        self._buffer_end = offset + read
+        self.fetches += 1
+        self.bytes_fetched += read
@@ -1,20 +1,31 @@
 """pytest  module"""
 
+import asyncio
+import inspect
+import io
 import os
+import shutil
+import threading
 import uuid
 import pytest
+from async_file_system_api import AsyncFileSystemApi
+from core.block_device import BlockDevice
+from core.storage_backend import MmapBackend
 from file_system_api import FileSystemApi
+from managers.block_cache import ArcCache
+
+
+@pytest.fixture(autouse=True)
+def file_system_path(tmp_path, monkeypatch):
+    """Keep the images the tests create in a fresh temporary directory."""
+    monkeypatch.setattr(FileSystemApi, "FS_PATH", str(tmp_path))
+    return tmp_path
 
 
 @pytest.fixture
 def file_system_api():
     """Initialize the FileSystemApi with a real file system."""
-    user_id = "test_user"
-    if FileSystemApi.file_system_exists(user_id):
-        os.remove(f"{FileSystemApi.FS_PATH}/test_user.disk")
-        os.remove(f"{FileSystemApi.FS_PATH}/test_user.disk.dt")
-
-    return FileSystemApi.create_new_file_system(user_id=user_id)
+    return FileSystemApi.create_new_file_system(user_id="test_user")
 
 
 def test_create_empty_file(file_system_api):
@@ -49,3 +60,1191 @@ def test_get_file_metadata(file_system_api):
     # Validate metadata
     assert metadata.file_name == "test_file.txt"
     assert metadata.is_directory is False
+
+
+def test_delete_files_keeps_remaining_children(file_system_api):
+    file_system_api.create_directory("many")
+    names = [f"file_{i}.txt" for i in range(20)]
+    for name in names:
+        file_system_api.create_file(f"many/{name}", name.encode())
+
+    for name in names[::3]:
+        file_system_api.delete_file(f"many/{name}")
+
+    remaining = set(names) - set(names[::3])
+    assert set(file_system_api.list_directory_contents("many")) == remaining
+    for name in remaining:
+        assert file_system_api.read_file(f"many/{name}") == name.encode()
+
+    file_system_api.delete_directory("many")
+    assert not file_system_api.exists("many")
+
+
+def test_remove_child_reads_children_area_once(file_system_api, monkeypatch):
+    from structs.file_index_node import FileIndexNode
+
+    file_system_api.create_directory("wide")
+    names = [f"file_{i}" for i in range(200)]
+    file_system_api.create_files("wide", {name: name.encode() for name in names})
+    file_system_api.delete_file(f"wide/{names[0]}")
+
+    full_reads = []
+    read_children_ids = FileIndexNode.read_children_ids
+
+    def counting_read(self, file_system, start=0, count=None):
+        if count is None:
+            full_reads.append(self.file_name)
+        return read_children_ids(self, file_system, start, count)
+
+    monkeypatch.setattr(FileIndexNode, "read_children_ids", counting_read)
+    wide = file_system_api.file_system.resolve_path("wide")
+    for name in names[1:150]:
+        wide.remove_child(file_system_api.file_system, name)
+    assert full_reads == []
+
+    # Resolving the path reads the children, only the removal is counted
+    file_system_api.rename_file(f"wide/{names[150]}", "renamed")
+    full_reads.clear()
+    wide.remove_child(file_system_api.file_system, "renamed")
+    assert full_reads == []
+    assert wide.children_count == 49
+    assert sorted(
+        file_system_api.file_system.index_manager.index[child_id].file_name
+        for child_id in read_children_ids(wide, file_system_api.file_system)
+    ) == sorted(names[151:])
+
+
+def test_rename_keeps_names_unique_and_rolls_back(file_system_api, monkeypatch):
+    file_system_api.create_file("a", b"a")
+    file_system_api.create_file("b", b"b")
+    with pytest.raises(FileExistsError):
+        file_system_api.rename_file("a", "b")
+    assert sorted(file_system_api.list_directory_contents("/")) == ["a", "b"]
+
+    index_manager = file_system_api.file_system.index_manager
+    write_to_index = index_manager.write_to_index
+
+    def failing_write(file_index):
+        raise OSError("disk error")
+
+    monkeypatch.setattr(index_manager, "write_to_index", failing_write)
+    with pytest.raises(OSError):
+        file_system_api.rename_file("a", "c")
+    monkeypatch.setattr(index_manager, "write_to_index", write_to_index)
+    assert sorted(file_system_api.list_directory_contents("/")) == ["a", "b"]
+    assert file_system_api.read_file("a") == b"a"
+
+    # The name to slot map still finds the child under its old name
+    file_system_api.delete_file("a")
+    file_system_api.rename_file("b", "a")
+    assert file_system_api.list_directory_contents("/") == ["a"]
+    assert file_system_api.read_file("a") == b"b"
+
+
+def test_delete_directory_with_file_before_subdirectory(file_system_api):
+    file_system_api.create_directory("p")
+    file_system_api.create_file("p/file", b"file")
+    file_system_api.create_directory("p/sub")
+    file_system_api.create_file("p/sub/x", b"x")
+    free_space = file_system_api.get_free_space()
+
+    file_system_api.delete_directory("/p")
+    assert not file_system_api.exists("p")
+    assert not file_system_api.exists("p/sub/x")
+    assert file_system_api.get_free_space() > free_space
+    assert "p" not in file_system_api.list_directory_contents("/")
+
+
+def test_sorted_directories_list_in_name_order():
+    user_id = "test_user_sorted"
+
+    api = FileSystemApi.create_new_file_system(
+        user_id=user_id, metadata={"sorted_directories": True}
+    )
+    for name in ["delta", "alpha", "charlie", "bravo", "echo"]:
+        api.create_file(name, name.encode())
+    api.rename_file("echo", "aardvark")
+    api.delete_file("charlie")
+
+    assert api.list_directory_contents("/") == ["aardvark", "alpha", "bravo", "delta"]
+    assert api.list_directory_contents("/", start_after="alpha", limit=2) == [
+        "bravo",
+        "delta",
+    ]
+    assert api.read_file("aardvark") == b"echo"
+
+    reopened = FileSystemApi(user_id)
+    assert reopened.file_system.sorted_directory_manager is not None
+    assert reopened.list_directory_contents("/")[0] == "aardvark"
+
+
+def test_create_files_in_one_call(file_system_api):
+    file_system_api.create_directory("bulk")
+    file_system_api.create_file("bulk/existing.txt", b"old")
+    files = {f"file_{i}.txt": bytes([65 + i % 26]) * (i * 7) for i in range(40)}
+
+    file_system_api.create_files("bulk", files)
+
+    assert set(file_system_api.list_directory_contents("bulk")) == set(files) | {
+        "existing.txt"
+    }
+    for name, data in files.items():
+        assert file_system_api.read_file(f"bulk/{name}") == data
+
+    with pytest.raises(Exception):
+        file_system_api.create_files("bulk", {"existing.txt": b"new", "x": b""})
+    assert "x" not in file_system_api.list_directory_contents("bulk")
+
+
+def test_directory_grows_in_place_or_relocates(file_system_api):
+    file_system = file_system_api.file_system
+    file_system_api.create_directory("grow")
+    directory = file_system.resolve_path("/grow")
+    start_block = directory.file_start_block
+
+    # Nothing was allocated after the directory, so it is extended in place
+    file_system.grow_directory(directory, directory.file_blocks + 1)
+    assert directory.file_start_block == start_block
+
+    names = [f"f{i}" for i in range(100)]
+    for name in names:
+        file_system_api.create_file(f"grow/{name}", name.encode())
+
+    directory = file_system.resolve_path("/grow")
+    assert directory.file_blocks * file_system.config_manager.block_size > 4 * 100
+    assert sorted(file_system_api.list_directory_contents("grow")) == sorted(names)
+    assert file_system_api.read_file("grow/f42") == b"f42"
+
+
+def test_dentry_cache_follows_namespace_changes(file_system_api):
+    file_system = file_system_api.file_system
+    file_system_api.create_directory("docs")
+
+    # A miss is cached as a negative entry and must not survive the create
+    assert not file_system_api.exists("docs/a.txt")
+    assert not file_system_api.exists("docs/a.txt")
+    file_system_api.create_file("docs/a.txt", b"a")
+    assert file_system_api.exists("docs/a.txt")
+
+    hits = file_system.dentry_cache.hits
+    file_system.resolve_path("/docs/a.txt")
+    assert file_system.dentry_cache.hits == hits + 1
+
+    file_system_api.rename_directory("docs", "papers")
+    assert not file_system_api.exists("docs/a.txt")
+    assert file_system_api.read_file("papers/a.txt") == b"a"
+
+    file_system_api.create_directory("archive")
+    file_system_api.move_file("papers/a.txt", "archive")
+    assert not file_system_api.exists("papers/a.txt")
+    assert file_system_api.exists("archive/a.txt")
+
+    file_system_api.delete_file("archive/a.txt")
+    assert not file_system_api.exists("archive/a.txt")
+    file_system_api.delete_directory("papers")
+    assert not file_system_api.exists("papers")
+
+
+def test_dentry_cache_drops_misses_below_renamed_and_moved_paths(file_system_api):
+    file_system_api.create_directory("x")
+    file_system_api.create_file("x/b", b"b")
+    assert not file_system_api.exists("a/b")
+    file_system_api.rename_directory("x", "a")
+    assert file_system_api.exists("a/b")
+    assert file_system_api.read_file("a/b") == b"b"
+
+    file_system_api.create_directory("dest")
+    assert not file_system_api.exists("dest/a/b")
+    file_system_api.move_directory("a", "dest")
+    assert file_system_api.read_file("dest/a/b") == b"b"
+
+    file_system_api.create_directory("y")
+    assert not file_system_api.exists("dest/y/c")
+    file_system_api.create_file("y/c", b"c")
+    file_system_api.move_file("y", "dest")
+    assert file_system_api.read_file("dest/y/c") == b"c"
+
+
+def test_handles_resolve_once_and_go_stale(file_system_api):
+    file_system_api.create_directory("docs")
+    file_system_api.create_file("docs/a.txt", b"hello")
+
+    handle = file_system_api.lookup("docs/a.txt")
+    assert handle.path == "/docs/a.txt"
+    assert file_system_api.read_file(handle) == b"hello"
+    assert file_system_api.stat(handle).file_name == "a.txt"
+
+    file_system_api.edit_file(handle, b"hello again")
+    assert file_system_api.read_file(handle) == b"hello again"
+
+    docs = file_system_api.lookup("docs")
+    assert file_system_api.list_directory_contents(docs) == ["a.txt"]
+
+    file_system_api.rename_file(handle, "b.txt")
+    with pytest.raises(FileNotFoundError):
+        file_system_api.read_file(handle)
+
+    handle = file_system_api.lookup("docs/b.txt")
+    file_system_api.delete_file(handle)
+    assert not file_system_api.exists("docs/b.txt")
+
+
+def test_scan_directory_and_stat_many(file_system_api):
+    file_system_api.create_directory("docs")
+    file_system_api.create_directory("docs/sub")
+    file_system_api.create_file("docs/a.txt", b"a" * 100)
+
+    scanned = {meta.file_name: meta for meta in file_system_api.scan_directory("docs")}
+    assert set(scanned) == {"sub", "a.txt"}
+    assert scanned["sub"].is_directory
+    assert scanned["a.txt"].file_path == "/docs/a.txt"
+    assert scanned["a.txt"].file_size == file_system_api.stat("docs/a.txt").file_size
+
+    after = [meta.file_name for meta in file_system_api.scan_directory("docs", "sub")]
+    assert after == ["a.txt"]
+    assert list(file_system_api.scan_directory("docs", start_after="zz")) == []
+    assert file_system_api.list_directory_contents("docs", start_after="zz") == []
+
+    results = file_system_api.stat_many(["docs/a.txt", "docs/missing", "/", "docs/sub"])
+    assert results[0].file_name == "a.txt"
+    assert results[1] is None
+    assert results[2].is_directory
+    assert results[3].file_path == "/docs/sub"
+
+
+def test_list_page_walks_directory_with_cursors(file_system_api):
+    file_system_api.create_directory("many")
+    names = [f"file_{i:03d}" for i in range(25)]
+    file_system_api.create_files("many", dict.fromkeys(names, b"x"))
+
+    listed = []
+    cursor = None
+    pages = 0
+    while True:
+        page, cursor = file_system_api.list_page("many", cursor, limit=10)
+        listed.extend(meta.file_name for meta in page)
+        pages += 1
+        if cursor is None:
+            break
+
+    assert pages == 3
+    assert sorted(listed) == names
+    assert [m.file_name for m in file_system_api.iter_directory("many", 4)] == listed
+
+    with pytest.raises(ValueError):
+        file_system_api.list_page("many", "not a cursor!", limit=10)
+
+
+def test_open_streams_file_contents(file_system_api):
+    data = b"".join(f"line {i}\n".encode() for i in range(200))
+    file_system_api.create_file("stream.txt", data)
+
+    with file_system_api.open("stream.txt") as stream:
+        assert stream.readline() == b"line 0\n"
+        stream.seek(-8, io.SEEK_END)
+        assert stream.read() == b"ine 199\n"
+        stream.seek(0)
+        buffer = bytearray(100)
+        assert stream.readinto(buffer) == 100
+        assert bytes(buffer) == data[:100]
+
+    with io.BufferedReader(file_system_api.open("stream.txt")) as reader:
+        assert reader.readlines() == data.splitlines(keepends=True)
+
+    with file_system_api.open("stream.txt", "r+b") as stream:
+        stream.seek(5)
+        stream.write(b"X")
+    with file_system_api.open("copy.txt", "ab") as stream:
+        shutil.copyfileobj(file_system_api.open("stream.txt"), stream, 77)
+        stream.write(b"tail")
+
+    expected = data[:5] + b"X" + data[6:] + b"tail"
+    assert file_system_api.read_file("copy.txt") == expected
+    assert file_system_api.read_file("stream.txt") == expected[:-4]
+
+    with pytest.raises(io.UnsupportedOperation):
+        file_system_api.open("stream.txt").write(b"no")
+
+
+def test_writer_streams_into_one_extent(file_system_api):
+    fs = file_system_api.file_system
+    chunk = bytes(range(1, 256)) * 40
+    progress = []
+
+    writer = file_system_api.create_writer(
+        "big.bin",
+        size_hint=len(chunk) * 3,
+        on_progress=lambda written, total: progress.append((written, total)),
+    )
+    writer.BUFFER_SIZE = len(chunk) * 2
+    for _ in range(4):
+        writer.write(chunk)
+    assert not file_system_api.exists("big.bin")
+    assert writer.progress == 1.0
+    writer.close()
+
+    assert progress[-1] == (len(chunk) * 4, len(chunk) * 3)
+    assert file_system_api.read_file("big.bin") == chunk * 4
+    node = fs.resolve_path("/big.bin")
+    assert node.file_blocks == -(-len(chunk) * 4 // fs.config_manager.block_size)
+
+    free_before = fs.bitmap_manager.get_free_blocks_count()
+    writer = file_system_api.create_writer("cancelled.bin")
+    writer.write(chunk)
+    writer.flush()
+    writer.cancel()
+    assert not file_system_api.exists("cancelled.bin")
+    assert fs.bitmap_manager.get_free_blocks_count() == free_before
+
+    with pytest.raises(FileExistsError):
+        file_system_api.create_writer("big.bin")
+
+
+def test_writer_blocks_are_not_marked_in_the_image_before_close(file_system_api):
+    fs = file_system_api.file_system
+    chunk = bytes(range(1, 256)) * 40
+    writer = file_system_api.create_writer("done.bin")
+    writer.write(chunk)
+    writer.close()
+
+    # Blocks of a writer that never closes are free again after a crash, even
+    # when a file created meanwhile writes the same bytes of the bitmap
+    writer = file_system_api.create_writer("lost.bin", size_hint=len(chunk) * 4)
+    writer.write(chunk)
+    writer.flush()
+    file_system_api.create_file("meanwhile.bin", b"meanwhile")
+    extent = (writer._file_node.file_start_block, writer._file_node.file_blocks)
+    assert not fs.bitmap_manager.is_range_free(*extent)
+    fs.shut_down()
+
+    remounted = FileSystemApi("test_user")
+    assert remounted.file_system.bitmap_manager.is_range_free(*extent)
+    assert remounted.read_file("done.bin") == chunk
+    assert remounted.read_file("meanwhile.bin") == b"meanwhile"
+    assert not remounted.exists("lost.bin")
+    remounted.file_system.shut_down()
+
+
+def test_pread_pwrite_touch_only_their_blocks(file_system_api):
+    fs = file_system_api.file_system
+    block_size = fs.config_manager.block_size
+    data = bytes(range(1, 256)) * 8
+    file_system_api.create_file("positional.bin", data)
+    node = fs.resolve_path("/positional.bin")
+
+    assert file_system_api.pread("positional.bin", 100, 10) == data[100:110]
+    assert file_system_api.pread("positional.bin", len(data) - 4, 10) == data[-4:]
+
+    reads = []
+    original_read = fs.storage.read_at
+    fs.storage.read_at = lambda offset, size: (
+        reads.append(size) or original_read(offset, size)
+    )
+    try:
+        file_system_api.pwrite("positional.bin", block_size + 3, b"\xff\xff")
+    finally:
+        fs.storage.read_at = original_read
+    assert reads == [block_size]
+
+    expected = data[: block_size + 3] + b"\xff\xff" + data[block_size + 5 :]
+    assert file_system_api.read_file("positional.bin") == expected
+
+    file_system_api.pwrite("positional.bin", len(data), b"grown")
+    assert file_system_api.read_file("positional.bin") == expected + b"grown"
+    assert node.file_blocks * block_size >= len(data) + 5
+
+    file_system_api.edit_file("positional.bin", b"short")
+    assert file_system_api.read_file("positional.bin") == b"short"
+
+
+def test_append_file_writes_only_the_tail(file_system_api):
+    fs = file_system_api.file_system
+    block_size = fs.config_manager.block_size
+    file_system_api.create_file("app.log", b"start\n")
+    node = fs.resolve_path("/app.log")
+
+    for i in range(50):
+        file_system_api.append_file("app.log", f"entry {i}\n".encode())
+
+    expected = b"start\n" + b"".join(f"entry {i}\n".encode() for i in range(50))
+    assert file_system_api.read_file("app.log") == expected
+    assert fs.get_file_length(node) == len(expected)
+
+    writes = []
+    original_write = fs.storage.write_at
+    fs.storage.write_at = lambda offset, data: (
+        writes.append(len(data)) or original_write(offset, data)
+    )
+    try:
+        file_system_api.append_file("app.log", b"x")
+    finally:
+        fs.storage.write_at = original_write
+    assert max(writes) <= block_size
+
+    node.data_length = None
+    assert fs.get_file_length(node) == len(expected) + 1
+
+
+def test_mmap_backend_round_trip():
+    user_id = "test_user_mmap"
+
+    api = FileSystemApi.create_new_file_system(
+        user_id=user_id, metadata={"storage_backend": "mmap"}
+    )
+    assert isinstance(api.file_system.storage, MmapBackend)
+
+    api.create_directory("docs")
+    api.create_file("docs/a.txt", b"a" * 100)
+    api.append_file("docs/a.txt", b"tail")
+    api.pwrite("docs/a.txt", 0, b"b")
+    assert api.pread("docs/a.txt", 0, 3) == b"baa"
+    api.file_system.shut_down()
+
+    reopened = FileSystemApi(user_id)
+    assert isinstance(reopened.file_system.storage, MmapBackend)
+    assert reopened.list_directory_contents("docs") == ["a.txt"]
+    assert reopened.read_file("docs/a.txt") == b"b" + b"a" * 99 + b"tail"
+    reopened.file_system.shut_down()
+
+
+def test_durability_modes_and_group_commit(monkeypatch):
+    user_id = "test_user_durability"
+
+    api = FileSystemApi.create_new_file_system(
+        user_id=user_id, metadata={"durability": "group"}
+    )
+    storage = api.file_system.storage
+    assert storage.durability == "group"
+
+    flushes = []
+    original_fsync = os.fsync
+    with monkeypatch.context() as patch:
+        patch.setattr(
+            os, "fsync", lambda fd: flushes.append(fd) or original_fsync(fd)
+        )
+        threads = [threading.Thread(target=storage.sync) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    assert 1 <= len(flushes) < 8
+
+    api.create_file("kept.txt", b"group")
+    api.file_system.shut_down()
+
+    remounted = FileSystemApi(user_id, durability="commit")
+    assert remounted.file_system.storage.durability == "commit"
+    assert remounted.read_file("kept.txt") == b"group"
+    remounted.file_system.shut_down()
+    assert FileSystemApi(user_id).file_system.storage.durability == "group"
+
+    with pytest.raises(ValueError):
+        FileSystemApi(user_id, durability="never")
+
+
+def test_group_commit_follows_recreated_image(tmp_path):
+    from core.storage_backend import _group_commits, open_storage
+
+    path = str(tmp_path / "image.disk")
+    with open(path, "wb") as image:
+        image.truncate(4096)
+    first = open_storage(path, "file", "group")
+    second = open_storage(path, "mmap", "group")
+    assert first.group_commit is second.group_commit
+    group_commit = first.group_commit
+    first.close()
+    second.close()
+    assert group_commit not in _group_commits.values()
+    with pytest.raises(OSError):
+        os.fstat(group_commit.fd)
+
+    os.remove(path)
+    with open(path, "wb") as image:
+        image.truncate(4096)
+    held = open_storage(path, "file", "group")
+    os.remove(path)
+    with open(path, "wb") as image:
+        image.truncate(4096)
+    recreated = open_storage(path, "file", "group")
+    assert recreated.group_commit is not held.group_commit
+    assert os.fstat(recreated.group_commit.fd).st_ino == os.stat(path).st_ino
+    held.close()
+    recreated.close()
+
+
+def test_block_cache_write_back_and_eviction():
+    user_id = "test_user_cache"
+
+    api = FileSystemApi.create_new_file_system(
+        user_id=user_id, metadata={"durability": "commit"}
+    )
+    cache = api.file_system.storage
+    api.create_directory("docs")
+    api.create_file("docs/hot.txt", b"hot" * 100)
+    assert not cache.dirty
+
+    api.read_file("docs/hot.txt")
+    misses = cache.misses
+    for _ in range(5):
+        assert api.read_file("docs/hot.txt") == b"hot" * 100
+        assert api.list_directory_contents("docs") == ["hot.txt"]
+    assert cache.misses == misses
+    assert cache.hits > 0
+
+    # Writes outside a transaction stay in the cache until the next sync
+    cache.write_at(cache.size - 10, b"0123456789")
+    assert cache.dirty
+    with open(cache.path, "rb") as image:
+        image.seek(cache.size - 10)
+        assert image.read() == bytes(10)
+    cache.sync()
+    with open(cache.path, "rb") as image:
+        image.seek(cache.size - 10)
+        assert image.read() == b"0123456789"
+    assert os.path.getsize(cache.path) == cache.size
+    api.file_system.shut_down()
+    assert FileSystemApi(user_id).read_file("docs/hot.txt") == b"hot" * 100
+
+    evicted = {}
+    arc = ArcCache(2, lambda page, data: evicted.setdefault(page, data))
+    arc.put(1, bytearray(b"a"))
+    arc.put(2, bytearray(b"b"))
+    assert arc.get(1) == b"a"
+    # A scan of pages used once evicts other pages used once first
+    arc.put(3, bytearray(b"c"))
+    arc.put(4, bytearray(b"d"))
+    assert 1 in arc and 2 in evicted and 3 in evicted
+    assert len(arc) == 2
+
+
+def test_readahead_sequential_reads(file_system_api):
+    lines = [f"line {i}\n".encode() for i in range(20000)]
+    data = b"".join(lines)
+    file_system_api.create_file("big.log", data)
+
+    with file_system_api.open("big.log") as stream:
+        assert list(stream) == lines
+        assert stream.readahead.fetches < 10
+        assert stream.readahead.hits > stream.readahead.misses
+
+    with file_system_api.open("big.log") as stream:
+        chunks = []
+        while chunk := stream.read(1000):
+            chunks.append(chunk)
+        assert b"".join(chunks) == data
+        assert stream.readahead.window > stream.readahead.INITIAL_WINDOW
+
+        # A seek away from the buffer is a random read and resets the window
+        stream.seek(len(data) - 5)
+        stream.readahead.invalidate()
+        assert stream.read(5) == data[-5:]
+        assert stream.readahead.window == 0
+
+    with file_system_api.open("big.log", "r+b") as stream:
+        assert stream.readline() == lines[0]
+        stream.seek(0)
+        stream.write(b"LINE")
+        stream.seek(0)
+        assert stream.readline() == b"LINE 0\n"
+
+
+def test_block_device_vectored_and_threaded_reads(file_system_api, tmp_path):
+    path = str(tmp_path / "device.img")
+    with open(path, "wb") as image:
+        image.truncate(1024 * 1024)
+
+    device = BlockDevice(path, synchronous=False)
+    buffers = [os.urandom(64) for _ in range(BlockDevice.IOV_MAX + 3)]
+    offset = 100
+    assert device.writev_at(offset, buffers) == 64 * len(buffers)
+    assert device.read_at(offset, 64 * len(buffers)) == b"".join(buffers)
+
+    targets = [bytearray(64), bytearray(10)]
+    assert device.readv_at(offset, [memoryview(b) for b in targets]) == 74
+    assert targets[0] == buffers[0] and targets[1] == buffers[1][:10]
+    # Reads stop short at the end of the image
+    assert len(device.read_at(1024 * 1024 - 5, 100)) == 5
+    device.close()
+
+    files = {f"file_{i}.txt": os.urandom(3000) for i in range(40)}
+    file_system_api.create_directory("threads")
+    file_system_api.create_files("threads", files)
+    errors = []
+
+    def read_all() -> None:
+        for name, data in files.items():
+            if file_system_api.read_file(f"threads/{name}") != data.rstrip(b"\0"):
+                errors.append(name)
+
+    workers = [threading.Thread(target=read_all) for _ in range(8)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    assert not errors
+
+
+def test_async_api_mirrors_and_orders_operations(file_system_api):
+    for name, member in inspect.getmembers(FileSystemApi, inspect.isfunction):
+        if name.startswith("_"):
+            continue
+        mirrored = getattr(AsyncFileSystemApi, name)
+        assert inspect.iscoroutinefunction(
+            mirrored
+        ) or inspect.isasyncgenfunction(mirrored), name
+    # Reads resolve relative paths against the current directory
+    assert "change_directory" in AsyncFileSystemApi.MUTATION_METHODS
+    assert "change_directory" not in AsyncFileSystemApi.READ_METHODS
+
+    async_api = AsyncFileSystemApi("test_user", file_system_api)
+
+    async def scenario():
+        await async_api.create_directory("logs")
+        await async_api.create_file("logs/app.log", b"start,")
+        # Appends queued at once still run in order
+        await asyncio.gather(
+            *(async_api.append_file("logs/app.log", f"{i},".encode()) for i in range(5))
+        )
+        contents, exists, missing = await asyncio.gather(
+            async_api.read_file("logs/app.log"),
+            async_api.exists("logs/app.log"),
+            async_api.exists("logs/other.log"),
+        )
+        with pytest.raises(FileNotFoundError):
+            await async_api.read_file("logs/other.log")
+
+        async def chunks():
+            for i in range(100):
+                yield f"line {i}\n".encode()
+
+        written = await async_api.write_file("logs/big.log", chunks())
+        lines = [line async for line in await async_api.open("logs/big.log")]
+        streamed = b"".join(
+            [chunk async for chunk in async_api.iter_file("logs/big.log", 64)]
+        )
+        names = [entry.file_name async for entry in async_api.iter_directory("logs")]
+        await async_api.change_directory("logs")
+        assert await async_api.exists("app.log")
+        return contents, exists, missing, written, lines, streamed, names
+
+    contents, exists, missing, written, lines, streamed, names = asyncio.run(
+        scenario()
+    )
+    assert contents == b"start,0,1,2,3,4,"
+    assert exists and not missing
+    expected = b"".join(f"line {i}\n".encode() for i in range(100))
+    assert written == len(expected)
+    assert b"".join(lines) == expected and len(lines) == 100
+    assert streamed == expected
+    assert sorted(names) == ["app.log", "big.log"]
+
+
+def test_copy_file_shares_extents(file_system_api):
+    data = os.urandom(4000).replace(b"\0", b"x")
+    file_system_api.create_file("big.bin", data)
+    file_system_api.create_directory("copies")
+    free_space = file_system_api.get_free_space()
+
+    file_system_api.copy_file("big.bin", "copies")
+    assert file_system_api.get_free_space() == free_space
+    assert file_system_api.read_file("copies/big.bin") == data
+    original = file_system_api.file_system.get_node("big.bin")
+    assert file_system_api.file_system.index_manager.is_extent_shared(
+        original.file_start_block
+    )
+
+    # The edited copy moves to its own blocks, the original keeps the data
+    file_system_api.edit_file("copies/big.bin", b"edited")
+    assert file_system_api.read_file("copies/big.bin") == b"edited"
+    assert file_system_api.read_file("big.bin") == data
+    assert file_system_api.get_free_space() < free_space
+
+    file_system_api.create_directory("more")
+    file_system_api.copy_file("big.bin", "more")
+    file_system_api.file_system.shut_down()
+
+    # Reference counts are rebuilt from the index on mount
+    remounted = FileSystemApi("test_user")
+    index_manager = remounted.file_system.index_manager
+    assert index_manager.is_extent_shared(original.file_start_block)
+    free_space = remounted.get_free_space()
+    remounted.delete_file("big.bin")
+    assert remounted.get_free_space() == free_space
+    assert remounted.read_file("more/big.bin") == data
+    assert not index_manager.is_extent_shared(original.file_start_block)
+    remounted.delete_file("more/big.bin")
+    assert remounted.get_free_space() > free_space
+    remounted.file_system.shut_down()
+
+
+def test_copy_directory_clones_subtree(file_system_api):
+    file_system_api.create_directory("project")
+    file_system_api.create_directory("project/src")
+    file_system_api.create_directory("project/src/empty")
+    file_system_api.file_system.create_files(
+        "/project/src", {f"module_{i}.py": f"x = {i}\n".encode() for i in range(300)}
+    )
+    file_system_api.create_file("project/README", b"readme")
+    free_space = file_system_api.get_free_space()
+
+    file_system_api.create_directory("backup")
+    file_system_api.copy_directory("project", "backup")
+    assert not file_system_api.file_system.transaction_manager.operations
+    assert sorted(file_system_api.list_directory_contents("backup/project")) == [
+        "README",
+        "src",
+    ]
+    copied = file_system_api.list_directory_contents("backup/project/src")
+    assert sorted(copied) == sorted(
+        file_system_api.list_directory_contents("project/src")
+    )
+    assert file_system_api.read_file("backup/project/src/module_7.py") == b"x = 7\n"
+    assert file_system_api.list_directory_contents("backup/project/src/empty") == []
+
+    # Only the copied directories take space, the files share their extents
+    files_size = 301 * file_system_api.file_system.config_manager.block_size
+    assert free_space - file_system_api.get_free_space() < files_size
+
+    file_system_api.edit_file("backup/project/README", b"changed")
+    file_system_api.create_file("backup/project/src/empty/new.txt", b"new")
+    assert file_system_api.read_file("project/README") == b"readme"
+    assert file_system_api.list_directory_contents("project/src/empty") == []
+
+    file_system_api.delete_directory("project")
+    file_system_api.file_system.shut_down()
+    remounted = FileSystemApi("test_user")
+    assert remounted.read_file("backup/project/src/module_299.py") == b"x = 299\n"
+    assert remounted.read_file("backup/project/README") == b"changed"
+    remounted.file_system.shut_down()
+
+
+def test_compressed_files_read_transparently(file_system_api):
+    lines = b"".join(f"{i:06d} GET /index.html 200\n".encode() for i in range(20000))
+    file_system_api.create_directory("logs")
+    file_system_api.set_compression("logs", True)
+
+    file_system_api.create_file("logs/access.log", lines)
+    file_system_api.create_file("logs/random.bin", os.urandom(8000))
+    file_system_api.create_file("plain.log", lines)
+    assert file_system_api.stat("logs/access.log").is_compressed
+    assert not file_system_api.stat("logs/random.bin").is_compressed
+    assert not file_system_api.stat("plain.log").is_compressed
+    compressed_size = file_system_api.stat("logs/access.log").file_size
+    assert compressed_size * 4 < file_system_api.stat("plain.log").file_size
+
+    assert file_system_api.read_file("logs/access.log") == lines
+    offset = 300000
+    assert file_system_api.pread("logs/access.log", offset, 5000) == (
+        lines[offset : offset + 5000]
+    )
+    with file_system_api.open("logs/access.log") as stream:
+        assert list(stream) == lines.splitlines(keepends=True)
+
+    report = file_system_api.get_compression_report()
+    assert report["files_compressed"] == 1 and report["files_skipped"] == 1
+    assert report["ratio"] > 2
+
+    # Writing into a compressed file recompresses the chunks it covers
+    file_system_api.append_file("logs/access.log", b"tail\n")
+    assert file_system_api.stat("logs/access.log").is_compressed
+    assert file_system_api.read_file("logs/access.log") == lines + b"tail\n"
+    file_system_api.edit_file("logs/access.log", lines[:100000])
+    assert file_system_api.stat("logs/access.log").is_compressed
+    assert file_system_api.read_file("logs/access.log") == lines[:100000]
+
+    file_system_api.create_directory("logs/2024")
+    assert file_system_api.stat("logs/2024").is_compressed
+    file_system_api.copy_file("logs/access.log", "/")
+    file_system_api.delete_file("logs/random.bin")
+    # Compressed extents are moved as they are stored
+    file_system_api.file_system.defragmentation()
+    file_system_api.file_system.shut_down()
+    remounted = FileSystemApi("test_user")
+    assert remounted.read_file("access.log") == lines[:100000]
+    assert remounted.stat("logs").is_compressed
+    remounted.file_system.shut_down()
+
+
+def test_writer_follows_directory_compression(file_system_api):
+    lines = b"".join(f"GET /page/{i % 50} 200\n".encode() for i in range(40000))
+    noise = os.urandom(200000).replace(b"\0", b"x")
+    file_system_api.create_directory("logs")
+    file_system_api.set_compression("logs", True)
+
+    for name, data in (("a.log", lines), ("noise.bin", noise)):
+        with file_system_api.create_writer(f"logs/{name}") as writer:
+            for offset in range(0, len(data), 10000):
+                writer.write(data[offset : offset + 10000])
+        file_system_api.create_file(f"logs/copy_{name}", data)
+        streamed = file_system_api.stat(f"logs/{name}")
+        created = file_system_api.stat(f"logs/copy_{name}")
+        assert streamed.is_compressed == created.is_compressed
+        assert streamed.file_size == created.file_size
+        assert file_system_api.read_file(f"logs/{name}") == data
+    assert file_system_api.stat("logs/a.log").is_compressed
+    assert not file_system_api.stat("logs/noise.bin").is_compressed
+
+    with file_system_api.create_writer("plain.log") as writer:
+        writer.write(lines)
+    assert not file_system_api.stat("plain.log").is_compressed
+
+
+def test_writes_to_compressed_files_keep_them_compressed(file_system_api):
+    chunk_size = file_system_api.file_system.compressor.chunk_size
+    expected = bytearray(
+        b"".join(f"{i:06d} GET /index.html 200\n".encode() for i in range(8000))
+    )
+    file_system_api.create_file("log", bytes(expected), compress=True)
+    stored_size = file_system_api.stat("log").file_size
+
+    for i in range(50):
+        line = f"{i:06d} POST /api 201\n".encode() * 200
+        file_system_api.append_file("log", line)
+        expected += line
+    file_system_api.pwrite("log", chunk_size - 10, b"X" * 20)
+    expected[chunk_size - 10 : chunk_size + 10] = b"X" * 20
+    file_system_api.pwrite("log", len(expected) + 5000, b"end")
+    expected += bytes(5000) + b"end"
+
+    assert file_system_api.stat("log").is_compressed
+    assert file_system_api.read_file("log") == bytes(expected)
+    assert file_system_api.stat("log").file_size < len(expected) // 4
+    assert file_system_api.stat("log").file_size > stored_size
+
+    # A clone keeps the extent it shares untouched
+    file_system_api.create_directory("copies")
+    file_system_api.copy_file("log", "copies")
+    file_system_api.append_file("copies/log", b"copy\n")
+    copied = bytes(expected) + b"copy\n"
+    assert file_system_api.read_file("log") == bytes(expected)
+    assert file_system_api.read_file("copies/log") == copied
+    assert file_system_api.stat("copies/log").is_compressed
+
+    # Zeros written over the end shorten the data
+    file_system_api.pwrite("log", len(expected) - 3, bytes(3))
+    del expected[-3:]
+    assert file_system_api.read_file("log") == bytes(expected).rstrip(b"\0")
+    assert file_system_api.stat("log").is_compressed
+
+    file_system_api.file_system.shut_down()
+    remounted = FileSystemApi("test_user")
+    assert remounted.read_file("log") == bytes(expected).rstrip(b"\0")
+    assert remounted.read_file("copies/log") == copied
+    remounted.file_system.shut_down()
+
+
+def test_dedup_offline_and_inline(file_system_api):
+    data = os.urandom(8000).replace(b"\0", b"x")
+    file_system_api.create_directory("docs")
+    file_system_api.create_file("a.bin", data)
+    file_system_api.create_file("docs/b.bin", data)
+    file_system_api.create_file("c.bin", data[::-1])
+    free_space = file_system_api.get_free_space()
+
+    result = file_system_api.deduplicate()
+    assert result["extents_freed"] == 1
+    assert file_system_api.get_free_space() - free_space >= 7000
+    assert file_system_api.read_file("docs/b.bin") == data
+    file_system_api.edit_file("docs/b.bin", b"changed")
+    assert file_system_api.read_file("a.bin") == data
+    assert file_system_api.deduplicate()["extents_freed"] == 0
+
+    user_id = "test_user_dedup"
+    api = FileSystemApi.create_new_file_system(
+        user_id=user_id, metadata={"dedup": True}
+    )
+    api.create_file("x.bin", data)
+    free_space = api.get_free_space()
+    api.create_file("y.bin", data)
+    api.create_directory("batch")
+    api.create_files("batch", {"1": data, "2": data[::-1], "3": data[::-1]})
+    assert free_space - api.get_free_space() < 2 * len(data)
+    assert api.read_file("batch/3") == data[::-1]
+    report = api.get_dedup_report()
+    assert report["files_deduplicated"] == 3
+    assert report["bytes_saved"] >= 3 * len(data)
+
+    # A changed file no longer matches, the digest index is checked against
+    # the stored data
+    api.pwrite("x.bin", 0, b"new start")
+    api.file_system.shut_down()
+    remounted = FileSystemApi(user_id)
+    free_space = remounted.get_free_space()
+    remounted.create_file("w.bin", data[::-1])
+    assert remounted.get_free_space() == free_space
+    remounted.create_file("z.bin", data)
+    assert remounted.get_free_space() < free_space
+    assert remounted.read_file("z.bin") == data
+    assert remounted.read_file("x.bin").startswith(b"new start")
+    remounted.file_system.shut_down()
+
+
+def test_failed_deduplicate_rolls_back_extent_references(file_system_api):
+    data = os.urandom(8000).replace(b"\0", b"x")
+    file_system_api.create_file("a.bin", data)
+    file_system_api.create_file("b.bin", data)
+    file_system = file_system_api.file_system
+    node = file_system.resolve_path("b.bin")
+    start_block = node.file_start_block
+    free_range = file_system.bitmap_manager.free_range
+
+    def failing_free_range(start, blocks):
+        raise OSError("disk error")
+
+    file_system.bitmap_manager.free_range = failing_free_range
+    with pytest.raises(OSError):
+        file_system.deduplicate()
+    file_system.bitmap_manager.free_range = free_range
+
+    assert node.file_start_block == start_block
+    assert file_system.index_manager.extent_refs == {}
+    file_system_api.edit_file("a.bin", b"changed")
+    assert file_system_api.read_file("b.bin") == data
+    assert file_system.deduplicate()["extents_freed"] == 0
+    file_system.shut_down()
+    remounted = FileSystemApi("test_user")
+    assert remounted.read_file("a.bin") == b"changed"
+    assert remounted.read_file("b.bin") == data
+    remounted.file_system.shut_down()
+
+
+def test_dedup_only_shares_extents_with_the_same_flags():
+    user_id = "test_user_dedup_flags"
+    api = FileSystemApi.create_new_file_system(
+        user_id=user_id,
+        metadata={"dedup": True, "large_region_size": 8 * 1024 * 1024},
+    )
+    file_system = api.file_system
+    holes = b"a" * 4096 + bytes(16384) + b"b" * 4096
+    api.create_file("sparse.bin", holes)
+    node = file_system.resolve_path("sparse.bin")
+    assert node.is_sparse
+    stored = bytes(
+        file_system.storage.read_at(
+            file_system.data_offset(node.file_start_block),
+            node.file_blocks * file_system.config_manager.block_size,
+        )
+    ).rstrip(b"\0")
+
+    # The same bytes as a plain file must not be read through the run table
+    api.create_file("plain.bin", stored)
+    assert not file_system.resolve_path("plain.bin").is_sparse
+    assert api.read_file("plain.bin") == stored
+    api.create_files("/", {"batch.bin": stored})
+    assert api.read_file("batch.bin") == stored
+    assert api.read_file("sparse.bin") == holes
+    assert api.get_dedup_report()["files_deduplicated"] == 1
+
+    # The digest index is a file of the volume but not one of the user's
+    names = {node.file_name for node in file_system.list_all_files()}
+    assert names >= {"sparse.bin", "plain.bin", "batch.bin"}
+    assert not any(name.startswith("/") for name in names)
+    assert file_system.find_file_by_name("/dedup") is None
+    assert file_system.index_manager.find_file_by_name("/dedup") is None
+    file_system.shut_down()
+    remounted = FileSystemApi(user_id)
+    remounted.create_file("again.bin", stored)
+    assert remounted.get_dedup_report()["files_deduplicated"] == 1
+    remounted.file_system.shut_down()
+
+
+def test_sparse_files_skip_holes(file_system_api):
+    hole = bytes(1024 * 1024)
+    data = b"header" + hole + b"middle" + hole + os.urandom(10000).replace(b"\0", b"x")
+    file_system_api.create_file("disk.img", data)
+    file_system_api.create_file("dense.img", data.replace(b"\0", b"\1"))
+    assert file_system_api.stat("disk.img").is_sparse
+    assert not file_system_api.stat("dense.img").is_sparse
+    sparse_size = file_system_api.stat("disk.img").file_size
+    assert sparse_size * 50 < file_system_api.stat("dense.img").file_size
+
+    assert file_system_api.read_file("disk.img") == data
+    assert file_system_api.pread("disk.img", 4000, 100000) == data[4000:104000]
+    with file_system_api.open("disk.img") as stream:
+        assert stream.read() == data
+        assert list(stream.data_ranges()) == [
+            (0, 4096),
+            (len(hole), len(hole) + 4096),
+            (2 * len(hole), len(data)),
+        ]
+        assert stream.seek(5000, os.SEEK_DATA) == len(hole)
+        assert stream.seek(5000, os.SEEK_HOLE) == 5000
+        assert stream.seek(len(hole) + 10, os.SEEK_HOLE) == len(hole) + 4096
+        with pytest.raises(OSError):
+            stream.seek(len(data), os.SEEK_DATA)
+
+    # Writes inside the stored runs stay in place, a write into a hole
+    # rewrites the runs and keeps the remaining holes out
+    file_system_api.pwrite("disk.img", 2, b"ADER")
+    assert file_system_api.stat("disk.img").file_size == sparse_size
+    file_system_api.pwrite("disk.img", 500000, b"filled")
+    data = data[:2] + b"ADER" + data[6:500000] + b"filled" + data[500006:]
+    assert file_system_api.stat("disk.img").is_sparse
+    assert file_system_api.read_file("disk.img") == data
+    file_system_api.append_file("disk.img", b"tail")
+    assert file_system_api.read_file("disk.img") == data + b"tail"
+
+    file_system_api.create_directory("copies")
+    file_system_api.copy_file("disk.img", "copies")
+    file_system_api.edit_file("dense.img", data)
+    assert file_system_api.stat("dense.img").is_sparse
+    file_system_api.file_system.shut_down()
+    remounted = FileSystemApi("test_user")
+    assert remounted.read_file("copies/disk.img") == data + b"tail"
+    assert remounted.read_file("dense.img") == data
+    remounted.file_system.shut_down()
+
+
+
+def test_writer_leaves_out_holes(file_system_api, monkeypatch):
+    image = bytearray(4 * 1024 * 1024)
+    image[:512] = b"boot" * 128
+    image[3 * 1024 * 1024 : 3 * 1024 * 1024 + 32] = b"partition table!" * 2
+    image = bytes(image)
+    storage = file_system_api.file_system.storage
+    write_at = storage.write_at
+    written = []
+
+    def counting_write(offset, data):
+        written.append(len(data))
+        return write_at(offset, data)
+
+    monkeypatch.setattr(storage, "write_at", counting_write)
+    with file_system_api.create_writer("vm.img", size_hint=len(image)) as writer:
+        for offset in range(0, len(image), 64 * 1024):
+            writer.write(image[offset : offset + 64 * 1024])
+    monkeypatch.setattr(storage, "write_at", write_at)
+    # The zero chunks are never written, only the data, the table and the
+    # index and bitmap entries
+    assert sum(written) < 64 * 1024
+
+    file_system_api.create_file("created.img", image)
+    streamed = file_system_api.stat("vm.img")
+    assert streamed.is_sparse
+    assert streamed.file_size == file_system_api.stat("created.img").file_size
+    assert file_system_api.read_file("vm.img") == image.rstrip(b"\0")
+    with file_system_api.open("vm.img") as stream:
+        assert list(stream.data_ranges()) == [
+            (0, 4096),
+            (3 * 1024 * 1024, 3 * 1024 * 1024 + 32),
+        ]
+
+    # Without enough holes the runs are spread out to their offsets
+    dense = os.urandom(60000).replace(b"\0", b"x")
+    dense = dense[:8192] + bytes(4096) + dense[8192:]
+    with file_system_api.create_writer("dense.bin") as writer:
+        writer.write(dense)
+    assert not file_system_api.stat("dense.bin").is_sparse
+    assert file_system_api.read_file("dense.bin") == dense
+
+def test_large_block_region(file_system_api):
+    user_id = "test_user_regions"
+    api = FileSystemApi.create_new_file_system(
+        user_id=user_id, metadata={"large_region_size": 40 * 1024 * 1024}
+    )
+    config = api.file_system.config_manager
+    assert config.small_bitmap_size + config.large_bitmap_size == config.bitmap_size
+    assert config.large_bitmap_size * 100 < config.small_bitmap_size
+
+    big = os.urandom(100000).replace(b"\0", b"x")
+    large_bitmap = api.file_system.bitmap_manager.large.bitmap
+    api.create_file("small.txt", b"tiny")
+    api.create_file("big.bin", big)
+    small_node = api.file_system.resolve_path("small.txt")
+    big_node = api.file_system.resolve_path("big.bin")
+    assert not small_node.is_large
+    assert big_node.is_large
+    ratio = config.blocks_per_large_block
+    offset = big_node.file_start_block - config.small_num_blocks
+    assert offset >= 0 and offset % ratio == 0
+    # The big file takes whole large blocks
+    assert sum(bin(byte).count("1") for byte in large_bitmap) == 25
+
+    # Growing into the rest of the last large block needs no new blocks
+    api.append_file("big.bin", b"more")
+    assert api.file_system.resolve_path("big.bin").file_start_block == (
+        big_node.file_start_block
+    )
+    api.create_files("/", {"a.bin": big, "b.txt": b"b", "c.bin": big[::-1]})
+    assert [
+        api.file_system.resolve_path(name).is_large
+        for name in ("a.bin", "b.txt", "c.bin")
+    ] == [True, False, True]
+    assert sum(bin(byte).count("1") for byte in large_bitmap) == sum(
+        -(-api.file_system.resolve_path(name).file_blocks // ratio)
+        for name in ("big.bin", "a.bin", "c.bin")
+    )
+    with api.create_writer("streamed.bin") as writer:
+        writer.write(big)
+
+    freed_block = api.file_system.resolve_path("a.bin").file_start_block
+    api.delete_file("a.bin")
+    api.file_system.shut_down()
+    remounted = FileSystemApi(user_id)
+    assert remounted.read_file("big.bin") == big + b"more"
+    assert remounted.read_file("c.bin") == big[::-1]
+    assert remounted.read_file("streamed.bin") == big
+    assert remounted.file_system.resolve_path("streamed.bin").is_large
+    assert remounted.read_file("b.txt") == b"b"
+    remounted.create_file("d.bin", big)
+    assert remounted.file_system.resolve_path("d.bin").file_start_block == (
+        freed_block
+    )
+    remounted.file_system.shut_down()
+
+
+@pytest.mark.parametrize("backend", ["file", "mmap"])
+def test_grow_volume_online(backend):
+    user_id = f"test_user_grow_{backend}"
+    api = FileSystemApi.create_new_file_system(
+        user_id=user_id,
+        metadata={
+            "file_system_size": 1024 * 1024,
+            "file_index_size": 64 * 1024,
+            "storage_backend": backend,
+        },
+    )
+    file_system = api.file_system
+    data_start = file_system.config_manager.data_start
+    api.create_directory("docs")
+    # Trailing zeros are not stored, so the files must not end with any
+    files = {
+        f"docs/{i}.bin": os.urandom(1000 + i).replace(b"\0", b"x") for i in range(20)
+    }
+    for path, data in files.items():
+        api.create_file(path, data)
+    with pytest.raises(Exception):
+        api.create_file("big.bin", os.urandom(2 * 1024 * 1024))
+    with pytest.raises(ValueError):
+        api.grow(512 * 1024)
+
+    # Block numbers take a byte more, so the index is rewritten past the data
+    api.grow(4 * 1024 * 1024)
+    config = file_system.config_manager
+    assert api.get_total_space() == 4 * 1024 * 1024
+    assert config.data_start == data_start
+    assert config.bitmap_offset >= data_start + config.file_system_size
+    assert config.index_offset == config.bitmap_offset + config.bitmap_size
+    for path, data in files.items():
+        assert api.read_file(path) == data
+    big = os.urandom(2 * 1024 * 1024).replace(b"\0", b"x")
+    api.create_file("big.bin", big)
+
+    # The data region now covers where the bitmaps and the index were moved to
+    api.grow(8 * 1024 * 1024, 128 * 1024)
+    assert file_system.config_manager.data_start == data_start
+    assert file_system.config_manager.max_index_entries > config.max_index_entries
+    assert api.read_file("big.bin") == big
+    api.create_file("docs/more.bin", big[::-1])
+    api.create_file("bigger.bin", big + big[: 1024 * 1024])
+    file_system.shut_down()
+
+    remounted = FileSystemApi(user_id)
+    assert remounted.get_total_space() == 8 * 1024 * 1024
+    for path, data in files.items():
+        assert remounted.read_file(path) == data
+    assert remounted.read_file("big.bin") == big
+    assert remounted.read_file("docs/more.bin") == big[::-1]
+    assert remounted.read_file("bigger.bin") == big + big[: 1024 * 1024]
+    assert len(remounted.list_directory_contents("docs")) == 21
+    remounted.file_system.shut_down()
@@ -17,13 +17,14 @@ def reset_seek_to_zero(func):
     return wrapper
 
 
-def open_file_without_cache(filepath, mode):
+def open_file_without_cache(filepath, mode, synchronous=True):
     """
     Opens a file without using the OS-level buffer cache.
 
     Args:
         filepath (str): The path to the file.
         mode (str): The mode to open the file in.
+        synchronous (bool): Whether writes wait for the disk (O_SYNC).
 
     Returns:
         A file object.
@@ -47,7 +48,7 @@ def open_file_without_cache(filepath, mode):
 
     if os.name == "nt":
         flags |= os.O_BINARY
-    else:
+    elif synchronous:
         flags |= os.O_SYNC  # pylint: disable=no-member
 
     fd = os.open(filepath, flags)